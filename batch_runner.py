@@ -0,0 +1,321 @@
+"""
+批量请求运行器
+对评测集、聊天记录等成千上万条数据批量调用对话接口或审核接口：
+- 输入为JSONL文件，每行一个请求；结果在完成时立即追加写入输出JSONL文件
+- 限制并发数量，请求仍然经过 tool.py 的提供商配置、限流、重试和缓存
+- 断点续跑：输出文件本身就是检查点，中断后重新运行会跳过已经成功的请求
+- 汇总token用量、预估费用和延迟分位数
+
+输入格式（每行一个JSON）:
+    对话模式: {"id": "q1", "messages": [...], "model": 可选, "temperature": 可选, "max_tokens": 可选}
+              或者直接是消息列表 [...]
+    审核模式: {"id": "m1", "input": "文本"}、{"id": "m1", "messages": [...]}（审核其中用户消息的内容）
+              或者直接是字符串
+    没有 id 时使用行号作为 id。
+
+使用方法:
+    python batch_runner.py questions.jsonl answers.jsonl --concurrency 16
+    python batch_runner.py chat_logs.jsonl moderation.jsonl --mode moderation
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+from tool import achat_completion, aclose_sessions, APIError
+from moderation_service import get_moderation_service
+from token_counter import estimate_cost
+from metrics import percentile
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _read_items(input_path):
+    """
+    逐行读取输入文件，产出 (id, 请求)，跳过空行
+
+    不是有效JSON的行产出 (行号, json.JSONDecodeError)，由调用方记录为失败，不影响后面的行。
+    """
+    with open(input_path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, e
+                continue
+            if isinstance(item, dict) and item.get('id') is not None:
+                yield item['id'], item
+            else:
+                yield line_number, item
+
+
+def _load_checkpoint(output_path):
+    """
+    读取已有的输出文件，返回已经成功的请求id集合
+
+    上次运行在写入过程中被中断时，文件末尾可能有不完整的一行，会被截掉。
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if 'error' not in record:
+            done.add(_id_key(record.get('id')))
+    return done
+
+
+def _id_key(item_id):
+    # id 可能是数字或字符串，统一转换后比较
+    return json.dumps(item_id, ensure_ascii=False)
+
+
+def _moderation_text(item):
+    if isinstance(item, str):
+        return item
+    if isinstance(item, list):
+        item = {'messages': item}
+    if 'input' in item:
+        return item['input']
+    if 'text' in item:
+        return item['text']
+    return '\n'.join(m.get('content') or '' for m in item.get('messages', []) if m.get('role') == 'user')
+
+
+class BatchStats:
+    """
+    批量运行的汇总统计
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.cached = 0
+        self.flagged = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.estimated_cost = 0.0
+        self.unpriced = 0
+        self.latencies = []
+
+    def record(self, record):
+        self.latencies.append(record['latency'])
+        if 'error' in record:
+            self.failed += 1
+            return
+        self.succeeded += 1
+        if record.get('cached'):
+            self.cached += 1
+        if record.get('flagged'):
+            self.flagged += 1
+        usage = record.get('usage')
+        if usage:
+            prompt = usage.get('prompt_tokens') or 0
+            completion = usage.get('completion_tokens') or 0
+            self.prompt_tokens += prompt
+            self.completion_tokens += completion
+            self.total_tokens += usage.get('total_tokens') or prompt + completion
+            cost = estimate_cost(record.get('model'), prompt, completion)
+            if cost is None:
+                self.unpriced += 1
+            else:
+                self.estimated_cost += cost
+
+    def summary(self):
+        """
+        返回:
+            dict: 请求数量、token用量、预估费用、吞吐量和延迟分位数（秒）
+        """
+        elapsed = time.monotonic() - self.started_at
+        latencies = sorted(self.latencies)
+        finished = self.succeeded + self.failed
+        latency = {f'p{p}': percentile(latencies, p) for p in PERCENTILES}
+        latency['mean'] = sum(latencies) / len(latencies) if latencies else None
+        latency['max'] = latencies[-1] if latencies else None
+        return {
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'cached': self.cached,
+            'flagged': self.flagged,
+            'usage': {
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'total_tokens': self.total_tokens,
+            },
+            'estimated_cost': round(self.estimated_cost, 6),
+            'unpriced_requests': self.unpriced,
+            'elapsed': round(elapsed, 3),
+            'throughput': round(finished / elapsed, 3) if elapsed > 0 else None,
+            'latency': latency,
+        }
+
+
+async def _run_chat(item_id, item, model, temperature, max_tokens):
+    if isinstance(item, list):
+        item = {'messages': item}
+    result = await achat_completion(
+        item['messages'],
+        model=item.get('model', model),
+        temperature=item.get('temperature', temperature),
+        max_tokens=item.get('max_tokens', max_tokens),
+    )
+    return {'id': item_id, **result.as_dict()}
+
+
+async def _run_moderation(item_id, item):
+    result = await get_moderation_service().amoderate(_moderation_text(item))
+    if 'error' in result:
+        raise APIError(result['error'])
+    return {
+        'id': item_id,
+        'flagged': result.get('flagged', False),
+        'categories': result.get('categories', {}),
+        'category_scores': result.get('category_scores', {}),
+    }
+
+
+async def arun_batch(input_path, output_path, mode='chat', concurrency=8, model=None,
+                     temperature=0, max_tokens=500, resume=True, progress_interval=10.0):
+    """
+    批量运行输入文件中的请求，结果在完成时立即追加写入输出文件
+
+    参数:
+        input_path: 输入JSONL文件路径
+        output_path: 输出JSONL文件路径，同时作为断点续跑的检查点
+        mode: 'chat'（对话）或 'moderation'（审核）
+        concurrency: 同时进行的请求数量上限
+        model, temperature, max_tokens: 对话模式的默认参数，可被每行请求中的同名字段覆盖
+        resume: 为True时跳过输出文件中已经成功的请求；为False时清空输出文件重新运行
+        progress_interval: 每隔多少秒在标准错误输出打印一次进度，为None时不打印
+
+    返回:
+        dict: 汇总统计，详见 BatchStats.summary()
+
+    输出格式（每行一个JSON，顺序为完成顺序）:
+        对话成功: {"id", "content", "usage", "provider", "model", "cached", "tool_calls", "finish_reason", "latency"}
+        审核成功: {"id", "flagged", "categories", "category_scores", "latency"}
+        失败: {"id", "error", "status_code", "latency"}，续跑时会重新请求；
+              不是有效JSON的行另外带有 "line"（行号，同时作为id），不会发送请求
+    """
+    if mode not in ('chat', 'moderation'):
+        raise ValueError(f"未知的模式: {mode}")
+
+    done = _load_checkpoint(output_path) if resume else set()
+    stats = BatchStats()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as out:
+
+        def write(record):
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            stats.record(record)
+
+        async def worker():
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    return
+                item_id, item = entry
+                start = time.monotonic()
+                try:
+                    if mode == 'chat':
+                        record = await _run_chat(item_id, item, model, temperature, max_tokens)
+                    else:
+                        record = await _run_moderation(item_id, item)
+                except Exception as e:
+                    # 单条请求失败（包括输入格式错误）不影响其他请求，续跑时会重新请求
+                    record = {'id': item_id, 'error': str(e), 'status_code': getattr(e, 'status_code', None)}
+                record['latency'] = round(time.monotonic() - start, 4)
+                write(record)
+
+        async def report():
+            while True:
+                await asyncio.sleep(progress_interval)
+                summary = stats.summary()
+                print(f"进度: 成功{summary['succeeded']} 失败{summary['failed']} 跳过{summary['skipped']}，"
+                      f"{summary['throughput']}条/秒，p50延迟{summary['latency']['p50']}秒",
+                      file=sys.stderr, flush=True)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        reporter = asyncio.create_task(report()) if progress_interval else None
+        try:
+            for item_id, item in _read_items(input_path):
+                if _id_key(item_id) in done:
+                    stats.skipped += 1
+                    continue
+                if isinstance(item, json.JSONDecodeError):
+                    write({'id': item_id, 'line': item_id, 'error': f"第{item_id}行不是有效的JSON: {item}",
+                           'status_code': None, 'latency': 0.0})
+                    continue
+                await queue.put((item_id, item))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            if reporter is not None:
+                reporter.cancel()
+            await aclose_sessions()
+
+    return stats.summary()
+
+
+def run_batch(input_path, output_path, **kwargs):
+    """
+    arun_batch 的同步版本，参数和返回值相同
+    """
+    return asyncio.run(arun_batch(input_path, output_path, **kwargs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量调用对话接口或审核接口')
+    parser.add_argument('input', help='输入JSONL文件')
+    parser.add_argument('output', help='输出JSONL文件（同时作为断点续跑的检查点）')
+    parser.add_argument('--mode', choices=('chat', 'moderation'), default='chat', help='对话或审核（默认: chat）')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发请求数量（默认: 8）')
+    parser.add_argument('--model', default=None, help='默认模型（默认: 当前提供商的默认模型）')
+    parser.add_argument('--temperature', type=float, default=0, help='默认温度（默认: 0）')
+    parser.add_argument('--max-tokens', type=int, default=500, help='默认回复长度上限（默认: 500）')
+    parser.add_argument('--restart', action='store_true', help='清空输出文件重新运行，不续跑')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='打印进度的间隔秒数，0表示不打印')
+    args = parser.parse_args(argv)
+
+    try:
+        summary = run_batch(
+            args.input, args.output,
+            mode=args.mode,
+            concurrency=args.concurrency,
+            model=args.model,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            resume=not args.restart,
+            progress_interval=args.progress_interval or None,
+        )
+    except KeyboardInterrupt:
+        print("已中断，重新运行相同的命令会从中断处继续", file=sys.stderr)
+        return 130
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
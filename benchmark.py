@@ -0,0 +1,384 @@
+"""
+可重复的离线性能测试
+默认在本进程内启动 mock_server.MockServer，并通过 DEEPSEEK_BASE_URL / OPENAI_BASE_URL
+让所有请求发往模拟服务，测量 tool.py 本身的开销以及并发、流式、审核路径的吞吐量和延迟分位数。
+结果保存为JSON，可以与之前的结果对比，发现性能回退。
+
+测试场景:
+    single      顺序调用 chat_completion（单个调用的延迟和客户端开销）
+    concurrent  多个会话并发进行多轮对话（achat_completion，对话历史逐轮增长）
+    streaming   多个会话并发进行流式对话（首段内容延迟 ttft 和总耗时）
+    moderation  并发提交审核请求（经过审核服务的缓存与批量合并）
+    import      冷启动导入耗时：在新的Python进程中导入 tool 和 pizza_bot（结果为 import.tool、import.pizza_bot）
+
+使用方法:
+    python benchmark.py --output bench_before.json
+    python benchmark.py --output bench_after.json --compare bench_before.json
+    python benchmark.py --scenarios concurrent,streaming --sessions 50 --latency 0.2
+    python benchmark.py --scenarios import --import-repeats 20
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import tool
+from tool import chat_completion, achat_completion, astream_completion_from_messages, APIError
+from metrics import percentile
+from menu import MENU_TEXT
+from mock_server import MockServer
+
+SCENARIOS = ('single', 'concurrent', 'streaming', 'moderation', 'import')
+
+# import 场景测量的模块
+IMPORT_MODULES = ('tool', 'pizza_bot')
+
+# 与披萨机器人相同的菜单，保证请求体大小接近真实情况
+SYSTEM_PROMPT = {'role': 'system', 'content': (
+    "你是订餐机器人，为披萨餐厅自动收集订单信息。你要首先问候顾客，然后等待用户回复收集订单信息。"
+    "收集完信息需确认顾客是否还需要添加其他内容。最后需要询问是否自取或外送，如果是外送，你要询问地址。"
+    "最后告诉顾客订单总金额，并送上祝福。请确保明确所有选项、附加项和尺寸，以便从菜单中识别出该项唯一的内容。"
+    "\n\n菜单包括：\n\n" + MENU_TEXT
+)}
+
+
+def _summary(latencies, errors, elapsed, extra=None):
+    """汇总一个场景的结果：吞吐量（成功请求/秒）和延迟分位数（秒）"""
+    latencies = sorted(latencies)
+    result = {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'elapsed': round(elapsed, 4),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'latency': _distribution(latencies),
+    }
+    if extra:
+        result.update(extra)
+    return result
+
+
+def _distribution(sorted_values):
+    if not sorted_values:
+        return {}
+    return {
+        'p50': round(percentile(sorted_values, 50), 5),
+        'p90': round(percentile(sorted_values, 90), 5),
+        'p99': round(percentile(sorted_values, 99), 5),
+        'mean': round(sum(sorted_values) / len(sorted_values), 5),
+        'max': round(sorted_values[-1], 5),
+    }
+
+
+def _user_message(session, turn):
+    # 每个请求的内容都不同，避免命中回复缓存
+    return {'role': 'user', 'content': f"会话{session}第{turn}轮：我想要一个中号芝士披萨，加蘑菇"}
+
+
+def bench_single(requests):
+    """顺序发送 requests 个请求"""
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for i in range(requests):
+        begin = time.perf_counter()
+        try:
+            chat_completion([SYSTEM_PROMPT, _user_message(0, i)])
+        except APIError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - begin)
+    return _summary(latencies, errors, time.perf_counter() - started)
+
+
+async def bench_concurrent(sessions, turns):
+    """sessions 个会话并发，每个会话进行 turns 轮对话"""
+    latencies, errors = [], [0]
+
+    async def run_session(session):
+        history = [SYSTEM_PROMPT]
+        for turn in range(turns):
+            history.append(_user_message(session, turn))
+            begin = time.perf_counter()
+            try:
+                result = await achat_completion(history)
+            except APIError:
+                errors[0] += 1
+                history.pop()
+                continue
+            latencies.append(time.perf_counter() - begin)
+            history.append({'role': 'assistant', 'content': result.content})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_session(s) for s in range(sessions)))
+    return _summary(latencies, errors[0], time.perf_counter() - started)
+
+
+async def bench_streaming(sessions, turns):
+    """sessions 个会话并发进行流式对话，额外记录首段内容延迟（ttft）"""
+    latencies, ttfts, errors = [], [], [0]
+
+    async def run_session(session):
+        history = [SYSTEM_PROMPT]
+        for turn in range(turns):
+            history.append(_user_message(session, turn))
+            begin = time.perf_counter()
+            chunks = []
+            try:
+                async for chunk in astream_completion_from_messages(history):
+                    if not chunks:
+                        ttfts.append(time.perf_counter() - begin)
+                    chunks.append(chunk)
+            except APIError:
+                errors[0] += 1
+                history.pop()
+                continue
+            latencies.append(time.perf_counter() - begin)
+            history.append({'role': 'assistant', 'content': ''.join(chunks)})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_session(s) for s in range(sessions)))
+    return _summary(latencies, errors[0], time.perf_counter() - started,
+                    {'ttft': _distribution(sorted(ttfts))})
+
+
+async def bench_moderation(requests, concurrency):
+    """以 concurrency 的并发度提交 requests 个不同文本的审核请求"""
+    from moderation_service import get_moderation_service
+
+    service = get_moderation_service()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], [0]
+
+    async def moderate(i):
+        async with semaphore:
+            begin = time.perf_counter()
+            result = await service.amoderate(f"第{i}条消息：我想要一个大号意式辣香肠披萨")
+            if 'error' in result:
+                errors[0] += 1
+                return
+            latencies.append(time.perf_counter() - begin)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(moderate(i) for i in range(requests)))
+    return _summary(latencies, errors[0], time.perf_counter() - started,
+                    {'service': service.stats()})
+
+
+def bench_import(repeats, modules=IMPORT_MODULES):
+    """
+    冷启动导入耗时：每次在新的Python进程中导入模块，只计算 import 语句本身的耗时（不包括解释器启动）
+
+    每个模块先导入一次（生成字节码缓存）不计入结果。
+
+    返回:
+        dict: {'import.模块名': 结果}，结果的 latency 为导入耗时的分布（秒）
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+        timings, errors = [], 0
+        started = time.perf_counter()
+        for attempt in range(repeats + 1):
+            process = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True)
+            if process.returncode != 0:
+                errors += 1
+            elif attempt:
+                timings.append(float(process.stdout.split()[-1]))
+        results[f'import.{module}'] = _summary(timings, errors, time.perf_counter() - started, {'throughput': None})
+    return results
+
+
+def describe_environment():
+    """记录运行环境，便于判断两次结果是否可比"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    optional = {}
+    for module in ('orjson', 'h2', 'tiktoken'):
+        try:
+            __import__(module)
+            optional[module] = True
+        except ImportError:
+            optional[module] = False
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'optional_packages': optional,
+    }
+
+
+def start_mock_server(**options):
+    """
+    在后台线程中启动模拟服务，并让所有提供商的请求发往该服务（没有API密钥时设置为 mock）
+
+    参数:
+        **options: 传给 MockServer 的参数
+
+    返回:
+        MockServer: 已启动的模拟服务，用完后调用 stop()
+    """
+    server = MockServer(**options).start()
+    for config in tool.API_CONFIGS.values():
+        os.environ[config['base_url_env']] = server.url
+        if not os.getenv(config['key']):
+            os.environ[config['key']] = 'mock'
+    tool.reload_api_config()
+    return server
+
+
+def run_benchmarks(scenarios=SCENARIOS, requests=200, sessions=20, turns=5, mock=True,
+                   latency=0.05, jitter=0.0, token_delay=0.002, reply_tokens=30, error_rate=0.0, seed=0,
+                   import_repeats=10):
+    """
+    运行性能测试
+
+    参数:
+        scenarios: 要运行的场景
+        requests: single 和 moderation 场景的请求数量
+        sessions, turns: concurrent 和 streaming 场景的会话数量和每个会话的轮数
+        mock: 为True时在本进程内启动模拟服务；为False时请求真实配置的提供商（会产生费用）
+        latency, jitter, token_delay, reply_tokens, error_rate, seed: 模拟服务的参数，详见 MockServer
+        import_repeats: import 场景每个模块导入的次数
+
+    返回:
+        dict: {'environment': 运行环境, 'parameters': 参数, 'results': {场景: 结果}}
+    """
+    parameters = {
+        'requests': requests, 'sessions': sessions, 'turns': turns, 'mock': mock,
+        'latency': latency, 'jitter': jitter, 'token_delay': token_delay,
+        'reply_tokens': reply_tokens, 'error_rate': error_rate, 'seed': seed,
+        'import_repeats': import_repeats,
+    }
+    server = None
+    if mock:
+        server = start_mock_server(latency=latency, jitter=jitter, token_delay=token_delay,
+                                   reply_tokens=reply_tokens, error_rate=error_rate, seed=seed)
+    # 每个请求的内容都不同，关闭回复缓存避免额外的开销影响结果
+    tool.disable_completion_cache()
+
+    results = {}
+    try:
+        if 'import' in scenarios:
+            results.update(bench_import(import_repeats))
+        if 'single' in scenarios:
+            results['single'] = bench_single(requests)
+
+        async def run_async():
+            try:
+                if 'concurrent' in scenarios:
+                    results['concurrent'] = await bench_concurrent(sessions, turns)
+                if 'streaming' in scenarios:
+                    results['streaming'] = await bench_streaming(sessions, turns)
+                if 'moderation' in scenarios:
+                    results['moderation'] = await bench_moderation(requests, sessions)
+            finally:
+                await tool.aclose_sessions()
+
+        asyncio.run(run_async())
+    finally:
+        if server is not None:
+            parameters['server_requests'] = server.stats()
+            server.stop()
+
+    return {'environment': describe_environment(), 'parameters': parameters, 'results': results}
+
+
+def compare(current, baseline, threshold=0.10):
+    """
+    对比两次结果，返回 (对比文本, 是否有回退)
+
+    吞吐量下降或 p50/p99 延迟上升超过 threshold（比例）时视为回退。
+    """
+    lines = [f"{'场景':<18}{'指标':<14}{'之前':>12}{'现在':>12}{'变化':>10}"]
+    regressed = False
+    for scenario, result in current['results'].items():
+        old = baseline.get('results', {}).get(scenario)
+        if not old:
+            continue
+        metrics = [('throughput', old.get('throughput'), result.get('throughput'), True)]
+        for key in ('p50', 'p99'):
+            metrics.append((f'latency.{key}', old['latency'].get(key), result['latency'].get(key), False))
+            if 'ttft' in result:
+                metrics.append((f'ttft.{key}', old.get('ttft', {}).get(key), result['ttft'].get(key), False))
+        for name, before, after, higher_is_better in metrics:
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = ' ⚠'
+                regressed = True
+            lines.append(f"{scenario:<18}{name:<14}{before:>12.4f}{after:>12.4f}{change:>+10.1%}{flag}")
+    return '\n'.join(lines), regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='离线性能测试（默认使用本地模拟服务）')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"逗号分隔的场景（默认: {','.join(SCENARIOS)}）")
+    parser.add_argument('--requests', type=int, default=200, help='single 和 moderation 场景的请求数量')
+    parser.add_argument('--sessions', type=int, default=20, help='并发会话数量')
+    parser.add_argument('--turns', type=int, default=5, help='每个会话的对话轮数')
+    parser.add_argument('--live', action='store_true', help='请求真实配置的提供商（会产生费用）')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟服务返回响应头之前的延迟秒数')
+    parser.add_argument('--jitter', type=float, default=0.0, help='模拟服务随机增加的最大延迟秒数')
+    parser.add_argument('--token-delay', type=float, default=0.002, help='模拟服务流式响应每段之间的间隔秒数')
+    parser.add_argument('--reply-tokens', type=int, default=30, help='模拟服务每次回复的段数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务注入错误的比例')
+    parser.add_argument('--seed', type=int, default=0, help='模拟服务的随机数种子')
+    parser.add_argument('--import-repeats', type=int, default=10, help='import 场景每个模块导入的次数')
+    parser.add_argument('--output', default='benchmark_results.json', help='结果保存路径')
+    parser.add_argument('--compare', default=None, help='与之前保存的结果对比')
+    parser.add_argument('--threshold', type=float, default=0.10, help='对比时视为回退的变化比例（默认: 0.10）')
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(sorted(unknown))}")
+
+    report = run_benchmarks(
+        scenarios, requests=args.requests, sessions=args.sessions, turns=args.turns, mock=not args.live,
+        latency=args.latency, jitter=args.jitter, token_delay=args.token_delay,
+        reply_tokens=args.reply_tokens, error_rate=args.error_rate, seed=args.seed,
+        import_repeats=args.import_repeats,
+    )
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for scenario, result in report['results'].items():
+        latency = result['latency']
+        line = f"{scenario:<18}"
+        if result['throughput'] is not None:
+            line += f"吞吐量 {result['throughput']}/秒  "
+        line += f"p50 {latency.get('p50')}秒  p99 {latency.get('p99')}秒  错误 {result['errors']}/{result['requests']}"
+        if 'ttft' in result:
+            line += f"  ttft p50 {result['ttft'].get('p50')}秒"
+        print(line)
+    print(f"结果已保存到 {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        text, regressed = compare(report, baseline, args.threshold)
+        print()
+        print(text)
+        if regressed:
+            print(f"\n⚠ 有指标变差超过 {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
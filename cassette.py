@@ -0,0 +1,440 @@
+"""
+API请求的录制与回放（cassette）
+在 tool.py 发送HTTP请求的最底层录制请求和响应，之后在本地回放，
+不访问网络即可快速、确定地重复运行披萨机器人和练习脚本的整段对话。
+
+- 录制（record）：照常发送请求，同时保存响应的状态码、响应头、响应体，
+  以及每个数据块（流式响应的每段SSE）相对请求开始的到达时间
+- 回放（replay）：按请求的规范化键查找录制的响应，在本地返回；
+  latency='original' 按录制时的首字节时间和数据块间隔返回，latency='none' 立即返回。
+  没有录制的请求抛出 CassetteMiss
+- 自动（auto）：有录制时回放，没有时发送请求并录制
+
+请求键是 提供商 + 接口名称（请求路径的最后一段，如 completions）+ 按键排序的JSON请求体
+的SHA-256哈希，不包括API密钥和服务地址，回放时可以使用任意的API密钥和 *_BASE_URL。
+同一个键录制了多次时（如温度不为0的相同请求、先收到429再重试成功），
+回放时按录制的顺序依次返回，用完后从头循环。
+
+录制保存在一个SQLite文件中，以 (请求键, 序号) 为主键，请求体和响应体用zlib压缩。
+响应体保存的是解压后的内容（录制时要求服务端不压缩），同步（requests）和异步（httpx）
+调用录制的内容可以互相回放。
+"""
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urlsplit
+
+from env_loader import getenv
+from metrics import percentile
+
+MODES = ('record', 'replay', 'auto')
+LATENCIES = ('original', 'none')
+
+# 不保存的响应头：响应体保存的是解压后的完整内容，这些头已经不再适用
+_DROPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'set-cookie')
+
+
+class CassetteMiss(LookupError):
+    """回放模式下，请求没有对应的录制"""
+
+
+def request_key(provider, url, data):
+    """
+    生成请求的规范化键
+
+    参数:
+        provider: API提供商名称
+        url: 请求地址（只使用路径的最后一段，与服务地址无关）
+        data: 请求体字典
+
+    返回:
+        str: 十六进制哈希字符串
+    """
+    endpoint = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+    canonical = json.dumps([provider, endpoint, data], ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _operation(data):
+    """录制的调用类型: completion、stream 或 moderation"""
+    if 'messages' not in data:
+        return 'moderation'
+    return 'stream' if data.get('stream') else 'completion'
+
+
+class _Recording:
+    """录制中的一次响应：收集数据块和到达时间，读完或关闭时写入cassette（只写一次）"""
+
+    def __init__(self, cassette, key, provider, url, data, status, reason, headers, started, ttfb):
+        self._cassette = cassette
+        self._row = (key, provider, url, data, status, reason, headers, ttfb)
+        self._started = started
+        self._chunks = []
+        self._saved = False
+
+    def add(self, chunk):
+        if chunk:
+            self._chunks.append((time.perf_counter() - self._started, chunk))
+
+    def finish(self):
+        if not self._saved:
+            self._saved = True
+            self._cassette._save(*self._row, self._chunks, time.perf_counter() - self._started)
+
+
+class _Replay:
+    """回放的一次响应：按录制的时间（或立即）产出数据块"""
+
+    def __init__(self, status, reason, headers, chunks, ttfb, started, latency):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunks = chunks
+        self.ttfb = ttfb
+        self.started = started
+        self.original = latency == 'original'
+
+    def wait(self, offset):
+        """数据块（或响应头）还要等待多少秒才到达"""
+        if not self.original:
+            return 0
+        return max(self.started + offset - time.perf_counter(), 0)
+
+
+class _ReplayRaw:
+    """代替 urllib3 响应的 requests.Response.raw，按录制的时间产出数据块"""
+
+    def __init__(self, replay):
+        self._replay = replay
+        self._closed = False
+
+    def stream(self, amt=None, decode_content=True):
+        for offset, chunk in self._replay.chunks:
+            if self._closed:
+                return
+            delay = self._replay.wait(offset)
+            if delay:
+                time.sleep(delay)
+            yield chunk
+
+    def close(self):
+        self._closed = True
+
+
+class _RecordingRaw:
+    """包装 requests.Response.raw，把读取到的数据块写入录制"""
+
+    def __init__(self, raw, recording):
+        self._raw = raw
+        self._recording = recording
+
+    def stream(self, amt=None, decode_content=True):
+        try:
+            for chunk in self._raw.stream(amt, decode_content=decode_content):
+                self._recording.add(chunk)
+                yield chunk
+        finally:
+            self._recording.finish()
+
+    def close(self):
+        self._recording.finish()
+        self._raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+_async_stream_classes = None
+
+
+def _async_streams():
+    """回放和录制使用的 httpx.AsyncByteStream 子类（第一次用到时才导入 httpx）"""
+    global _async_stream_classes
+    if _async_stream_classes is None:
+        import asyncio
+        import httpx
+
+        class ReplayStream(httpx.AsyncByteStream):
+            def __init__(self, replay):
+                self._replay = replay
+
+            async def __aiter__(self):
+                for offset, chunk in self._replay.chunks:
+                    delay = self._replay.wait(offset)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    yield chunk
+
+        class RecordingStream(httpx.AsyncByteStream):
+            def __init__(self, stream, recording):
+                self._stream = stream
+                self._recording = recording
+
+            async def __aiter__(self):
+                try:
+                    async for chunk in self._stream:
+                        self._recording.add(chunk)
+                        yield chunk
+                finally:
+                    self._recording.finish()
+
+            async def aclose(self):
+                self._recording.finish()
+                await self._stream.aclose()
+
+        _async_stream_classes = ReplayStream, RecordingStream
+    return _async_stream_classes
+
+
+class Cassette:
+    """
+    一个录制文件
+
+    参数:
+        path: SQLite文件路径（不存在时创建）
+        mode: 'record'（总是发送请求并录制，覆盖同一请求之前的录制）、
+              'replay'（只回放，没有录制时抛出 CassetteMiss）、
+              'auto'（有录制时回放，否则发送请求并录制）
+        latency: 回放时的延迟，'original'（与录制时相同）或 'none'（立即返回）
+    """
+
+    def __init__(self, path, mode='replay', latency='original'):
+        if mode not in MODES:
+            raise ValueError(f"mode 必须是 {MODES} 之一: {mode!r}")
+        if latency not in LATENCIES:
+            raise ValueError(f"latency 必须是 {LATENCIES} 之一: {latency!r}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS interactions ('
+            'key TEXT NOT NULL, seq INTEGER NOT NULL, provider TEXT NOT NULL, path TEXT NOT NULL, '
+            'operation TEXT NOT NULL, request BLOB NOT NULL, status INTEGER NOT NULL, reason TEXT, '
+            'headers TEXT NOT NULL, body BLOB NOT NULL, chunks TEXT NOT NULL, ttfb REAL NOT NULL, '
+            'total REAL NOT NULL, recorded_at REAL NOT NULL, PRIMARY KEY (key, seq))'
+        )
+        self._db.commit()
+        # 请求键 -> 录制的次数；本次运行中已经回放的次数；本次运行中已经重新录制过的键
+        self._counts = dict(self._db.execute('SELECT key, COUNT(*) FROM interactions GROUP BY key'))
+        self._played = {}
+        self._rerecorded = set()
+
+    def __len__(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    # ---------- 回放 ----------
+
+    def _lookup(self, provider, url, data):
+        """
+        取出下一条录制
+
+        返回:
+            _Replay对象；没有录制时，auto模式返回None，replay模式抛出 CassetteMiss
+        """
+        started = time.perf_counter()
+        key = request_key(provider, url, data)
+        with self._lock:
+            count = 0 if self.mode == 'record' else self._counts.get(key, 0)
+            if count == 0:
+                if self.mode == 'replay':
+                    self.misses += 1
+                    raise CassetteMiss(f"录制文件 {self.path} 中没有这个请求（{provider} {urlsplit(url).path}）")
+                return None
+            seq = self._played.get(key, 0)
+            self._played[key] = seq + 1
+            row = self._db.execute(
+                'SELECT status, reason, headers, body, chunks, ttfb FROM interactions WHERE key = ? AND seq = ?',
+                (key, seq % count),
+            ).fetchone()
+            self.replayed += 1
+        status, reason, headers, body, chunks, ttfb = row
+        body = zlib.decompress(body)
+        pieces, position = [], 0
+        for offset, length in json.loads(chunks):
+            pieces.append((offset, body[position:position + length]))
+            position += length
+        return _Replay(status, reason, json.loads(headers), pieces, ttfb, started, self.latency)
+
+    def replay(self, provider, url, data):
+        """
+        回放一次同步请求
+
+        返回:
+            requests.Response对象（响应头按录制的首字节时间返回，响应体按录制的时间逐块读取）；
+            auto模式下没有录制时返回None
+        """
+        replay = self._lookup(provider, url, data)
+        if replay is None:
+            return None
+        import requests
+        delay = replay.wait(replay.ttfb)
+        if delay:
+            time.sleep(delay)
+        response = requests.Response()
+        response.status_code = replay.status
+        response.reason = replay.reason
+        response.headers = requests.structures.CaseInsensitiveDict(replay.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = url
+        response.raw = _ReplayRaw(replay)
+        return response
+
+    async def areplay(self, provider, url, data):
+        """replay 的异步版本，返回 httpx.Response对象"""
+        replay = self._lookup(provider, url, data)
+        if replay is None:
+            return None
+        import asyncio
+        import httpx
+        delay = replay.wait(replay.ttfb)
+        if delay:
+            await asyncio.sleep(delay)
+        ReplayStream, _ = _async_streams()
+        return httpx.Response(
+            replay.status,
+            headers=replay.headers,
+            stream=ReplayStream(replay),
+            request=httpx.Request('POST', url),
+            extensions={'reason_phrase': (replay.reason or '').encode('ascii', 'replace')},
+        )
+
+    # ---------- 录制 ----------
+
+    def record(self, provider, url, data, response, started):
+        """
+        录制一次同步请求的响应（读取响应体时逐块录制，读完或关闭响应时保存）
+
+        参数:
+            response: 以 stream=True 发送得到的 requests.Response对象
+            started: 发送请求时的 time.perf_counter()
+
+        返回:
+            同一个 response（raw 已被包装）
+        """
+        response.raw = _RecordingRaw(response.raw, self._recording(
+            provider, url, data, response.status_code, response.reason, response.headers, started
+        ))
+        return response
+
+    def arecord(self, provider, url, data, response, started):
+        """record 的异步版本，response 为以 stream=True 发送得到的 httpx.Response对象"""
+        _, RecordingStream = _async_streams()
+        response.stream = RecordingStream(response.stream, self._recording(
+            provider, url, data, response.status_code, response.reason_phrase, response.headers, started
+        ))
+        return response
+
+    def _recording(self, provider, url, data, status, reason, headers, started):
+        headers = {name: value for name, value in headers.items() if name.lower() not in _DROPPED_HEADERS}
+        return _Recording(self, request_key(provider, url, data), provider, url, data, status, reason,
+                          headers, started, time.perf_counter() - started)
+
+    def _save(self, key, provider, url, data, status, reason, headers, ttfb, chunks, total):
+        body = b''.join(chunk for _, chunk in chunks)
+        offsets = [(round(offset, 6), len(chunk)) for offset, chunk in chunks]
+        request = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            if self.mode == 'record' and key not in self._rerecorded:
+                # 重新录制：丢弃这个请求之前的录制
+                self._rerecorded.add(key)
+                self._db.execute('DELETE FROM interactions WHERE key = ?', (key,))
+                self._counts[key] = 0
+            seq = self._counts.get(key, 0)
+            self._db.execute(
+                'INSERT INTO interactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, seq, provider, urlsplit(url).path, _operation(data), zlib.compress(request), status,
+                 reason, json.dumps(dict(headers), ensure_ascii=False), zlib.compress(body),
+                 json.dumps(offsets), ttfb, total, time.time()),
+            )
+            self._db.commit()
+            self._counts[key] = seq + 1
+            self.recorded += 1
+
+    # ---------- 统计 ----------
+
+    def stats(self):
+        """
+        获取本次运行的统计
+
+        返回:
+            dict: {'mode', 'latency', 'interactions': 录制文件中的响应数量, 'recorded': 本次录制的数量,
+                   'replayed': 本次回放的数量, 'misses': 没有录制的请求数量}
+        """
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'latency': self.latency,
+                'interactions': sum(self._counts.values()),
+                'recorded': self.recorded,
+                'replayed': self.replayed,
+                'misses': self.misses,
+            }
+
+    def timings(self):
+        """
+        录制时的耗时分布，用于与回放或新版本代码的实测耗时对比
+
+        返回:
+            dict: {'提供商/调用类型': {'interactions': 响应数量,
+                                       'ttfb': {'p50', 'p99', 'max'}, 'total': {'p50', 'p99', 'max'}}}（秒）
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT provider, operation, ttfb, total FROM interactions').fetchall()
+        groups = {}
+        for provider, operation, ttfb, total in rows:
+            group = groups.setdefault(f'{provider}/{operation}', ([], []))
+            group[0].append(ttfb)
+            group[1].append(total)
+        result = {}
+        for name, (ttfbs, totals) in sorted(groups.items()):
+            result[name] = {'interactions': len(ttfbs)}
+            for phase, values in (('ttfb', sorted(ttfbs)), ('total', sorted(totals))):
+                result[name][phase] = {
+                    'p50': round(percentile(values, 50), 5),
+                    'p99': round(percentile(values, 99), 5),
+                    'max': round(values[-1], 5),
+                }
+        return result
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def cassette_from_env():
+    """
+    根据环境变量创建 Cassette，没有设置 CASSETTE_PATH 时返回None
+
+    环境变量:
+        CASSETTE_PATH: 录制文件路径
+        CASSETTE_MODE: record / replay / auto（默认: replay）
+        CASSETTE_LATENCY: original / none（默认: original）
+    """
+    path = getenv('CASSETTE_PATH', '').strip()
+    if not path:
+        return None
+    return Cassette(path, mode=getenv('CASSETTE_MODE', 'replay').strip().lower(),
+                    latency=getenv('CASSETTE_LATENCY', 'original').strip().lower())
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        print('用法: python cassette.py 录制文件路径')
+        sys.exit(2)
+    cassette = Cassette(sys.argv[1], mode='replay')
+    print(f'{len(cassette)} 条录制')
+    for name, timing in cassette.timings().items():
+        print(f"{name:<24} {timing['interactions']:>6} 条  "
+              f"首字节 p50 {timing['ttfb']['p50']}秒 p99 {timing['ttfb']['p99']}秒  "
+              f"总耗时 p50 {timing['total']['p50']}秒 p99 {timing['total']['p99']}秒")
@@ -0,0 +1,163 @@
+"""
+AI回复缓存
+对相同的请求（提供商、模型、消息、温度、最大token数都相同）直接返回之前的回复，
+减少重复调用API带来的延迟和费用。
+
+缓存分两层：
+- 内存层：LRU淘汰，限制条目数量和存活时间（TTL）
+- 磁盘层（可选）：SQLite文件，进程重启后依然有效
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def make_cache_key(provider, model, messages, temperature, max_tokens):
+    """
+    根据请求参数生成缓存键（规范化JSON的SHA-256哈希）
+
+    字典按键排序、去掉多余空白，因此内容相同的请求总是得到相同的键。
+
+    参数:
+        provider: API提供商名称
+        model: 模型名称
+        messages: 消息列表
+        temperature: 温度参数
+        max_tokens: 最大token数量
+
+    返回:
+        str: 十六进制哈希字符串
+    """
+    canonical = json.dumps(
+        [provider, model, messages, temperature, max_tokens],
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """
+    带LRU/TTL淘汰的两级回复缓存
+
+    缓存的值是字典: {'content': 回复内容, 'usage': token使用情况}
+
+    参数:
+        max_size: 内存层最多保存的条目数量，超过后淘汰最久未使用的条目
+        ttl: 条目存活时间（秒），为None时永不过期
+        db_path: SQLite文件路径，为None时只使用内存层
+    """
+
+    def __init__(self, max_size=1024, ttl=3600, db_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS completion_cache '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+            )
+            self._db.commit()
+
+    def _expires_at(self):
+        return None if self.ttl is None else time.time() + self.ttl
+
+    def get(self, key):
+        """
+        查询缓存
+
+        返回:
+            缓存的值；未命中或已过期时返回None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value, expires_at FROM completion_cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    value, expires_at = json.loads(row[0]), row[1]
+                    if expires_at is None or expires_at > now:
+                        # 提升到内存层
+                        self._remember(key, expires_at, value)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+                    self._db.execute('DELETE FROM completion_cache WHERE key = ?', (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """
+        写入缓存（同时写入内存层和磁盘层）
+        """
+        expires_at = self._expires_at()
+        with self._lock:
+            self._remember(key, expires_at, value)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO completion_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(value, ensure_ascii=False), expires_at),
+                )
+                self._db.commit()
+
+    def _remember(self, key, expires_at, value):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存（包括磁盘层）"""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM completion_cache')
+                self._db.commit()
+
+    def stats(self):
+        """
+        获取缓存统计信息
+
+        返回:
+            dict: {'hits': 命中次数, 'misses': 未命中次数, 'disk_hits': 磁盘层命中次数,
+                   'hit_rate': 命中率, 'size': 内存层条目数量}
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._entries),
+            }
+
+    def close(self):
+        """关闭磁盘层的数据库连接"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,189 @@
+"""
+对话上下文窗口管理
+多轮对话的历史会不断增长，每轮都把全部历史发送给模型会让费用和延迟线性增长，
+最终还会超出模型的上下文长度。ContextWindow 在每次请求前按token预算裁剪消息：
+- 固定保留开头的系统提示词（菜单等）
+- 滑动窗口：优先保留最近的对话
+- 摘要：被移出窗口的早期对话压缩为一条简短的备忘录
+"""
+import inspect
+
+from tool import APIError, chat_completion, achat_completion
+from token_counter import count_message_tokens
+
+SUMMARY_PROMPT = """请把下面的对话整理成一份简短的备忘录，供之后继续对话使用。
+保留顾客已经确定的订单内容（菜品、尺寸、配料、饮料）、取餐方式和地址，以及尚未解决的问题。
+不要编造内容，不超过{limit}字。"""
+
+
+def _build_summary_request(messages, previous_memo, limit):
+    transcript = '\n'.join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_memo:
+        transcript = f"之前的备忘录：{previous_memo}\n\n{transcript}"
+    return [
+        {'role': 'system', 'content': SUMMARY_PROMPT.format(limit=limit)},
+        {'role': 'user', 'content': transcript},
+    ]
+
+
+def summarize_messages(messages, previous_memo=None, limit=200):
+    """
+    调用模型把一段对话（以及之前的备忘录）压缩为备忘录
+
+    返回:
+        备忘录文本；调用失败时返回None
+    """
+    try:
+        result = chat_completion(
+            _build_summary_request(messages, previous_memo, limit), temperature=0, max_tokens=limit * 2
+        )
+    except APIError:
+        return None
+    return result.content.strip()
+
+
+async def asummarize_messages(messages, previous_memo=None, limit=200):
+    """
+    summarize_messages 的异步版本
+    """
+    try:
+        result = await achat_completion(
+            _build_summary_request(messages, previous_memo, limit), temperature=0, max_tokens=limit * 2
+        )
+    except APIError:
+        return None
+    return result.content.strip()
+
+
+class ContextWindow:
+    """
+    一段对话的上下文窗口，每次请求前调用 build()/abuild() 得到裁剪后的消息列表
+
+    对话应当只追加、不修改；备忘录会记住已经被摘要的消息，下次只摘要新移出窗口的部分。
+
+    参数:
+        max_prompt_tokens: 每次请求提示词部分的token预算
+        summarize: 摘要函数 summarize(messages, previous_memo) -> 备忘录文本或None，
+                   可以是普通函数或异步函数；为None时只使用滑动窗口，直接丢弃早期对话
+        memo_max_tokens: 为备忘录预留的token数量
+        token_counter: 计算单条消息token数量的函数，默认使用 token_counter.count_message_tokens
+    """
+
+    def __init__(self, max_prompt_tokens=3000, summarize=None, memo_max_tokens=300,
+                 token_counter=count_message_tokens):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.summarize = summarize
+        self.memo_max_tokens = memo_max_tokens
+        self.token_counter = token_counter
+
+        self.memo = None
+        self._summarized_upto = 0  # 非系统消息中已被备忘录覆盖的数量
+        self._counts = {}          # (role, content) -> token数量
+        self.last_report = None
+        self.total_saved_tokens = 0
+
+    def _count(self, message):
+        key = (message.get('role'), message.get('content'))
+        count = self._counts.get(key)
+        if count is None:
+            count = self._counts[key] = self.token_counter(message)
+        return count
+
+    def _plan(self, messages):
+        """计算需要保留的消息范围，返回 (固定的系统消息, 其余消息, 窗口起点)"""
+        n_pinned = 0
+        while n_pinned < len(messages) and messages[n_pinned].get('role') == 'system':
+            n_pinned += 1
+        pinned, rest = messages[:n_pinned], messages[n_pinned:]
+        pinned_tokens = sum(self._count(m) for m in pinned)
+        rest_counts = [self._count(m) for m in rest]
+
+        if pinned_tokens + sum(rest_counts) <= self.max_prompt_tokens and self.memo is None:
+            return pinned, rest, 0
+
+        budget = self.max_prompt_tokens - pinned_tokens
+        if self.summarize is not None:
+            budget -= self.memo_max_tokens
+
+        # 从最近的消息开始向前保留，至少保留最后一条
+        start = len(rest)
+        used = 0
+        while start > 0 and (start == len(rest) or used + rest_counts[start - 1] <= budget):
+            used += rest_counts[start - 1]
+            start -= 1
+
+        # 已被备忘录覆盖的消息不再重复发送
+        start = max(start, self._summarized_upto)
+        # 窗口尽量从用户消息开始
+        while start < len(rest) - 1 and rest[start].get('role') != 'user':
+            start += 1
+        return pinned, rest, start
+
+    def _assemble(self, messages, pinned, rest, start):
+        window = list(pinned)
+        if self.memo:
+            window.append({'role': 'system', 'content': f"之前对话的备忘录：{self.memo}"})
+        window.extend(rest[start:])
+
+        original = sum(self._count(m) for m in messages)
+        sent = sum(self._count(m) for m in window)
+        self.last_report = {
+            'original_tokens': original,
+            'sent_tokens': sent,
+            'saved_tokens': max(original - sent, 0),
+            'dropped_messages': start,
+            'memo': self.memo is not None,
+        }
+        self.total_saved_tokens += self.last_report['saved_tokens']
+        return window
+
+    def build(self, messages):
+        """
+        按token预算裁剪消息列表
+
+        参数:
+            messages: 完整的消息列表（系统提示词 + 全部对话 + 本轮用户消息）
+
+        返回:
+            裁剪后的消息列表；本次节省的token数量等信息见 last_report
+        """
+        pinned, rest, start = self._plan(messages)
+        if self.summarize is not None and start > self._summarized_upto:
+            memo = self.summarize(rest[self._summarized_upto:start], self.memo)
+            self._update_memo(memo, start)
+        return self._assemble(messages, pinned, rest, start)
+
+    async def abuild(self, messages):
+        """
+        build 的异步版本，摘要函数可以是异步函数
+        """
+        pinned, rest, start = self._plan(messages)
+        if self.summarize is not None and start > self._summarized_upto:
+            memo = self.summarize(rest[self._summarized_upto:start], self.memo)
+            if inspect.isawaitable(memo):
+                memo = await memo
+            self._update_memo(memo, start)
+        return self._assemble(messages, pinned, rest, start)
+
+    def export_state(self):
+        """
+        导出备忘录状态，便于保存到会话存储中
+
+        返回:
+            dict: {'memo': 备忘录文本, 'summarized_upto': 已被备忘录覆盖的消息数量}
+        """
+        return {'memo': self.memo, 'summarized_upto': self._summarized_upto}
+
+    def restore_state(self, state):
+        """从 export_state() 导出的字典恢复备忘录状态"""
+        self.memo = state.get('memo')
+        self._summarized_upto = state.get('summarized_upto', 0)
+
+    def _update_memo(self, memo, start):
+        # 摘要失败时保留旧的备忘录，下次请求再尝试
+        if memo:
+            # 模型没有遵守字数限制时截断，保证备忘录不超出预留的预算
+            while len(memo) > 1 and self.token_counter({'role': 'system', 'content': memo}) > self.memo_max_tokens:
+                memo = memo[:int(len(memo) * 0.9)]
+            self.memo = memo
+            self._summarized_upto = start
@@ -0,0 +1,34 @@
+"""
+环境变量读取
+.env 文件在第一次读取配置时才查找和加载（只加载一次），导入模块时不做任何文件操作，
+只使用其中一部分功能的脚本（如 practice.py）不需要为此付出启动时间。
+
+各模块读取配置时使用 getenv() 代替 os.getenv()，保证 .env 中的配置已经加载。
+"""
+import os
+import threading
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_env():
+    """
+    加载 .env 文件中的环境变量，只在第一次调用时加载
+
+    已经存在的环境变量不会被 .env 覆盖；之后修改 .env 需要重启进程。
+    """
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if not _loaded:
+            from dotenv import load_dotenv, find_dotenv
+            load_dotenv(find_dotenv())
+            _loaded = True
+
+
+def getenv(name, default=None):
+    """读取环境变量（第一次调用时先加载 .env），用法与 os.getenv 相同"""
+    load_env()
+    return os.getenv(name, default)
@@ -0,0 +1,206 @@
+"""
+工具调用（function calling）与JSON模式
+- function_tool(): 构造工具定义（JSON Schema）
+- Toolbox: 注册工具及其处理函数，执行模型请求的工具调用
+- run_tools() / arun_tools(): 调用模型 -> 执行工具 -> 把结果返回给模型，直到模型给出最终回复
+- json_completion() / ajson_completion(): JSON模式，直接返回解析后的dict
+
+请求仍然经过 tool.py 的提供商配置、限流、重试和提供商切换。
+
+示例:
+    toolbox = Toolbox()
+
+    @toolbox.tool('查询菜品价格', {'type': 'object', 'properties': {'item': {'type': 'string'}}, 'required': ['item']})
+    def get_price(item):
+        return {'item': item, 'price': '10.95'}
+
+    result, messages = run_tools([{'role': 'user', 'content': '芝士披萨多少钱？'}], toolbox)
+    print(result.content)
+"""
+import json
+import asyncio
+import inspect
+
+from tool import chat_completion, achat_completion, APIError
+
+
+def function_tool(name, description, parameters=None):
+    """
+    构造一个工具定义
+
+    参数:
+        name: 工具名称（字母、数字、下划线）
+        description: 说明，模型根据它决定何时调用
+        parameters: 参数的 JSON Schema，默认为没有参数
+
+    返回:
+        dict: 可以放入 chat_completion(tools=[...]) 的工具定义
+    """
+    return {
+        'type': 'function',
+        'function': {
+            'name': name,
+            'description': description,
+            'parameters': parameters or {'type': 'object', 'properties': {}},
+        },
+    }
+
+
+def force_tool(name):
+    """tool_choice 参数：强制模型调用指定的工具"""
+    return {'type': 'function', 'function': {'name': name}}
+
+
+def _tool_message(call, result):
+    if not isinstance(result, str):
+        result = json.dumps(result, ensure_ascii=False)
+    return {'role': 'tool', 'tool_call_id': call.id, 'content': result}
+
+
+class Toolbox:
+    """
+    一组工具的定义和处理函数
+
+    处理函数以关键字参数接收模型生成的参数，返回值（dict、list或字符串）会作为工具结果
+    发回给模型；可以是普通函数或异步函数（异步函数只能在 arun_tools 中使用）。
+    """
+
+    def __init__(self):
+        self._tools = {}
+
+    def register(self, name, description, parameters=None, handler=None):
+        """注册一个工具；handler 为None时只提供定义，调用结果由调用方自行处理"""
+        self._tools[name] = (function_tool(name, description, parameters), handler)
+
+    def tool(self, description, parameters=None, name=None):
+        """装饰器形式的 register，工具名称默认为函数名"""
+        def decorator(func):
+            self.register(name or func.__name__, description, parameters, func)
+            return func
+        return decorator
+
+    @property
+    def definitions(self):
+        """所有工具的定义，用作 chat_completion 的 tools 参数"""
+        return [definition for definition, _ in self._tools.values()]
+
+    def __contains__(self, name):
+        return name in self._tools
+
+    def _resolve(self, call):
+        """返回 (处理函数, 错误结果)，两者只有一个不为None"""
+        entry = self._tools.get(call.name)
+        if entry is None or entry[1] is None:
+            return None, {'error': f'未知的工具: {call.name}'}
+        if call.arguments is None:
+            return None, {'error': f'参数不是合法的JSON: {call.raw_arguments}'}
+        return entry[1], None
+
+    def dispatch(self, call):
+        """
+        执行一次工具调用
+
+        返回:
+            dict: 工具结果消息 {'role': 'tool', 'tool_call_id', 'content'}；
+                  工具不存在、参数无效或处理函数抛出异常时，content 为错误说明，模型可以据此修正
+        """
+        handler, error = self._resolve(call)
+        if error is not None:
+            return _tool_message(call, error)
+        if inspect.iscoroutinefunction(handler):
+            raise TypeError(f'工具 {call.name} 是异步函数，请使用 arun_tools')
+        try:
+            result = handler(**call.arguments)
+        except Exception as e:
+            result = {'error': f'{type(e).__name__}: {e}'}
+        return _tool_message(call, result)
+
+    async def adispatch(self, call):
+        """dispatch 的异步版本，处理函数可以是异步函数"""
+        handler, error = self._resolve(call)
+        if error is not None:
+            return _tool_message(call, error)
+        try:
+            result = handler(**call.arguments)
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception as e:
+            result = {'error': f'{type(e).__name__}: {e}'}
+        return _tool_message(call, result)
+
+
+def run_tools(messages, toolbox, model=None, temperature=0, max_tokens=500, tool_choice='auto', max_rounds=5):
+    """
+    调用模型并执行它请求的工具，把结果返回给模型，直到模型给出最终回复
+
+    参数:
+        messages: 消息列表（不会被修改）
+        toolbox: Toolbox
+        tool_choice: 第一轮的 tool_choice，之后各轮为 'auto'
+        max_rounds: 最多调用模型的次数，达到后返回最后一次的结果（可能仍包含 tool_calls）
+
+    返回:
+        (CompletionResult, 完整的消息列表): 消息列表包括中间的工具调用和工具结果
+
+    异常:
+        APIError: 请求失败
+    """
+    messages = list(messages)
+    for round_index in range(max_rounds):
+        result = chat_completion(
+            messages, model=model, temperature=temperature, max_tokens=max_tokens,
+            tools=toolbox.definitions, tool_choice=tool_choice if round_index == 0 else 'auto',
+        )
+        if not result.tool_calls:
+            break
+        messages.append(result.assistant_message())
+        messages.extend(toolbox.dispatch(call) for call in result.tool_calls)
+    return result, messages
+
+
+async def arun_tools(messages, toolbox, model=None, temperature=0, max_tokens=500, tool_choice='auto', max_rounds=5):
+    """
+    run_tools 的异步版本，同一轮的多个工具调用并发执行
+    """
+    messages = list(messages)
+    for round_index in range(max_rounds):
+        result = await achat_completion(
+            messages, model=model, temperature=temperature, max_tokens=max_tokens,
+            tools=toolbox.definitions, tool_choice=tool_choice if round_index == 0 else 'auto',
+        )
+        if not result.tool_calls:
+            break
+        messages.append(result.assistant_message())
+        messages.extend(await asyncio.gather(*(toolbox.adispatch(call) for call in result.tool_calls)))
+    return result, messages
+
+
+def _parse_json_content(result):
+    try:
+        value = json.loads(result.content)
+    except ValueError as e:
+        raise APIError(f"调用{result.provider} API时发生错误: 回复不是合法的JSON {str(e)}", result.provider) from e
+    if not isinstance(value, dict):
+        raise APIError(f"调用{result.provider} API时发生错误: 回复不是JSON对象", result.provider)
+    return value
+
+
+def json_completion(messages, model=None, temperature=0, max_tokens=500):
+    """
+    JSON模式：要求模型输出一个JSON对象，并返回解析后的dict
+
+    提示词中需要说明要输出JSON以及各字段的含义（提供商的要求）。
+
+    异常:
+        APIError: 请求失败，或回复不是合法的JSON对象
+    """
+    result = chat_completion(messages, model=model, temperature=temperature, max_tokens=max_tokens,
+                             response_format={'type': 'json_object'})
+    return _parse_json_content(result)
+
+
+async def ajson_completion(messages, model=None, temperature=0, max_tokens=500):
+    """json_completion 的异步版本"""
+    result = await achat_completion(messages, model=model, temperature=temperature, max_tokens=max_tokens,
+                                    response_format={'type': 'json_object'})
+    return _parse_json_content(result)
@@ -0,0 +1,118 @@
+"""
+对冲请求（hedged requests）的策略
+偶尔很慢的请求决定了每轮对话的p99延迟。启用对冲后，一次对话请求在自适应的等待时间内
+还没有收到响应时，再向另一个配置了API密钥的提供商发送一份相同的请求，使用先返回的结果，
+取消较慢的一个。
+
+- 等待时间：每个提供商、每种调用（completion / stream）最近若干次请求耗时的p95，
+  样本不足时使用 initial_delay。样本与对冲时等待的是同一段时间：非流式请求包括读取完整的
+  响应体，流式请求到收到响应头为止，生成较长回复的请求不会因此被误判为慢请求
+- 预算：每个请求积累 budget 个令牌（最多 burst 个），每次对冲消耗一个，
+  额外请求量长期不超过请求总数的 budget 比例，提供商整体变慢时也不会让请求量翻倍
+- 统计：对冲次数、对冲请求先返回的次数、因预算不足而没有对冲的次数
+
+实际发送请求的逻辑在 tool.py 中（tool.enable_hedging()）。
+"""
+import threading
+from collections import deque
+
+from metrics import percentile
+
+
+class HedgePolicy:
+    """
+    对冲请求的等待时间、预算和统计
+
+    参数:
+        percentile: 用请求耗时的哪个分位数作为等待时间
+        window: 每个提供商保留的最近样本数量
+        min_samples: 样本数量达到多少后才使用分位数
+        initial_delay: 样本不足时的等待时间（秒）
+        min_delay: 等待时间的下限（秒），避免响应很快时几乎每个请求都被对冲
+        budget: 对冲请求占请求总数的最大比例
+        burst: 预算最多积累的对冲次数
+    """
+
+    def __init__(self, percentile=95, window=256, min_samples=20, initial_delay=2.0, min_delay=0.05,
+                 budget=0.05, burst=5):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.budget = budget
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._samples = {}   # (提供商, 调用类型) -> deque
+        self._tokens = float(burst)
+
+        self.requests = 0
+        self.hedged = 0
+        self.wins = 0
+        self.budget_exhausted = 0
+
+    def observe(self, provider, operation, seconds):
+        """记录一次请求耗时（秒）"""
+        with self._lock:
+            samples = self._samples.get((provider, operation))
+            if samples is None:
+                samples = self._samples[(provider, operation)] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def delay(self, provider, operation):
+        """当前的等待时间（秒）：超过这个时间还没有响应就发送对冲请求"""
+        with self._lock:
+            samples = sorted(self._samples.get((provider, operation), ()))
+        if len(samples) < self.min_samples:
+            return max(self.initial_delay, self.min_delay)
+        return max(percentile(samples, self.percentile), self.min_delay)
+
+    def record_request(self):
+        """一个可以对冲的请求开始发送，积累预算"""
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(self._tokens + self.budget, float(self.burst))
+
+    def try_hedge(self):
+        """
+        是否可以发送对冲请求（消耗预算）
+
+        返回:
+            bool: 预算不足时返回False
+        """
+        with self._lock:
+            if self._tokens < 1:
+                self.budget_exhausted += 1
+                return False
+            self._tokens -= 1
+            self.hedged += 1
+            return True
+
+    def record_result(self, hedge_won):
+        """记录已发送对冲的请求中，是否是对冲请求先返回"""
+        if hedge_won:
+            with self._lock:
+                self.wins += 1
+
+    def stats(self):
+        """
+        获取统计信息
+
+        返回:
+            dict: {'requests': 可以对冲的请求数, 'hedged': 发送对冲的次数, 'wins': 对冲请求先返回的次数,
+                   'budget_exhausted': 因预算不足没有对冲的次数, 'hedge_rate': 对冲比例,
+                   'win_rate': 对冲请求先返回的比例, 'delays': {'提供商/调用类型': 当前等待时间}}
+        """
+        with self._lock:
+            keys = list(self._samples)
+            stats = {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'wins': self.wins,
+                'budget_exhausted': self.budget_exhausted,
+                'hedge_rate': self.hedged / self.requests if self.requests else 0.0,
+                'win_rate': self.wins / self.hedged if self.hedged else 0.0,
+            }
+        stats['delays'] = {f'{provider}/{operation}': round(self.delay(provider, operation), 4)
+                           for provider, operation in keys}
+        return stats
@@ -0,0 +1,297 @@
+"""
+披萨机器人的负载测试
+模拟大量顾客同时下单，测量一个服务进程能支撑多少并发会话：
+- 每个虚拟顾客按脚本进行多轮对话（问候、点餐、配料、饮料、外送地址），轮与轮之间有思考时间
+- 直接驱动 pizza_bot.collect_messages（与点击发送按钮时执行的代码相同，包括审核、上下文裁剪、
+  会话存储和界面对象的更新），大模型由本地模拟服务 mock_server 代替
+- 按阶段逐步增加并发顾客数，统计每轮对话的延迟分位数、事件循环延迟和每个会话的内存增长，
+  找出延迟开始明显变差的饱和点
+
+只测量服务端的处理开销，不包括浏览器与服务之间 websocket 的传输和渲染。
+
+使用方法:
+    python load_test.py --levels 10,50,100,200 --latency 0.3 --token-delay 0.02
+    python load_test.py --levels 50 --think-time 0,0 --output load.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+
+import panel as pn
+
+import pizza_bot
+from transcript import Transcript
+from metrics import percentile
+from benchmark import start_mock_server, describe_environment
+from session_store import get_session_store
+import tool
+
+# 顾客的对话脚本，每个脚本是一次完整的下单过程
+SCRIPTS = (
+    ('你好', '我想要一个大号意式辣香肠披萨', '加蘑菇和奶酪', '再来一个中号可乐', '外送', '地址是人民路88号3单元502', '没有了，谢谢'),
+    ('嗨，今天有什么推荐', '来一个中号芝士披萨', '加香肠', '再要一份大薯条', '自取', '就这些'),
+    ('你好，我要点餐', '两个小号茄子披萨', '一个加辣椒，一个加加拿大熏肉', '一份希腊沙拉', '一瓶水', '外送到建设路12号', '多少钱？', '好的，确认'),
+    ('hello', '一个大号芝士披萨，加AI酱', '还要中号雪碧', '外送', '幸福小区5栋1201', '谢谢'),
+)
+
+PHASES = ('ack', 'first_token', 'total')
+
+
+def _rss_bytes():
+    """当前进程占用的物理内存（字节）；无法获取时返回None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 上单位是KB，macOS 上是字节；这里返回的是峰值而不是当前值
+        return usage if sys.platform == 'darwin' else usage * 1024
+    except ImportError:
+        return None
+
+
+class VirtualCustomer:
+    """
+    一个虚拟顾客：拥有自己的会话ID、输入框和对话显示内容，和浏览器中的一个会话相同
+
+    参数:
+        script: 依次发送的消息
+        think_time: (最短, 最长) 两轮之间的思考秒数
+        rng: 随机数生成器
+    """
+
+    def __init__(self, script, think_time, rng):
+        self.session_id = f"load-{uuid.uuid4().hex}"
+        self.script = script
+        self.think_time = think_time
+        self.rng = rng
+        self.inp = pn.widgets.TextInput(value='')
+        self.transcript = Transcript()
+        self.timings = {phase: [] for phase in PHASES}
+        self.turns = 0
+        self.errors = 0
+
+    async def run(self):
+        store = get_session_store()
+        for index, text in enumerate(self.script):
+            if index:
+                await asyncio.sleep(self.rng.uniform(*self.think_time))
+            before = len(store.load(self.session_id)['messages'])
+            self.inp.value = text
+            started = time.perf_counter()
+            views = 0
+            try:
+                async for _ in pizza_bot.collect_messages(None, self.inp, self.transcript, self.session_id):
+                    views += 1
+                    now = time.perf_counter() - started
+                    if views == 1:
+                        self.timings['ack'].append(now)
+                    elif views == 2:
+                        self.timings['first_token'].append(now)
+            except Exception:
+                self.errors += 1
+                continue
+            self.turns += 1
+            # 回复失败（显示系统提示）或被审核拦截时，本轮不会写入对话历史
+            if len(store.load(self.session_id)['messages']) == before + 2:
+                self.timings['total'].append(time.perf_counter() - started)
+            else:
+                self.errors += 1
+
+
+async def _monitor_loop_lag(samples, interval=0.01):
+    """定期测量事件循环的调度延迟：处理能力饱和时，所有会话的界面更新都会被推迟"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(time.perf_counter() - started - interval, 0.0))
+
+
+def _distribution(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'p50': round(percentile(values, 50), 4),
+        'p95': round(percentile(values, 95), 4),
+        'p99': round(percentile(values, 99), 4),
+        'max': round(values[-1], 4),
+    }
+
+
+async def run_stage(customers, think_time=(0.5, 2.0), ramp_up=1.0, seed=0):
+    """
+    运行一个阶段：customers 个虚拟顾客在 ramp_up 秒内陆续进入，各自完成一次下单
+
+    返回:
+        dict: 该阶段的统计结果
+    """
+    rng = random.Random(seed)
+    store = get_session_store()
+    rss_before = _rss_bytes()
+    store_before = store.stats()['bytes']
+
+    group = [VirtualCustomer(rng.choice(SCRIPTS), think_time, random.Random(rng.random()))
+             for _ in range(customers)]
+
+    async def start(customer, delay):
+        await asyncio.sleep(delay)
+        await customer.run()
+
+    lag = []
+    monitor = asyncio.ensure_future(_monitor_loop_lag(lag))
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(start(c, rng.uniform(0, ramp_up)) for c in group))
+    finally:
+        monitor.cancel()
+    elapsed = time.perf_counter() - started
+
+    # 所有会话仍然存活（界面对象和会话状态都还在）时测量内存
+    rss_after = _rss_bytes()
+    store_after = store.stats()['bytes']
+    turns = sum(c.turns for c in group)
+    result = {
+        'customers': customers,
+        'turns': turns,
+        'errors': sum(c.errors for c in group),
+        'elapsed': round(elapsed, 3),
+        'turns_per_second': round(turns / elapsed, 2) if elapsed > 0 else None,
+        'latency': {phase: _distribution([t for c in group for t in c.timings[phase]]) for phase in PHASES},
+        'loop_lag': _distribution(lag),
+        'memory_per_session': {
+            'rss_bytes': round((rss_after - rss_before) / customers) if rss_before and rss_after else None,
+            'store_bytes': round((store_after - store_before) / customers),
+        },
+    }
+    for customer in group:
+        store.delete(customer.session_id)
+    return result
+
+
+def _saturated(result, baseline, slo, max_degradation):
+    """
+    判断一个阶段是否已经饱和：首段回复的p95延迟超过SLO，或者比第一个阶段差 max_degradation 倍以上
+
+    返回:
+        str 或 None: 饱和的原因
+    """
+    p95 = result['latency']['first_token'].get('p95')
+    if p95 is None:
+        return '没有成功的对话'
+    if slo and p95 > slo:
+        return f'首段回复p95延迟 {p95}秒 超过SLO {slo}秒'
+    base = baseline['latency']['first_token'].get('p95') if baseline else None
+    if base and p95 > base * max_degradation:
+        return f'首段回复p95延迟 {p95}秒 是第一个阶段的 {p95 / base:.1f} 倍'
+    if result['errors'] > result['turns'] * 0.05:
+        return f"错误率 {result['errors'] / max(result['turns'], 1):.0%}"
+    return None
+
+
+async def arun_load_test(levels=(10, 25, 50, 100), think_time=(0.5, 2.0), ramp_up=1.0, slo=2.0,
+                         max_degradation=2.0, stop_on_saturation=True, seed=0):
+    """
+    按 levels 逐步增加并发顾客数运行负载测试
+
+    返回:
+        dict: {'stages': 各阶段结果, 'saturation': {'customers', 'reason'} 或 None,
+               'max_healthy_customers': 未饱和的最大并发顾客数}
+    """
+    stages, saturation, healthy = [], None, None
+    try:
+        # 预热：首次请求会建立连接、加载依赖，不计入第一个阶段的延迟和内存
+        await run_stage(1, (0.0, 0.0), 0.0, seed - 1)
+        for index, customers in enumerate(levels):
+            result = await run_stage(customers, think_time, ramp_up, seed + index)
+            reason = _saturated(result, stages[0] if stages else None, slo, max_degradation)
+            result['saturated'] = reason
+            stages.append(result)
+            _print_stage(result)
+            if reason:
+                saturation = saturation or {'customers': customers, 'reason': reason}
+                if stop_on_saturation:
+                    break
+            elif saturation is None:
+                healthy = customers
+    finally:
+        await tool.aclose_sessions()
+    return {'stages': stages, 'saturation': saturation, 'max_healthy_customers': healthy}
+
+
+def _print_stage(result):
+    latency = result['latency']
+    memory = result['memory_per_session']
+    rss = f"{memory['rss_bytes'] / 1024:.1f}KB" if memory['rss_bytes'] is not None else '未知'
+    print(f"{result['customers']:>5}个顾客  {result['turns_per_second']}轮/秒  "
+          f"首段回复 p50 {latency['first_token'].get('p50')}秒 p95 {latency['first_token'].get('p95')}秒  "
+          f"整轮 p95 {latency['total'].get('p95')}秒  事件循环延迟 p99 {result['loop_lag'].get('p99')}秒  "
+          f"内存 {rss}/会话  错误 {result['errors']}/{result['turns']}"
+          + (f"  ⚠ {result['saturated']}" if result['saturated'] else ''), flush=True)
+
+
+def _parse_range(text):
+    low, _, high = text.partition(',')
+    return float(low), float(high or low)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='模拟大量顾客同时使用披萨机器人，寻找饱和点')
+    parser.add_argument('--levels', default='10,25,50,100', help='逗号分隔的各阶段并发顾客数（默认: 10,25,50,100）')
+    parser.add_argument('--think-time', default='0.5,2.0', help='两轮之间思考时间的范围（秒），如 0.5,2.0')
+    parser.add_argument('--ramp-up', type=float, default=1.0, help='每个阶段的顾客在多少秒内陆续进入')
+    parser.add_argument('--slo', type=float, default=2.0, help='首段回复p95延迟的目标（秒），超过视为饱和')
+    parser.add_argument('--max-degradation', type=float, default=2.0, help='p95延迟是第一个阶段的多少倍视为饱和')
+    parser.add_argument('--keep-going', action='store_true', help='饱和后继续运行剩余的阶段')
+    parser.add_argument('--no-moderation', action='store_true', help='关闭内容审核')
+    parser.add_argument('--live', action='store_true', help='请求真实配置的提供商（会产生费用）')
+    parser.add_argument('--latency', type=float, default=0.3, help='模拟服务返回响应头之前的延迟秒数')
+    parser.add_argument('--jitter', type=float, default=0.1, help='模拟服务随机增加的最大延迟秒数')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='模拟服务流式响应每段之间的间隔秒数')
+    parser.add_argument('--reply-tokens', type=int, default=40, help='模拟服务每次回复的段数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务注入错误的比例')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--output', default=None, help='结果保存路径（JSON）')
+    args = parser.parse_args(argv)
+
+    levels = [int(n) for n in args.levels.split(',') if n.strip()]
+    server = None
+    if not args.live:
+        server = start_mock_server(latency=args.latency, jitter=args.jitter, token_delay=args.token_delay,
+                                   reply_tokens=args.reply_tokens, error_rate=args.error_rate, seed=args.seed)
+    if args.no_moderation:
+        os.environ['OPENAI_API_KEY'] = ''
+    # 每个顾客的对话都不同，但问候语等会重复，关闭回复缓存以测量真实的请求开销
+    tool.disable_completion_cache()
+
+    try:
+        report = asyncio.run(arun_load_test(
+            levels, think_time=_parse_range(args.think_time), ramp_up=args.ramp_up, slo=args.slo,
+            max_degradation=args.max_degradation, stop_on_saturation=not args.keep_going, seed=args.seed,
+        ))
+    finally:
+        if server is not None:
+            server.stop()
+
+    if report['saturation']:
+        print(f"\n饱和点: {report['saturation']['customers']}个并发顾客（{report['saturation']['reason']}）")
+    print(f"未饱和的最大并发顾客数: {report['max_healthy_customers']}")
+
+    if args.output:
+        report.update(environment=describe_environment(), parameters=vars(args))
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,579 @@
+"""
+菜单与订单引擎
+把披萨机器人系统提示词中的菜单解析为结构化数据（只解析一次），并在本地跟踪每个会话的订单：
+- 菜品、尺寸、配料的查找是一次正则扫描（按最长匹配），不需要调用大模型
+- 订单金额用 Decimal 精确计算，确认订单时直接使用，不再依赖大模型心算
+- 订单状态可以导出为字典保存到会话存储中，每轮对话根据用户消息增量更新
+
+大模型仍然负责自然语言对话；本地无法确定的信息（如没有说明尺寸）会列为待确认项，
+由大模型向顾客追问。
+"""
+import re
+from decimal import Decimal
+
+# 菜单原文，同时是披萨机器人系统提示词的一部分（修改后两边保持一致）
+MENU_TEXT = """菜品：
+意式辣香肠披萨（大、中、小） 12.95、10.00、7.00
+芝士披萨（大、中、小） 10.95、9.25、6.50
+茄子披萨（大、中、小） 11.95、9.75、6.75
+薯条（大、小） 4.50、3.50
+希腊沙拉 7.25
+
+配料：
+奶酪 2.00
+蘑菇 1.50
+香肠 3.00
+加拿大熏肉 3.50
+AI酱 1.50
+辣椒 1.00
+
+饮料：
+可乐（大、中、小） 3.00、2.00、1.00
+雪碧（大、中、小） 3.00、2.00、1.00
+瓶装水 5.00
+"""
+
+# 菜单分类的标题
+DISH, TOPPING, DRINK = '菜品', '配料', '饮料'
+
+# 顾客常用的别名 -> 菜单中的名称
+ALIASES = {
+    '辣香肠披萨': '意式辣香肠披萨',
+    '意式辣香肠': '意式辣香肠披萨',
+    '芝士': '奶酪',
+    '培根': '加拿大熏肉',
+    '熏肉': '加拿大熏肉',
+    '沙拉': '希腊沙拉',
+    '可口可乐': '可乐',
+    '矿泉水': '瓶装水',
+    '纯净水': '瓶装水',
+}
+# 别名至少两个字：单个字（如“水”）会匹配到地址等无关内容中（“送到水库路”）
+
+_NUMERALS = {'一': 1, '两': 2, '二': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_QUANTITY = re.compile(
+    r'(\d+|[一两二三四五六七八九十]+)\s*(?:个|份|杯|瓶|听|块|盒)?\s*(?:[大中小](?:号|杯|份|瓶)?)?\s*的?\s*$'
+)
+_SIZE_BEFORE = re.compile(r'([大中小])(?:号|杯|份|瓶)?\s*的?\s*$')
+_SIZE_AFTER = re.compile(r'^\s*[（(]?\s*([大中小])(?:号|杯|份|瓶|的)?')
+_REMOVE = re.compile(r'(不要|取消|去掉|删掉|别要|拿掉)')
+_CLAUSE_END = re.compile(r'[，,。；;！!？?\n]')
+# 询问（价格、有没有、是什么）：这样的分句不修改订单，由大模型回答
+_QUESTION = re.compile(r'(多少钱|多少|价格|价钱|什么|哪些|哪种|几种|有没有|怎么样|贵不贵|好不好吃)')
+# 以“吗”或问号结尾的分句，只有带点餐动词时才是点餐（“能来一杯可乐吗”）
+_ORDER_VERB = re.compile(r'(要|来|点|加(?!拿大)|给我|帮我|换成|改成|取消|去掉)')
+_DELIVERY = re.compile(r'(外送|外卖|送到|配送|送餐)')
+_PICKUP = re.compile(r'(自取|到店取|自己取|自己来取|堂食)')
+_ADDRESS = re.compile(r'(?:地址是|地址[:：]?|送到|外送到)\s*([^，,。！!？?\n]+)')
+_BARE_ADDRESS = re.compile(r'\S*(?:路|街|道|巷|小区|大厦|花园|公寓|村)\S*?\d[^\s，,。；;！!？?]*')
+
+
+class MenuItem:
+    """
+    菜单中的一项
+
+    参数:
+        name: 名称
+        category: 分类（菜品、配料、饮料）
+        prices: {尺寸: 价格}，没有尺寸的项目为 {None: 价格}
+    """
+
+    __slots__ = ('name', 'category', 'prices')
+
+    def __init__(self, name, category, prices):
+        self.name = name
+        self.category = category
+        self.prices = prices
+
+    @property
+    def sizes(self):
+        """可选的尺寸，没有尺寸时为空元组"""
+        return tuple(size for size in self.prices if size is not None)
+
+    @property
+    def is_pizza(self):
+        return self.category == DISH and self.name.endswith('披萨')
+
+    def price(self, size=None):
+        """
+        指定尺寸的价格；只有一种尺寸时可以省略 size。尺寸不存在或未指定时返回None
+        """
+        if size in self.prices:
+            return self.prices[size]
+        if len(self.prices) == 1:
+            return next(iter(self.prices.values()))
+        return None
+
+    def __repr__(self):
+        return f"MenuItem({self.name!r}, {self.category!r}, {self.prices!r})"
+
+
+class Menu:
+    """
+    结构化的菜单，支持按名称（包括别名）查找和在文本中扫描菜单项
+
+    参数:
+        items: MenuItem 列表
+        aliases: {别名: 菜单中的名称}
+    """
+
+    def __init__(self, items, aliases=None):
+        self.items = list(items)
+        self._by_name = {item.name.lower(): item for item in self.items}
+        for alias, name in (aliases or {}).items():
+            if name.lower() in self._by_name:
+                self._by_name.setdefault(alias.lower(), self._by_name[name.lower()])
+        # 最长的名称排在前面，扫描时优先匹配（如“加拿大熏肉”优先于“熏肉”）
+        names = sorted(self._by_name, key=len, reverse=True)
+        self._pattern = re.compile('|'.join(re.escape(name) for name in names), re.IGNORECASE)
+
+    def pizza_for(self, name):
+        """
+        按省略了“披萨”的名称查找披萨（“芝士” -> 芝士披萨），也接受唯一的简称
+        （“香肠” -> 意式辣香肠披萨），找不到时返回None
+        """
+        item = self._by_name.get(f'{name.lower()}披萨')
+        if item is not None:
+            return item if item.is_pizza else None
+        suffix = f'{name.lower()}披萨'
+        candidates = [item for item in self.items if item.is_pizza and item.name.lower().endswith(suffix)]
+        return candidates[0] if len(candidates) == 1 else None
+
+    def names(self):
+        """所有菜单项的名称和别名（小写）"""
+        return list(self._by_name)
+
+    def get(self, name):
+        """按名称或别名查找菜单项，找不到时返回None"""
+        return self._by_name.get(name.lower())
+
+    def category(self, category):
+        """某个分类下的所有菜单项"""
+        return [item for item in self.items if item.category == category]
+
+    def scan(self, text):
+        """
+        在文本中查找提到的菜单项（不重叠，最长匹配）
+
+        紧跟“披萨”的配料名称按披萨的简称处理（“不要香肠披萨了”是意式辣香肠披萨，不是配料香肠）。
+
+        返回:
+            list: [(起始位置, 结束位置, MenuItem), ...]，按出现顺序排列
+        """
+        matches = []
+        for m in self._pattern.finditer(text):
+            start, end, item = m.start(), m.end(), self._by_name[m.group(0).lower()]
+            if item.category == TOPPING and text.startswith('披萨', end):
+                pizza = self.pizza_for(m.group(0))
+                if pizza is not None:
+                    item, end = pizza, end + len('披萨')
+            matches.append((start, end, item))
+        return matches
+
+
+def parse_menu(text, aliases=ALIASES):
+    """
+    解析菜单文本
+
+    每个分类以“标题：”开头，每行一项：“名称（尺寸、尺寸） 价格、价格” 或 “名称 价格”。
+
+    返回:
+        Menu
+    """
+    items = []
+    category = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.endswith(('：', ':')):
+            category = line[:-1]
+            continue
+        match = re.match(r'^(.+?)(?:（([^）]+)）)?\s+([\d.、]+)$', line)
+        if match is None:
+            continue
+        name, sizes, prices = match.groups()
+        prices = [Decimal(p) for p in prices.split('、')]
+        sizes = sizes.split('、') if sizes else [None]
+        if len(sizes) != len(prices):
+            raise ValueError(f"菜单行的尺寸和价格数量不一致: {line}")
+        items.append(MenuItem(name.strip(), category, dict(zip(sizes, prices))))
+    return Menu(items, aliases)
+
+
+_menu = None
+
+
+def get_menu():
+    """获取默认菜单（解析 MENU_TEXT，只解析一次）"""
+    global _menu
+    if _menu is None:
+        _menu = parse_menu(MENU_TEXT)
+    return _menu
+
+
+def order_update_schema(menu=None):
+    """
+    update_order 工具的参数定义（JSON Schema），菜单项名称和尺寸限定为菜单中的取值
+
+    模型只需要输出本条消息带来的订单变化，由 OrderState.apply_update() 在本地合并和计价。
+    """
+    menu = menu or get_menu()
+    items = [item.name for item in menu.items if item.category != TOPPING]
+    toppings = [item.name for item in menu.category(TOPPING)]
+    sizes = sorted({size for item in menu.items for size in item.sizes}, key='大中小'.find)
+    return {
+        'type': 'object',
+        'properties': {
+            'add': {
+                'type': 'array',
+                'description': '新点的菜品或饮料',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'item': {'type': 'string', 'enum': items},
+                        'size': {'type': 'string', 'enum': sizes, 'description': '顾客没有说明时省略'},
+                        'quantity': {'type': 'integer', 'minimum': 1},
+                        'toppings': {'type': 'array', 'items': {'type': 'string', 'enum': toppings}},
+                    },
+                    'required': ['item'],
+                },
+            },
+            'remove': {'type': 'array', 'description': '顾客不要了的菜品或饮料', 'items': {'type': 'string', 'enum': items}},
+            'add_toppings': {'type': 'array', 'description': '给最近点的披萨加的配料', 'items': {'type': 'string', 'enum': toppings}},
+            'remove_toppings': {'type': 'array', 'items': {'type': 'string', 'enum': toppings}},
+            'sizes': {
+                'type': 'array',
+                'description': '补充之前没有说明的尺寸',
+                'items': {
+                    'type': 'object',
+                    'properties': {'item': {'type': 'string', 'enum': items}, 'size': {'type': 'string', 'enum': sizes}},
+                    'required': ['item', 'size'],
+                },
+            },
+            'fulfillment': {'type': 'string', 'enum': ['delivery', 'pickup'], 'description': '外送或自取'},
+            'address': {'type': 'string', 'description': '外送地址'},
+        },
+    }
+
+
+def _to_int(text):
+    """“12”“十二”“二十五”“两” -> 整数；无法识别时为1"""
+    if text.isdigit():
+        return int(text)
+    if '十' in text:
+        tens, _, ones = text.partition('十')
+        if len(tens) > 1 or len(ones) > 1:
+            return 1
+        return _NUMERALS.get(tens, 1 if not tens else 0) * 10 + _NUMERALS.get(ones, 0)
+    return _NUMERALS.get(text, 1) if len(text) == 1 else 1
+
+
+def _is_question(clause, question_mark):
+    """
+    分句是否是询问而不是点餐
+
+    参数:
+        clause: 分句内容（不含结尾的标点）
+        question_mark: 分句是否以问号结尾
+    """
+    if _QUESTION.search(clause):
+        return True
+    if question_mark or clause.rstrip().endswith(('吗', '么')):
+        return _ORDER_VERB.search(clause) is None
+    return False
+
+
+def format_price(amount):
+    return f"{amount:.2f}"
+
+
+class OrderLine:
+    """
+    订单中的一行：菜品或饮料、尺寸、数量和配料
+
+    参数:
+        item: MenuItem
+        size: 尺寸，未确定时为None
+        quantity: 数量
+        toppings: 配料的 MenuItem 列表（每份都加）
+    """
+
+    __slots__ = ('item', 'size', 'quantity', 'toppings')
+
+    def __init__(self, item, size=None, quantity=1, toppings=None):
+        self.item = item
+        self.size = size
+        self.quantity = quantity
+        self.toppings = list(toppings or [])
+
+    @property
+    def needs_size(self):
+        return self.size is None and len(self.item.prices) > 1
+
+    def unit_price(self):
+        """单价（含配料）；尺寸未确定时返回None"""
+        base = self.item.price(self.size)
+        if base is None:
+            return None
+        return base + sum((topping.price() for topping in self.toppings), Decimal('0'))
+
+    def total(self):
+        unit = self.unit_price()
+        return None if unit is None else unit * self.quantity
+
+    def describe(self):
+        size = f"{self.size}号" if self.size else ''
+        text = f"{size}{self.item.name} ×{self.quantity}"
+        if self.toppings:
+            text += f"（加{'、'.join(t.name for t in self.toppings)}）"
+        return text
+
+
+class OrderState:
+    """
+    一个会话的订单状态，根据顾客的消息增量更新，金额在本地精确计算
+
+    参数:
+        menu: 使用的菜单，默认为 get_menu()
+    """
+
+    def __init__(self, menu=None):
+        self.menu = menu or get_menu()
+        self.lines = []
+        self.fulfillment = None  # 'delivery'（外送）、'pickup'（自取）或None
+        self.address = None
+
+    def _last_pizza(self):
+        for line in reversed(self.lines):
+            if line.item.is_pizza:
+                return line
+        return None
+
+    def apply(self, text):
+        """
+        根据顾客的一条消息更新订单
+
+        能识别的内容：数量、尺寸、菜品和饮料、“加xx”配料、“不要/取消xx”、外送或自取、外送地址。
+
+        返回:
+            bool: 订单是否发生了变化
+        """
+        before = self.to_dict()
+        # 分句: [(起始位置, 结束位置, 是否是询问)]，询问中提到的菜单项不修改订单
+        clauses, clause_start = [], 0
+        for m in [*_CLAUSE_END.finditer(text), None]:
+            clause_end = m.start() if m else len(text)
+            clause = text[clause_start:clause_end]
+            clauses.append((clause_start, clause_end, _is_question(clause, m is not None and m.group(0) in '？?')))
+            clause_start = clause_end + 1
+        statements = ''.join(text[a:b] + '\n' for a, b, question in clauses if not question)
+
+        matches = [(start, end, item) for start, end, item in self.menu.scan(text)
+                   if not next(question for a, b, question in clauses if a <= start <= b)]
+        # 本条消息中最近提到的披萨，配料优先加到它上面
+        current = None
+        previous_end = 0
+        for start, end, item in matches:
+            clause_start = max((m.end() for m in _CLAUSE_END.finditer(text, previous_end, start)), default=previous_end)
+            window = text[clause_start:start]
+            full_clause = text[clause_start:end]
+            removing = _REMOVE.search(full_clause) is not None
+            previous_end = end
+            if item.category == TOPPING and (_SIZE_BEFORE.search(window) or _QUANTITY.search(window)):
+                # “大号芝士”“两个芝士”：前面有尺寸或数量的是披萨（芝士披萨），不是配料（奶酪）
+                item = self.menu.pizza_for(text[start:end]) or item
+
+            if item.category == TOPPING:
+                target = current or self._last_pizza()
+                if removing:
+                    if target is not None and item in target.toppings:
+                        target.toppings.remove(item)
+                    continue
+                if target is None:
+                    # 没有披萨时单独点配料，按菜单价格计入
+                    self.lines.append(OrderLine(item, None, self._quantity(window)))
+                    continue
+                quantity = _QUANTITY.search(window.replace('加', ''))
+                if quantity and _to_int(quantity.group(1)) < target.quantity:
+                    # “一个加辣椒”：从多份相同的披萨中分出一部分单独加配料
+                    # 分出的部分插在原行前面，下一句“一个加xx”仍然作用在剩下的披萨上
+                    split = _to_int(quantity.group(1))
+                    target.quantity -= split
+                    original = target
+                    target = OrderLine(original.item, original.size, split, original.toppings)
+                    self.lines.insert(self.lines.index(original), target)
+                if item not in target.toppings:
+                    target.toppings.append(item)
+                continue
+
+            size = self._size(item, window, text[end:])
+            if removing:
+                self.lines = [line for line in self.lines
+                              if not (line.item is item and (size is None or line.size == size))]
+                continue
+            line = OrderLine(item, size, self._quantity(window))
+            self.lines.append(line)
+            current = line if item.is_pizza else current
+
+        if not matches:
+            # “大的”“要中号”：补上最近一个还没有确定尺寸的项目
+            pending = next((line for line in reversed(self.lines) if line.needs_size), None)
+            size = re.search(r'([大中小])(?:号|杯|份|瓶|的)', statements)
+            if pending is not None and size and size.group(1) in pending.item.prices:
+                pending.size = size.group(1)
+
+        self._apply_fulfillment(statements, bool(matches))
+        return self.to_dict() != before
+
+    def apply_update(self, update):
+        """
+        合并模型通过 update_order 工具返回的订单变化（格式见 order_update_schema），
+        菜单中不存在的名称和尺寸会被忽略
+
+        返回:
+            bool: 订单是否发生了变化
+        """
+        before = self.to_dict()
+        menu = self.menu
+
+        def lookup(name, topping=False):
+            # 配料和菜品/饮料分开查找，避免把“芝士”（奶酪）当作菜品
+            item = menu.get(str(name)) if name else None
+            if item is None or (item.category == TOPPING) != topping:
+                return None
+            return item
+
+        for name in update.get('remove') or ():
+            item = lookup(name)
+            self.lines = [line for line in self.lines if line.item is not item]
+        for entry in update.get('add') or ():
+            item = lookup(entry.get('item')) if isinstance(entry, dict) else None
+            if item is None:
+                continue
+            size = entry.get('size') if entry.get('size') in item.prices else None
+            try:
+                quantity = max(int(entry.get('quantity') or 1), 1)
+            except (TypeError, ValueError):
+                quantity = 1
+            toppings = [t for t in (lookup(name, topping=True) for name in entry.get('toppings') or ()) if t is not None]
+            self.lines.append(OrderLine(item, size, quantity, toppings if item.is_pizza else None))
+        for entry in update.get('sizes') or ():
+            item = lookup(entry.get('item')) if isinstance(entry, dict) else None
+            line = next((l for l in reversed(self.lines) if l.item is item and l.needs_size), None)
+            if line is not None and entry.get('size') in item.prices:
+                line.size = entry['size']
+
+        target = self._last_pizza()
+        if target is not None:
+            for name in update.get('add_toppings') or ():
+                topping = lookup(name, topping=True)
+                if topping is not None and topping not in target.toppings:
+                    target.toppings.append(topping)
+            for name in update.get('remove_toppings') or ():
+                topping = lookup(name, topping=True)
+                if topping in target.toppings:
+                    target.toppings.remove(topping)
+
+        if update.get('fulfillment') in ('delivery', 'pickup'):
+            self.fulfillment = update['fulfillment']
+            if self.fulfillment == 'pickup':
+                self.address = None
+        if update.get('address'):
+            self.fulfillment = 'delivery'
+            self.address = str(update['address']).strip()
+        return self.to_dict() != before
+
+    @staticmethod
+    def _quantity(window):
+        match = _QUANTITY.search(window)
+        return _to_int(match.group(1)) if match else 1
+
+    @staticmethod
+    def _size(item, window, after):
+        for pattern, text in ((_SIZE_BEFORE, window), (_SIZE_AFTER, after)):
+            match = pattern.search(text)
+            if match and match.group(1) in item.prices:
+                return match.group(1)
+        return None
+
+    def _apply_fulfillment(self, text, mentioned_items):
+        if _PICKUP.search(text):
+            self.fulfillment = 'pickup'
+            self.address = None
+        elif _DELIVERY.search(text):
+            self.fulfillment = 'delivery'
+        match = _ADDRESS.search(text)
+        if match and match.group(1).strip():
+            self.fulfillment = 'delivery'
+            self.address = match.group(1).strip()
+        elif self.fulfillment == 'delivery' and self.address is None and not mentioned_items:
+            match = _BARE_ADDRESS.search(text)
+            if match:
+                self.address = match.group(0)
+
+    def total(self):
+        """已确定尺寸部分的总金额（Decimal）"""
+        return sum((line.total() for line in self.lines if line.total() is not None), Decimal('0'))
+
+    def missing(self):
+        """
+        订单中还需要向顾客确认的信息
+
+        返回:
+            list: 待确认项的描述
+        """
+        items = [f"{line.item.name}的尺寸（{'、'.join(line.item.sizes)}）" for line in self.lines if line.needs_size]
+        if self.lines and self.fulfillment is None:
+            items.append('自取还是外送')
+        if self.fulfillment == 'delivery' and not self.address:
+            items.append('外送地址')
+        return items
+
+    def summary(self):
+        """
+        订单的文字摘要（各行小计、合计、取餐方式和待确认项），用于提示大模型和显示给顾客
+        """
+        if not self.lines:
+            return '当前订单为空。'
+        lines = ['当前订单：']
+        for index, line in enumerate(self.lines, 1):
+            total = line.total()
+            lines.append(f"{index}. {line.describe()}  {format_price(total) if total is not None else '待确认尺寸'}")
+        lines.append(f"合计：{format_price(self.total())}")
+        if self.fulfillment == 'pickup':
+            lines.append('取餐方式：自取')
+        elif self.fulfillment == 'delivery':
+            lines.append(f"取餐方式：外送，地址：{self.address or '待确认'}")
+        missing = self.missing()
+        if missing:
+            lines.append(f"待确认：{'；'.join(missing)}")
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        """导出为可以JSON序列化的字典，便于保存到会话存储中"""
+        return {
+            'lines': [
+                {'item': line.item.name, 'size': line.size, 'quantity': line.quantity,
+                 'toppings': [t.name for t in line.toppings]}
+                for line in self.lines
+            ],
+            'fulfillment': self.fulfillment,
+            'address': self.address,
+        }
+
+    @classmethod
+    def from_dict(cls, data, menu=None):
+        """从 to_dict() 导出的字典恢复订单；data 为None时返回空订单。菜单中已不存在的项目会被忽略"""
+        order = cls(menu)
+        if not data:
+            return order
+        for entry in data.get('lines', []):
+            item = order.menu.get(entry['item'])
+            if item is None:
+                continue
+            toppings = [t for t in (order.menu.get(name) for name in entry.get('toppings', [])) if t is not None]
+            order.lines.append(OrderLine(item, entry.get('size'), entry.get('quantity', 1), toppings))
+        order.fulfillment = data.get('fulfillment')
+        order.address = data.get('address')
+        return order
@@ -0,0 +1,304 @@
+"""
+延迟与token用量的指标收集
+在进程内用固定分桶的直方图和计数器汇总各阶段的耗时、token用量和错误次数，开销很小：
+每次记录只是一次二分查找和几次加法。可以导出为 Prometheus 文本格式，挂载为 /metrics 接口。
+
+还提供可插拔的追踪钩子：注册 hook(name, attributes) -> 上下文管理器 后，
+span() 包住的代码（如披萨机器人的每一轮对话、每次API请求）会进入钩子返回的上下文，
+可以直接接入 OpenTelemetry 等追踪系统。
+"""
+import math
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, ExitStack
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def percentile(sorted_values, p):
+    """
+    按最近秩法计算一组样本的分位数（p 取0-100），sorted_values 需要已经排序；没有样本时返回None
+
+    直方图的分位数见 Histogram.quantile（按分桶插值估算，不保留样本）。
+    """
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """
+    只增不减的计数器
+
+    参数:
+        name: 指标名称
+        help: 说明
+        labelnames: 标签名称元组，记录时按相同顺序传入标签值
+    """
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        """计数增加 amount"""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def collect(self):
+        """返回 {标签值元组: 计数}"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """
+    固定分桶的直方图，记录观测值的分布、总和与数量
+
+    参数:
+        name: 指标名称
+        help: 说明
+        labelnames: 标签名称元组
+        buckets: 分桶上界（升序），最后自动追加 +Inf
+    """
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {}  # 标签值元组 -> [各分桶计数..., 总和, 数量]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """记录一个观测值"""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        """
+        返回:
+            dict: {标签值元组: {'buckets': 各分桶的累计计数, 'sum': 总和, 'count': 数量}}
+        """
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        result = {}
+        for labels, series in snapshot.items():
+            cumulative, total = [], 0
+            for count in series[:-2]:
+                total += count
+                cumulative.append(total)
+            result[labels] = {'buckets': cumulative, 'sum': series[-2], 'count': series[-1]}
+        return result
+
+    def quantile(self, q, *labels):
+        """
+        按分桶线性插值估算分位数（与 Prometheus 的 histogram_quantile 相同）；没有数据时返回None
+        """
+        series = self.collect().get(labels)
+        if not series or not series['count']:
+            return None
+        rank = q * series['count']
+        lower, previous = 0.0, 0
+        for bound, cumulative in zip(self.buckets, series['buckets']):
+            if cumulative >= rank:
+                if bound == math.inf:
+                    return lower
+                return lower + (bound - lower) * (rank - previous) / max(cumulative - previous, 1)
+            lower, previous = bound, cumulative
+        return lower
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self.collect().items()):
+            for bound, cumulative in zip(self.buckets, series['buckets']):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(series["sum"])}')
+            lines.append(f'{self.name}_count{label_text} {series["count"]}')
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class MetricsRegistry:
+    """
+    指标注册表：按名称创建或获取指标，并统一导出
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"指标 {name} 已注册为其他类型")
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        """创建或获取计数器"""
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """创建或获取直方图"""
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        导出为 Prometheus 文本格式（text/plain; version=0.0.4）
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        返回:
+            dict: {指标名称: {'标签=值,...': 计数 或 {'count', 'sum', 'mean', 'p50', 'p95', 'p99'}}}
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {}
+        for metric in metrics:
+            series = {}
+            for labels, value in metric.collect().items():
+                key = ','.join(f'{name}={label}' for name, label in zip(metric.labelnames, labels))
+                if isinstance(metric, Histogram):
+                    count = value['count']
+                    value = {
+                        'count': count,
+                        'sum': value['sum'],
+                        'mean': value['sum'] / count if count else None,
+                        'p50': metric.quantile(0.5, *labels),
+                        'p95': metric.quantile(0.95, *labels),
+                        'p99': metric.quantile(0.99, *labels),
+                    }
+                series[key] = value
+            result[metric.name] = series
+        return result
+
+    def reset(self):
+        """清空所有指标的数据（保留已注册的指标）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+
+REGISTRY = MetricsRegistry()
+
+
+def render_prometheus():
+    """导出默认注册表中的所有指标（Prometheus 文本格式）"""
+    return REGISTRY.render()
+
+
+# ========== 追踪钩子 ==========
+_trace_hooks = []
+
+
+def add_trace_hook(hook):
+    """
+    注册追踪钩子
+
+    参数:
+        hook: hook(name, attributes) -> 上下文管理器，进入时开始一个span，退出时结束
+
+    示例（OpenTelemetry）:
+        tracer = trace.get_tracer('pizza_bot')
+        add_trace_hook(lambda name, attributes: tracer.start_as_current_span(name, attributes=attributes))
+    """
+    _trace_hooks.append(hook)
+
+
+def remove_trace_hook(hook):
+    """移除已注册的追踪钩子"""
+    _trace_hooks.remove(hook)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    在所有已注册的追踪钩子中开始一个span；没有注册钩子时几乎没有开销
+    """
+    if not _trace_hooks:
+        yield
+        return
+    with ExitStack() as stack:
+        for hook in list(_trace_hooks):
+            stack.enter_context(hook(name, attributes))
+        yield
+
+
+def metrics_handler(registry=None):
+    """
+    返回输出 Prometheus 指标的 tornado 请求处理类，可以挂载到 Panel 服务上:
+
+        pn.serve(create_app, extra_patterns=[('/metrics', metrics_handler())])
+    """
+    from tornado.web import RequestHandler
+
+    registry = registry or REGISTRY
+
+    class MetricsHandler(RequestHandler):
+        def get(self):
+            self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.write(registry.render())
+
+    return MetricsHandler
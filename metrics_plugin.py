@@ -0,0 +1,11 @@
+"""
+Panel 服务插件：在 panel serve 启动的服务上挂载 Prometheus 格式的 /metrics 接口
+
+    panel serve pizza_bot.py --plugins metrics_plugin
+
+panel serve 启动时导入本模块，把 ROUTES 中的地址加到服务上；指标与各会话运行在同一个进程中。
+用 python pizza_bot.py 直接启动时，设置 METRICS_ENDPOINT=1 会挂载同样的 ROUTES。
+"""
+from metrics import metrics_handler
+
+ROUTES = [('/metrics', metrics_handler())]
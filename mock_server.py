@@ -0,0 +1,326 @@
+"""
+本地模拟的 OpenAI 兼容API服务
+不访问真实的提供商，用于性能测试、压力测试和离线开发：
+- POST /v1/chat/completions：普通JSON响应和SSE流式响应（支持 stream_options.include_usage），
+  以及强制调用工具（tool_choice）和JSON模式（response_format）的响应
+- POST /v1/moderations：包含指定关键词的文本会被标记
+- GET /stats：各接口收到的请求数量；GET /health：健康检查
+- 可配置响应延迟、逐段输出的间隔、回复长度，以及按比例注入错误（如503、429 + Retry-After）
+
+只依赖标准库。使用方法:
+    python mock_server.py --port 8800 --latency 0.2 --token-delay 0.02 --error-rate 0.05
+
+    # 另一个终端中，让 tool.py 的请求发往模拟服务
+    export DEEPSEEK_BASE_URL=http://127.0.0.1:8800/v1 DEEPSEEK_API_KEY=mock
+    export OPENAI_BASE_URL=http://127.0.0.1:8800/v1 OPENAI_API_KEY=mock
+
+在代码中使用:
+    with MockServer(latency=0.1) as server:
+        os.environ['DEEPSEEK_BASE_URL'] = server.url
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 模拟回复使用的词表，每个词作为流式响应的一段
+_VOCABULARY = ('好的', '，', '我们', '的', '披萨', '有', '意大利辣香肠', '芝士', '蘑菇', '。', '请问', '您', '需要', '什么', '尺寸', '？')
+DEFAULT_FLAG_WORDS = ('杀', '炸弹', 'kill', 'bomb')
+MODERATION_CATEGORIES = ('harassment', 'hate', 'self-harm', 'sexual', 'violence')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持keep-alive，与真实服务一样复用连接
+    disable_nagle_algorithm = True  # 响应头和响应体分开写入，否则会因延迟确认多出约40毫秒
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        mock = self.server.mock
+        if self.path == '/stats':
+            self._send_json(200, mock.stats())
+        elif self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        mock = self.server.mock
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'invalid JSON'}})
+            return
+
+        if self.path.endswith('/chat/completions'):
+            endpoint = 'chat'
+        elif self.path.endswith('/moderations'):
+            endpoint = 'moderations'
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+
+        mock._count(endpoint)
+        mock._sleep_latency()
+
+        error = mock._pick_error()
+        if error is not None:
+            mock._count('errors')
+            headers = {'Retry-After': str(mock.retry_after)} if mock.retry_after is not None else None
+            self._send_json(error, {'error': {'message': f'mock error {error}', 'type': 'mock_error'}}, headers)
+            return
+
+        if endpoint == 'moderations':
+            self._send_json(200, mock.moderate(body))
+        elif body.get('stream'):
+            self._stream_chat(mock, body)
+        else:
+            self._send_json(200, mock.complete(body))
+
+    def _stream_chat(self, mock, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        chunks, usage = mock.reply(body)
+        model = body.get('model')
+        for chunk in chunks:
+            event = {'object': 'chat.completion.chunk', 'model': model,
+                     'choices': [{'index': 0, 'delta': {'content': chunk}, 'finish_reason': None}]}
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+            if mock.token_delay:
+                time.sleep(mock.token_delay)
+        final = {'object': 'chat.completion.chunk', 'model': model,
+                 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+        self._write_chunk(f"data: {json.dumps(final)}\n\n".encode('utf-8'))
+        if (body.get('stream_options') or {}).get('include_usage'):
+            self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 默认只有5，并发建立连接时会触发SYN重传，出现1秒以上的延迟
+
+
+class MockServer:
+    """
+    本地模拟的 OpenAI 兼容API服务
+
+    参数:
+        host, port: 监听地址；port为0时随机选择空闲端口
+        latency: 每个请求返回响应头之前的固定延迟（秒）
+        jitter: 在 latency 基础上随机增加的最大延迟（秒）
+        token_delay: 流式响应每段之间的间隔（秒）
+        reply_tokens: 每次回复的段数（约等于token数量），请求中的 max_tokens 更小时以 max_tokens 为准
+        error_rate: 按该比例返回错误响应（0-1）
+        error_status: 注入错误时的HTTP状态码
+        retry_after: 注入错误时返回的 Retry-After 秒数，为None时不返回
+        flag_words: 审核接口中会被标记的关键词
+        seed: 随机数种子，便于复现延迟和错误的分布
+
+    以上参数在运行中可以直接修改（例如 server.error_rate = 0.5）。
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, token_delay=0.0,
+                 reply_tokens=20, error_rate=0.0, error_status=503, retry_after=None,
+                 flag_words=DEFAULT_FLAG_WORDS, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.flag_words = tuple(word.lower() for word in flag_words)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._ids = 0
+        self._thread = None
+
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self.host, self.port = self._server.server_address[:2]
+
+    @property
+    def url(self):
+        """API根地址，可以直接作为 DEEPSEEK_BASE_URL / OPENAI_BASE_URL"""
+        return f"http://{self.host}:{self.port}/v1"
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def _sleep_latency(self):
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pick_error(self):
+        if not self.error_rate:
+            return None
+        with self._lock:
+            return self.error_status if self._random.random() < self.error_rate else None
+
+    def reply(self, body):
+        """
+        生成模拟回复
+
+        返回:
+            (回复片段列表, usage)
+        """
+        messages = body.get('messages') or []
+        n = self.reply_tokens
+        if body.get('max_tokens'):
+            n = min(n, body['max_tokens'])
+        chunks = [_VOCABULARY[i % len(_VOCABULARY)] for i in range(n)]
+        prompt_tokens = sum(len(str(m.get('content') or '')) for m in messages) // 2 + 3 * len(messages)
+        # 除最后一条消息外的部分视为命中提示词前缀缓存
+        cached = max(prompt_tokens - len(str(messages[-1].get('content') or '')) // 2 - 3, 0) if messages else 0
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': n,
+            'total_tokens': prompt_tokens + n,
+            'prompt_cache_hit_tokens': cached,
+            'prompt_cache_miss_tokens': prompt_tokens - cached,
+        }
+        return chunks, usage
+
+    def complete(self, body):
+        """
+        生成非流式的对话响应
+
+        tool_choice 强制调用工具（'required' 或指定工具名）时返回参数为 {} 的工具调用；
+        response_format 为 json_object 时回复内容为 {"reply": ...}。
+        """
+        chunks, usage = self.reply(body)
+        message = {'role': 'assistant', 'content': ''.join(chunks)}
+        finish_reason = 'stop'
+        tool_choice = body.get('tool_choice')
+        if body.get('tools') and (tool_choice == 'required' or isinstance(tool_choice, dict)):
+            name = tool_choice['function']['name'] if isinstance(tool_choice, dict) else body['tools'][0]['function']['name']
+            message = {'role': 'assistant', 'content': None, 'tool_calls': [{
+                'id': f'call_mock_{self._next_id()}', 'type': 'function',
+                'function': {'name': name, 'arguments': '{}'},
+            }]}
+            finish_reason = 'tool_calls'
+        elif (body.get('response_format') or {}).get('type') == 'json_object':
+            message['content'] = json.dumps({'reply': message['content']}, ensure_ascii=False)
+        return {
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+            'usage': usage,
+        }
+
+    def _next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def moderate(self, body):
+        """生成审核响应：包含关键词的文本标记为 violence"""
+        inputs = body.get('input') or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        results = []
+        for text in inputs:
+            flagged = any(word in str(text).lower() for word in self.flag_words)
+            categories = {name: flagged and name == 'violence' for name in MODERATION_CATEGORIES}
+            scores = {name: (0.9 if value else 0.001) for name, value in categories.items()}
+            results.append({'flagged': flagged, 'categories': categories, 'category_scores': scores})
+        return {'id': 'modr-mock', 'model': body.get('model'), 'results': results}
+
+    def stats(self):
+        """
+        返回:
+            dict: 各接口收到的请求数量，如 {'chat': 10, 'moderations': 2, 'errors': 1}
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def start(self):
+        """在后台线程中启动服务，返回self"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """在当前线程中运行服务，直到被中断"""
+        self._server.serve_forever()
+
+    def stop(self):
+        """停止服务并释放端口"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地模拟的 OpenAI 兼容API服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0.0, help='返回响应头之前的延迟秒数')
+    parser.add_argument('--jitter', type=float, default=0.0, help='随机增加的最大延迟秒数')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='流式响应每段之间的间隔秒数')
+    parser.add_argument('--reply-tokens', type=int, default=20, help='每次回复的段数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='注入错误的比例（0-1）')
+    parser.add_argument('--error-status', type=int, default=503, help='注入错误的HTTP状态码')
+    parser.add_argument('--retry-after', type=float, default=None, help='注入错误时返回的 Retry-After 秒数')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子')
+    args = parser.parse_args(argv)
+
+    server = MockServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        token_delay=args.token_delay, reply_tokens=args.reply_tokens, error_rate=args.error_rate,
+        error_status=args.error_status, retry_after=args.retry_after, seed=args.seed,
+    )
+    print(f"模拟服务已启动: {server.url}")
+    print(f"  export DEEPSEEK_BASE_URL={server.url} OPENAI_BASE_URL={server.url}")
+    print("  按 Ctrl+C 停止")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
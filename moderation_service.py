@@ -0,0 +1,291 @@
+"""
+内容审核服务
+在 moderation_create 之上增加一层：
+- 本地预审核（pre_moderation.py）：明显安全（如只包含菜单词汇）或明显违规的输入在本地直接判定，不调用API
+- 结果缓存：按规范化文本的哈希缓存审核结论，重复的输入不再调用API
+- 请求合并：把不同会话在很短时间窗口内提交的单条审核请求，合并为一次
+  input: [...] 的批量调用，再把结果分发给各个调用方。批量调用在线程池中进行，
+  上一批还在等待API响应时就开始收集和发送下一批，不会多等一次往返
+"""
+import time
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from env_loader import getenv
+from tool import moderation_create
+
+
+def normalize_text(text):
+    """
+    规范化待审核文本：Unicode NFKC规范化、转小写、合并连续空白
+
+    全角/半角、大小写、多余空格不同的输入会得到相同的结果。
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ' '.join(text.split())
+
+
+def _text_key(text):
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def _set_result(future, result):
+    """设置结果；调用方已经取消的 Future 直接跳过"""
+    if future.set_running_or_notify_cancel():
+        future.set_result(result)
+
+
+def _done(result):
+    """已经有结果的 Future（缓存命中、本地预审核）"""
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _follow(shared):
+    """
+    为一个调用方创建独立的 Future，结果来自共享的 Future
+
+    相同文本的并发请求共享一次API调用，但每个调用方拿到各自的 Future：
+    一个调用方取消（如会话关闭）不会影响其他调用方。
+    """
+    future = Future()
+    shared.add_done_callback(lambda done: _set_result(future, done.result()))
+    return future
+
+
+class ModerationService:
+    """
+    带缓存和请求合并的内容审核服务
+
+    返回结果的格式与 moderation_create(单个字符串) 相同。
+
+    参数:
+        model: 审核模型
+        cache_size: 最多缓存的审核结论数量（LRU淘汰）
+        cache_ttl: 审核结论的缓存时间（秒）
+        batch_window: 合并请求的时间窗口（秒），收到第一条请求后最多等待这么久
+        max_batch_size: 单次批量调用最多包含的文本数量
+        max_concurrent_batches: 同时进行的批量调用数量上限
+        moderate_batch: 执行批量审核的函数，默认为 tool.moderation_create
+        pre_moderator: 本地预审核器（pre_moderation.PreModerator），为None时所有输入都交给API
+    """
+
+    def __init__(self, model="omni-moderation-latest", cache_size=4096, cache_ttl=3600,
+                 batch_window=0.02, max_batch_size=32, max_concurrent_batches=8, moderate_batch=None,
+                 pre_moderator=None):
+        self.model = model
+        self.pre_moderator = pre_moderator
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_concurrent_batches = max_concurrent_batches
+        self._moderate_batch = moderate_batch or moderation_create
+
+        self._cache = OrderedDict()  # key -> (过期时间, 结果)
+        self._pending = []           # 等待批量提交的 (key, text)
+        self._inflight = {}          # key -> Future，相同文本的并发请求共享一个结果
+        self._cond = threading.Condition()
+        self._worker = None
+        self._executor = None        # 执行批量调用的线程池，与第一个后台线程一起创建
+        self._batches_inflight = 0
+        self._closed = False
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = 0
+        self.api_calls = 0
+        self.texts_sent = 0
+
+    def submit(self, text):
+        """
+        提交一条待审核文本
+
+        返回:
+            concurrent.futures.Future，结果为审核结果字典；每次调用返回独立的 Future，
+            取消它不影响同一文本的其他调用方
+        """
+        if self.pre_moderator is not None:
+            result = self.pre_moderator.classify(text)
+            if result is not None:
+                return _done(result)
+
+        key = _text_key(text)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('ModerationService已关闭')
+
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.time():
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return _done(cached[1])
+            self.cache_misses += 1
+
+            shared = self._inflight.get(key)
+            if shared is not None:
+                self.coalesced += 1
+                return _follow(shared)
+
+            shared = Future()
+            self._inflight[key] = shared
+            self._pending.append((key, text))
+            if self._worker is None:
+                self._executor = ThreadPoolExecutor(self.max_concurrent_batches, thread_name_prefix='moderation')
+                self._worker = threading.Thread(target=self._run, name='moderation-batcher', daemon=True)
+                self._worker.start()
+            self._cond.notify()
+            return _follow(shared)
+
+    def moderate(self, text):
+        """
+        审核单条文本（阻塞直到结果返回）
+
+        返回:
+            与 moderation_create(text) 格式相同的字典
+        """
+        return self.submit(text).result()
+
+    async def amoderate(self, text):
+        """
+        moderate 的异步版本，等待期间不占用事件循环
+        """
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+                # 收到第一条请求后等待一个时间窗口，收集更多请求
+                deadline = time.monotonic() + self.batch_window
+                while len(self._pending) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+                self._batches_inflight += 1
+
+            # 交给线程池调用API，本线程立即开始收集下一批
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        texts = [text for _, text in batch]
+        try:
+            response = self._moderate_batch(texts, model=self.model)
+        except Exception as e:
+            response = {
+                'error': f'调用OpenAI Moderation API时发生错误: {str(e)}',
+                'flagged': False,
+                'api_error': True
+            }
+
+        results = response.get('results') or []
+        ok = 'error' not in response and len(results) == len(batch)
+        expires_at = time.time() + self.cache_ttl
+
+        with self._cond:
+            self._batches_inflight -= 1
+            self.api_calls += 1
+            self.texts_sent += len(batch)
+            futures = []
+            for i, (key, _) in enumerate(batch):
+                if ok:
+                    single = results[i]
+                    result = {
+                        'id': response.get('id'),
+                        'model': response.get('model'),
+                        'flagged': single.get('flagged', False),
+                        'categories': single.get('categories', {}),
+                        'category_scores': single.get('category_scores', {}),
+                        'results': [single]
+                    }
+                    # 只缓存成功的审核结论，API错误不缓存
+                    self._cache[key] = (expires_at, result)
+                    self._cache.move_to_end(key)
+                else:
+                    result = response
+                futures.append((self._inflight.pop(key), result))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        for future, result in futures:
+            _set_result(future, result)
+
+    def stats(self):
+        """
+        获取审核服务的统计信息
+
+        返回:
+            dict: {'cache_hits': 缓存命中次数, 'cache_misses': 缓存未命中次数,
+                   'coalesced': 与进行中的相同请求合并的次数, 'api_calls': 实际调用API的次数,
+                   'texts_sent': 发送给API的文本总数, 'pending': 等待提交的文本数量,
+                   'batches_inflight': 正在等待API响应的批量调用数量,
+                   'pre_moderation': 本地预审核的统计（见 PreModerator.stats()，未启用时为None）}
+        """
+        with self._cond:
+            stats = {
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'coalesced': self.coalesced,
+                'api_calls': self.api_calls,
+                'texts_sent': self.texts_sent,
+                'pending': len(self._pending),
+                'batches_inflight': self._batches_inflight,
+            }
+        stats['pre_moderation'] = self.pre_moderator.stats() if self.pre_moderator is not None else None
+        return stats
+
+    def close(self):
+        """停止后台合并线程（已提交的请求会先处理完）"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            worker = self._worker
+        if worker is not None:
+            worker.join()
+            self._executor.shutdown(wait=True)
+
+
+_default_service = None
+_default_service_lock = threading.Lock()
+
+
+def get_moderation_service():
+    """
+    获取进程内共享的审核服务，首次调用时创建
+
+    环境变量配置:
+        MODERATION_BATCH_WINDOW_MS: 合并请求的时间窗口（毫秒，默认: 20）
+        MODERATION_MAX_BATCH: 单次批量调用的最大文本数量（默认: 32）
+        MODERATION_MAX_CONCURRENT: 同时进行的批量调用数量上限（默认: 8）
+        MODERATION_CACHE_SIZE: 缓存的审核结论数量（默认: 4096）
+        MODERATION_CACHE_TTL: 审核结论的缓存时间（秒，默认: 3600）
+        PRE_MODERATION: 设为0时关闭本地预审核（默认开启）
+    """
+    global _default_service
+    if _default_service is None:
+        with _default_service_lock:
+            if _default_service is None:
+                pre_moderator = None
+                if getenv('PRE_MODERATION', '1') != '0':
+                    from pre_moderation import get_pre_moderator
+                    pre_moderator = get_pre_moderator()
+                _default_service = ModerationService(
+                    batch_window=float(getenv('MODERATION_BATCH_WINDOW_MS', '20')) / 1000,
+                    max_batch_size=int(getenv('MODERATION_MAX_BATCH', '32')),
+                    max_concurrent_batches=int(getenv('MODERATION_MAX_CONCURRENT', '8')),
+                    cache_size=int(getenv('MODERATION_CACHE_SIZE', '4096')),
+                    cache_ttl=float(getenv('MODERATION_CACHE_TTL', '3600')),
+                    pre_moderator=pre_moderator,
+                )
+    return _default_service
@@ -2,21 +2,25 @@
 """
 披萨餐厅订餐机器人
 使用Panel创建GUI界面，使用DeepSeek API进行对话
+
+Panel 在创建界面（create_app）时才导入和初始化，只使用对话逻辑（如负载测试）时
+导入本模块不需要加载 Panel。
 """
-import panel as pn
-from tool import get_completion_from_messages, moderation_create
+from tool import astream_completion_from_messages, achat_completion, APIError
+from moderation_service import get_moderation_service
+from context_window import ContextWindow, asummarize_messages
+from session_store import get_session_store
+from rate_limiter import request_priority, INTERACTIVE
+from metrics import REGISTRY, span
+from menu import MENU_TEXT, OrderState, order_update_schema
+from function_calling import function_tool, force_tool
+from env_loader import getenv
 import time
-import os
-from dotenv import load_dotenv, find_dotenv
-
-# 读取环境变量
-_ = load_dotenv(find_dotenv())
-
-# 初始化Panel
-pn.extension()
+import uuid
+import asyncio
 
-# 设置全局样式，实现居中
-pn.config.raw_css = ["""
+# 全局样式，实现居中（创建界面时设置）
+RAW_CSS = ["""
 body {
     display: flex;
     justify-content: center;
@@ -40,10 +44,21 @@ body {
 }
 """]
 
-# 存储对话历史
-panels = []  # 收集显示内容
+
+def init_panel():
+    """
+    初始化Panel（加载前端资源、设置全局样式），返回 panel 模块
+
+    在创建界面时调用；通过 panel serve 运行时每个会话都会调用，重复调用没有副作用。
+    """
+    import panel as pn
+    pn.extension()
+    pn.config.raw_css = RAW_CSS
+    return pn
 
 # 系统上下文 - 订餐机器人的角色和菜单信息
+# 每个请求都以它开头且内容固定不变，可以命中提供商的提示词前缀缓存；
+# 会话相关的内容（如对话备忘录）要放在它后面，不要修改它
 context = [{
     'role': 'system',
     'content': """
@@ -57,30 +72,47 @@ context = [{
 
 菜单包括：
 
-菜品：
-意式辣香肠披萨（大、中、小） 12.95、10.00、7.00
-芝士披萨（大、中、小） 10.95、9.25、6.50
-茄子披萨（大、中、小） 11.95、9.75、6.75
-薯条（大、小） 4.50、3.50
-希腊沙拉 7.25
-
-配料：
-奶酪 2.00
-蘑菇 1.50
-香肠 3.00
-加拿大熏肉 3.50
-AI酱 1.50
-辣椒 1.00
-
-饮料：
-可乐（大、中、小） 3.00、2.00、1.00
-雪碧（大、中、小） 3.00、2.00、1.00
-瓶装水 5.00
-"""
+""" + MENU_TEXT
 }]
 
-# 存储完整的对话历史
-conversation = context.copy()
+_settings = None
+
+
+def get_settings():
+    """
+    机器人的配置，第一次调用时从环境变量读取（导入本模块时不加载 .env）
+
+    返回:
+        dict: 以下各项（键名为环境变量名的小写）
+
+    环境变量配置:
+        CONTEXT_MAX_TOKENS: 上下文窗口：每次请求前按token预算裁剪对话历史，早期对话压缩为备忘录（默认: 3000）
+        CONTEXT_SUMMARY: 设为0时直接丢弃早期对话，不生成备忘录
+        SPECULATIVE_COMPLETION: 流水线模式，内容审核进行的同时提前开始生成回复（设为0时关闭）
+        ORDER_ENGINE: 订单引擎，在本地跟踪订单并精确计算金额，模型确认订单时直接使用（设为0时关闭）
+        ORDER_EXTRACTION: 订单信息的提取方式: rules（本地规则，默认，不产生额外请求）或 llm（模型通过
+                          update_order 工具返回本条消息带来的订单变化，能理解更随意的表达）。llm 模式下
+                          回复要用到更新后的订单金额，生成回复必须等提取请求返回：提取请求与内容审核、
+                          上下文裁剪同时开始，但每轮仍然在回复之前串行多出一次（很短的）模型请求的往返时间
+    """
+    global _settings
+    if _settings is None:
+        _settings = {
+            'context_max_tokens': int(getenv('CONTEXT_MAX_TOKENS', '3000')),
+            'context_summary': getenv('CONTEXT_SUMMARY', '1') != '0',
+            'speculative_completion': getenv('SPECULATIVE_COMPLETION', '1') != '0',
+            'order_engine': getenv('ORDER_ENGINE', '1') != '0',
+            'order_extraction': getenv('ORDER_EXTRACTION', 'rules').lower(),
+        }
+    return _settings
+
+ORDER_TOOL = function_tool('update_order', '记录顾客本条消息带来的订单变化（只包含变化的部分）', order_update_schema())
+
+# 每轮对话各阶段的耗时: context（裁剪上下文）、moderation（等待审核结论）、
+# first_token（从点击发送到显示第一段回复）、total（整轮对话）
+TURN_SECONDS = REGISTRY.histogram(
+    'pizza_bot_turn_seconds', '披萨机器人每轮对话各阶段的耗时（秒）', ('phase',)
+)
 
 
 def check_openai_support():
@@ -90,135 +122,389 @@ def check_openai_support():
     返回:
         bool: 如果支持OpenAI返回True，否则返回False
     """
-    openai_api_key = os.getenv('OPENAI_API_KEY')
+    openai_api_key = getenv('OPENAI_API_KEY')
     return openai_api_key is not None and openai_api_key.strip() != ""
 
 
-def collect_messages(_):
+class PendingCompletion:
     """
-    收集用户消息并获取AI回复
+    在后台开始生成AI回复，并缓冲已生成的片段，直到被读取
+
+    用于流水线模式：审核进行的同时提前开始生成；如果审核未通过，
+    调用 cancel() 取消生成并丢弃已生成的内容。
+    生成失败时，读取到失败的位置会抛出 APIError。
     
     参数:
-        _: Panel按钮点击事件（未使用）
+        messages: 发送给模型的消息列表
+        **kwargs: 传给 astream_completion_from_messages 的其他参数
+    """
+
+    def __init__(self, messages, **kwargs):
+        self._queue = asyncio.Queue()
+        self._error = None
+        self._task = asyncio.ensure_future(self._produce(messages, kwargs))
+
+    async def _produce(self, messages, kwargs):
+        try:
+            async for chunk in astream_completion_from_messages(messages, **kwargs):
+                self._queue.put_nowait(chunk)
+        except APIError as e:
+            self._error = e
+        finally:
+            self._queue.put_nowait(None)
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield chunk
+
+    def cancel(self):
+        """取消生成（已生成的内容被丢弃）"""
+        self._task.cancel()
+
+
+def order_message(order):
+    """
+    把本地记录的订单作为系统消息提供给模型
+
+    放在本轮用户消息之前、固定的系统提示词之后，不影响前缀缓存；订单为空时返回None
+    """
+    if not order.lines and order.fulfillment is None:
+        return None
+    return {'role': 'system', 'content': (
+        "以下是系统根据对话记录的订单，金额已经精确计算。确认订单和告知金额时直接使用，不要自己计算；"
+        "待确认的内容需要向顾客询问。\n" + order.summary()
+    )}
+
+
+async def aextract_order_update(order, user_input, last_reply=None):
+    """
+    让模型从顾客的消息中提取订单变化（强制调用 update_order 工具）
+
+    只发送当前订单、上一条助手回复和本条消息，不发送完整的对话历史。
     
     返回:
-        Panel对象，显示对话历史
+        dict: update_order 的参数；请求失败或模型没有返回有效参数时为None
     """
+    messages = [
+        {'role': 'system', 'content': "你负责从披萨店顾客的消息中提取订单变化，调用 update_order 记录。没有变化时传入空对象。"},
+        {'role': 'system', 'content': order.summary()},
+    ]
+    if last_reply:
+        messages.append({'role': 'assistant', 'content': last_reply})
+    messages.append({'role': 'user', 'content': user_input})
+    try:
+        result = await achat_completion(
+            messages, temperature=0, max_tokens=300, tools=[ORDER_TOOL], tool_choice=force_tool('update_order')
+        )
+    except APIError:
+        return None
+    for call in result.tool_calls:
+        if call.name == 'update_order' and call.arguments is not None:
+            return call.arguments
+    return None
+
+
+def create_context_window(state):
+    """
+    为一个会话创建上下文窗口，并恢复会话中保存的备忘录
+    
+    参数:
+        state: 会话状态（来自会话存储）
+    """
+    settings = get_settings()
+    window = ContextWindow(
+        max_prompt_tokens=settings['context_max_tokens'],
+        summarize=asummarize_messages if settings['context_summary'] else None,
+    )
+    window.restore_state(state)
+    return window
+
+
+async def collect_messages(_, inp, transcript, session_id, order_pane=None):
+    """
+    收集用户消息并以流式方式获取AI回复
+    
+    这是一个异步生成器：先在对话记录中追加用户消息和空的助手回复框，
+    然后随着回复逐段生成不断更新回复框，用户无需等待完整回复。
+    每轮只追加新的消息、更新回复框，不会重新构造已显示的对话记录。
+    等待API时不会占用服务器线程；用户关闭页面（会话销毁）时，
+    Panel会取消该任务，正在进行的请求随之中断。
+    
+    启用内容审核时，默认以流水线方式运行：审核与回复生成同时开始，
+    审核通过后才显示回复；审核未通过则取消生成，显示结果与先审核再生成完全相同。
+    
+    参数:
+        _: Panel按钮点击事件（未使用）
+        inp: 当前会话的输入框
+        transcript: 当前会话的对话记录（Transcript）
+        session_id: 会话ID，用于从会话存储读写对话历史
+        order_pane: 显示当前订单的Markdown组件（可选，启用订单引擎时每轮更新）
+    
+    产出:
+        Panel对象，显示对话记录（每次都是 transcript.view，界面有更新时产出）
+    """
+    # 对话请求在限流器中排在批量任务前面（本任务及其创建的子任务都使用该优先级）
+    request_priority.set(INTERACTIVE)
+    
+    # 整轮对话作为一个追踪span（注册了 metrics.add_trace_hook 时生效）
+    with span('pizza_bot.turn', session_id=session_id):
+        async for view in _run_turn(inp, transcript, session_id, order_pane):
+            yield view
+
+
+async def _run_turn(inp, transcript, session_id, order_pane=None):
+    """collect_messages 的实际处理过程，参数与 collect_messages 相同"""
+    import panel as pn  # 对话记录已经创建，Panel 已经导入
+    started = time.perf_counter()
+    
     # 获取用户输入
     user_input = inp.value
     
     if not user_input or user_input.strip() == "":
-        return pn.Column(*panels)
+        yield transcript.view
+        return
+    
+    # 从会话存储读取本会话的对话历史（不包含系统提示词）
+    session_store = get_session_store()
+    state = session_store.load(session_id)
+    conversation = context + state['messages']
+    context_window = create_context_window(state)
     
-    # 先检查是否支持OpenAI，如果支持则进行内容审核
-    if check_openai_support():
-        moderation_result = moderation_create(user_input)
+    completion = None
+    moderation = None
+    extraction = None
+    settings = get_settings()
+    order = OrderState.from_dict(state.get('order')) if settings['order_engine'] else None
+    
+    try:
+        if order is not None and settings['order_extraction'] == 'llm':
+            last_reply = next((m['content'] for m in reversed(state['messages']) if m['role'] == 'assistant'), None)
+            extraction = asyncio.ensure_future(aextract_order_update(order, user_input, last_reply))
         
-        # 检查是否是API错误
-        if 'error' in moderation_result and moderation_result.get('api_error', False):
-            # API调用失败，显示错误信息但不阻止处理
-            error_message = f"⚠️ **审核功能暂时不可用**: {moderation_result['error']}\n\n将跳过审核继续处理。"
-            panels.append(
-                pn.Row('用户:', pn.pane.Markdown(user_input, width=600))
-            )
-            panels.append(
-                pn.Row('系统:', pn.pane.Markdown(
-                    error_message, 
-                    width=600, 
-                    styles={'background-color': '#FFF4E6', 'color': '#CC6600'}
-                ))
-            )
-            # 继续处理，不阻止
-        elif moderation_result.get('flagged', False):
-            # 如果内容被标记为不当，拒绝处理
-            # 获取问题类别
-            categories = moderation_result.get('categories', {})
-            flagged_categories = [k for k, v in categories.items() if v]
-            
-            # 显示警告信息
-            warning_message = "⚠️ **警告**: 您的输入包含不当内容，无法处理。"
-            if flagged_categories:
-                warning_message += f"\n\n问题类别: {', '.join(flagged_categories)}"
+        # 先检查是否支持OpenAI，如果支持则进行内容审核
+        # 审核服务会缓存结论，并把多个会话的并发请求合并为一次批量调用
+        if check_openai_support():
+            moderation = asyncio.ensure_future(get_moderation_service().amoderate(user_input))
+        
+        # 本轮发送给模型的消息：按token预算裁剪后的对话历史（审核通过前不修改对话历史）
+        request_messages = await context_window.abuild(
+            conversation + [{'role': 'user', 'content': user_input}]
+        )
+        
+        # 更新订单（审核未通过或回复失败时不保存）；模型提取失败时退回本地规则
+        # llm 模式在这里等待提取请求返回，回复（包括提前生成的回复）在此之后才开始
+        if order is not None:
+            update = await extraction if extraction is not None else None
+            if update is not None:
+                order.apply_update(update)
+            else:
+                order.apply(user_input)
+            message = order_message(order)
+            if message is not None:
+                request_messages.insert(-1, message)
+        TURN_SECONDS.observe(time.perf_counter() - started, 'context')
+        
+        if moderation is not None:
+            if settings['speculative_completion']:
+                # 审核进行的同时提前开始生成回复
+                completion = PendingCompletion(request_messages, temperature=0.7, max_tokens=500)
             
-            panels.append(
-                pn.Row('用户:', pn.pane.Markdown(user_input, width=600))
-            )
-            panels.append(
-                pn.Row('系统:', pn.pane.Markdown(
-                    warning_message, 
-                    width=600, 
-                    styles={'background-color': '#FFE6E6', 'color': '#CC0000'}
-                ))
-            )
+            moderation_result = await moderation
+            TURN_SECONDS.observe(time.perf_counter() - started, 'moderation')
             
-            # 清空输入框
-            inp.value = ''
-            return pn.Column(*panels)
+            # 检查是否是API错误
+            if 'error' in moderation_result and moderation_result.get('api_error', False):
+                # API调用失败，显示错误信息但不阻止处理
+                error_message = f"⚠️ **审核功能暂时不可用**: {moderation_result['error']}\n\n将跳过审核继续处理。"
+                transcript.append(
+                    pn.Row('用户:', pn.pane.Markdown(user_input, width=600)),
+                    pn.Row('系统:', pn.pane.Markdown(
+                        error_message, 
+                        width=600, 
+                        styles={'background-color': '#FFF4E6', 'color': '#CC6600'}
+                    ))
+                )
+                # 继续处理，不阻止
+            elif moderation_result.get('flagged', False):
+                # 如果内容被标记为不当，拒绝处理，并丢弃提前生成的回复
+                if completion is not None:
+                    completion.cancel()
+                
+                # 获取问题类别
+                categories = moderation_result.get('categories', {})
+                flagged_categories = [k for k, v in categories.items() if v]
+                
+                # 显示警告信息
+                warning_message = "⚠️ **警告**: 您的输入包含不当内容，无法处理。"
+                if flagged_categories:
+                    warning_message += f"\n\n问题类别: {', '.join(flagged_categories)}"
+                
+                transcript.append(
+                    pn.Row('用户:', pn.pane.Markdown(user_input, width=600)),
+                    pn.Row('系统:', pn.pane.Markdown(
+                        warning_message, 
+                        width=600, 
+                        styles={'background-color': '#FFE6E6', 'color': '#CC0000'}
+                    ))
+                )
+                
+                # 清空输入框
+                inp.value = ''
+                yield transcript.view
+                return
+        
+        if completion is None:
+            completion = PendingCompletion(request_messages, temperature=0.7, max_tokens=500)
+        
+        # 先显示用户消息和空的回复框
+        reply_pane = pn.pane.Markdown('', width=600, styles={'background-color': '#F6F6F6'})
+        transcript.append(
+            pn.Row('用户:', pn.pane.Markdown(user_input, width=600)),
+            pn.Row('助手:', reply_pane)
+        )
+        
+        # 清空输入框
+        inp.value = ''
+        
+        yield transcript.view
+        
+        # 流式获取AI回复（包括审核期间已生成的部分），逐段更新回复框
+        response = ''
+        try:
+            async for chunk in completion:
+                if not response:
+                    TURN_SECONDS.observe(time.perf_counter() - started, 'first_token')
+                response += chunk
+                reply_pane.object = response
+                yield transcript.view
+        except APIError as e:
+            # 重试和切换提供商后仍然失败：作为系统提示显示，不当作助手的回复，也不记入对话历史
+            transcript.replace_last(pn.Row('系统:', pn.pane.Markdown(
+                f"⚠️ **服务暂时不可用**: {e}\n\n请稍后重新发送。",
+                width=600,
+                styles={'background-color': '#FFF4E6', 'color': '#CC6600'}
+            )))
+            yield transcript.view
+            return
+        
+        # 添加本轮的用户消息和AI回复到对话历史，保存到会话存储
+        state['messages'].append({'role': 'user', 'content': user_input})
+        state['messages'].append({'role': 'assistant', 'content': response})
+        state.update(context_window.export_state())
+        if order is not None:
+            state['order'] = order.to_dict()
+            if order_pane is not None:
+                order_pane.object = order.summary()
+        session_store.save(session_id, state)
+        TURN_SECONDS.observe(time.perf_counter() - started, 'total')
+    finally:
+        # 任务被取消（如会话销毁）时，一并取消后台的审核和回复生成
+        if moderation is not None:
+            moderation.cancel()
+        if extraction is not None:
+            extraction.cancel()
+        if completion is not None:
+            completion.cancel()
+
+
+def _current_session_id():
+    """
+    当前浏览器会话的ID
     
-    # 添加用户消息到对话历史
-    conversation.append({'role': 'user', 'content': user_input})
+    优先使用URL参数 ?session=...（便于会话在多个服务进程之间迁移），
+    其次使用Panel的会话ID，都没有时生成一个新的ID。
+    """
+    import panel as pn
+    session_args = pn.state.session_args or {}
+    if session_args.get('session'):
+        return session_args['session'][0].decode('utf-8')
+    curdoc = pn.state.curdoc
+    if curdoc is not None and curdoc.session_context is not None:
+        return curdoc.session_context.id
+    return uuid.uuid4().hex
+
+
+def create_app():
+    """
+    创建订餐机器人的界面
     
-    # 获取AI回复
-    response = get_completion_from_messages(conversation, temperature=0.7, max_tokens=500)
+    每个浏览器会话调用一次，输入框和对话显示内容都属于该会话，
+    对话历史保存在会话存储中。
     
-    # 添加AI回复到对话历史
-    conversation.append({'role': 'assistant', 'content': response})
+    返回:
+        Panel对象
+    """
+    pn = init_panel()
+    from transcript import Transcript
     
-    # 更新显示面板
-    panels.append(
-        pn.Row('用户:', pn.pane.Markdown(user_input, width=600))
+    session_id = _current_session_id()
+    # 对话记录：固定放在页面中，每轮只追加新消息
+    transcript = Transcript(width=700)
+    
+    # 创建输入框
+    inp = pn.widgets.TextInput(
+        value="", 
+        placeholder='请输入您的消息...',
+        width=600
     )
-    panels.append(
-        pn.Row('助手:', pn.pane.Markdown(response, width=600, styles={'background-color': '#F6F6F6'}))
+    
+    # 创建聊天按钮
+    button_conversation = pn.widgets.Button(
+        name="发送",
+        button_type="primary",
+        width=100
     )
     
-    # 清空输入框
-    inp.value = ''
+    # 当前订单（启用订单引擎时显示，会话恢复时显示已保存的订单）
+    order_pane = None
+    if get_settings()['order_engine']:
+        saved_order = OrderState.from_dict(get_session_store().load(session_id).get('order'))
+        order_pane = pn.pane.Markdown(
+            saved_order.summary(), width=600, styles={'background-color': '#EEF6EE', 'white-space': 'pre-wrap'}
+        )
     
-    return pn.Column(*panels)
-
-
-# 创建输入框
-inp = pn.widgets.TextInput(
-    value="", 
-    placeholder='请输入您的消息...',
-    width=600
-)
-
-# 创建聊天按钮
-button_conversation = pn.widgets.Button(
-    name="发送",
-    button_type="primary",
-    width=100
-)
-
-# 绑定按钮点击事件
-interactive_conversation = pn.bind(collect_messages, button_conversation)
-
-# 创建主要内容区域
-content = pn.Column(
-    pn.pane.Markdown(
-        "# 🍕 披萨餐厅订餐机器人",
-        styles={'font-size': '24px', 'font-weight': 'bold', 'text-align': 'center'}
-    ),
-    pn.pane.Markdown(
-        "欢迎使用订餐机器人！请输入您的订单需求。" + 
-        ("\n\n✅ 内容审核功能已启用" if check_openai_support() else "\n\nℹ️ 提示: 设置 OPENAI_API_KEY 可启用内容审核功能"),
-        styles={'color': '#666', 'text-align': 'center'}
-    ),
-    pn.Spacer(height=10),
-    inp,
-    pn.Row(button_conversation),
-    pn.Spacer(height=10),
-    pn.panel(interactive_conversation, loading_indicator=True, height=400),
-    width=700
-)
+    # 点击按钮时运行一轮对话；对话记录的组件在原处更新，产出的视图不需要再重新显示
+    # （回复生成期间发送按钮显示加载状态）
+    async def send(event):
+        button_conversation.loading = True
+        try:
+            async for _ in collect_messages(event, inp, transcript, session_id, order_pane):
+                pass
+        finally:
+            button_conversation.loading = False
+    
+    button_conversation.on_click(send)
+    
+    # 创建主要内容区域（CSS已处理居中）
+    content = pn.Column(
+        pn.pane.Markdown(
+            "# 🍕 披萨餐厅订餐机器人",
+            styles={'font-size': '24px', 'font-weight': 'bold', 'text-align': 'center'}
+        ),
+        pn.pane.Markdown(
+            "欢迎使用订餐机器人！请输入您的订单需求。" + 
+            ("\n\n✅ 内容审核功能已启用" if check_openai_support() else "\n\nℹ️ 提示: 设置 OPENAI_API_KEY 可启用内容审核功能"),
+            styles={'color': '#666', 'text-align': 'center'}
+        ),
+        pn.Spacer(height=10),
+        inp,
+        pn.Row(button_conversation),
+        pn.Spacer(height=10),
+        transcript.view,
+        *([order_pane] if order_pane is not None else []),
+        width=700
+    )
+    return content
 
-# 创建仪表板，直接使用content（CSS已处理居中）
-dashboard = content
 
-# 显示仪表板
-dashboard.servable()
+# 通过 panel serve pizza_bot.py 运行时，每个会话都会重新执行本文件
+if __name__.startswith('bokeh'):
+    create_app().servable()
 
 # 如果直接运行此文件，启动服务器
 if __name__ == "__main__":
@@ -230,5 +516,13 @@ if __name__ == "__main__":
     print("\n提示: 按 Ctrl+C 停止服务器")
     print("=" * 60)
     
-    # 启动Panel服务器
-    dashboard.show()
+    # 设置 METRICS_ENDPOINT=1 时，在同一个服务上挂载 Prometheus 格式的 /metrics 接口
+    # （用 panel serve 运行时改为 --plugins metrics_plugin）
+    extra_patterns = []
+    if getenv('METRICS_ENDPOINT', '0') != '0':
+        from metrics_plugin import ROUTES
+        extra_patterns.extend(ROUTES)
+    
+    # 启动Panel服务器，每个浏览器会话调用一次 create_app
+    import panel as pn
+    pn.serve(create_app, show=True, extra_patterns=extra_patterns)
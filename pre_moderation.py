@@ -0,0 +1,255 @@
+"""
+本地预审核
+在调用远程审核API之前，先用本地规则判断明显安全和明显违规的输入：
+- 违规词表（中英文）和白名单词表编译为一个多模式匹配自动机（Aho-Corasick），一次扫描找出所有匹配
+- 命中违规词表：直接判定为违规，categories 为词表对应的类别
+- 全部内容都被白名单（菜单中的菜品、配料、饮料、尺寸，以及点餐常用词）覆盖：直接判定为安全
+- 其他情况无法确定，仍然交给远程审核API
+
+判定结果的格式与 moderation_create(单个字符串) 相同。本地判定只需要几微秒，
+“大号芝士披萨”“加蘑菇”“外送”这类点餐消息不再需要一次网络往返。
+
+违规词表只收录含义明确、几乎不会出现在正常点餐对话中的词语，宁可漏判（交给远程API）也不误判。
+"""
+import threading
+import unicodedata
+from collections import deque
+
+from menu import get_menu
+
+# 与 omni-moderation-latest 相同的审核类别
+CATEGORIES = (
+    'harassment', 'harassment/threatening', 'hate', 'hate/threatening', 'illicit', 'illicit/violent',
+    'self-harm', 'self-harm/intent', 'self-harm/instructions', 'sexual', 'sexual/minors',
+    'violence', 'violence/graphic',
+)
+
+# 本地判定结果中的模型名称
+MODEL = 'local-pre-moderation'
+
+# 违规词表：{类别: 词语}
+BLOCKLIST = {
+    'harassment': (
+        '傻逼', '傻屄', '煞笔', '沙比', '脑残', '操你妈', '草泥马', '你妈的', '去你妈', '妈的智障', '贱人',
+        'fuck you', 'fuck off', 'motherfucker', 'son of a bitch', 'asshole', 'dickhead', 'stupid bitch',
+    ),
+    'harassment/threatening': (
+        '杀了你', '弄死你', '砍死你', '打死你', '我要杀你', '杀你全家',
+        'kill you', "i'll kill you", 'i will kill you',
+    ),
+    'hate': ('支那', '黑鬼', 'nigger', 'chink', 'faggot'),
+    'illicit/violent': ('制造炸弹', '做炸弹', '自制炸弹', 'make a bomb', 'build a bomb'),
+    'self-harm': ('自杀', '割腕', 'suicide'),
+    'self-harm/intent': ('我想自杀', '我要自杀', '不想活了', 'kill myself', 'i want to die'),
+    'self-harm/instructions': ('怎么自杀', '如何自杀', 'how to kill myself'),
+    'sexual': ('色情', '做爱', '约炮', 'porn', 'blowjob'),
+    'sexual/minors': ('儿童色情', '幼女色情', 'child porn'),
+    'violence': ('砍人', '捅死', '杀人', 'stab him', 'shoot him'),
+}
+
+# 点餐对话中的常用词（菜单词汇在创建时从菜单中读取）
+ORDER_VOCABULARY = (
+    # 问候和礼貌用语
+    '你好', '您好', '嗨', '哈喽', '喂', '在吗', '谢谢', '多谢', '谢了', '再见', '拜拜', '请', '麻烦', '请问',
+    # 点餐
+    '我', '我们', '你', '你们', '要', '想要', '想', '来', '再', '还', '还要', '也', '和', '跟', '以及', '另外',
+    '加', '不加', '不要', '去掉', '取消', '换成', '改成', '帮我', '给我', '点餐', '点', '下单', '订单', '订',
+    '一个', '一份', '个', '份', '杯', '瓶', '听', '块', '盒', '号', '大号', '中号', '小号', '尺寸',
+    '一', '两', '二', '三', '四', '五', '六', '七', '八', '九', '十',
+    '披萨', '饮料', '配料', '小料', '菜单', '有什么', '有哪些', '什么', '哪些', '推荐', '今天', '都', '所有',
+    # 确认和结束
+    '的', '了', '吧', '吗', '呢', '啊', '呀', '哦', '嗯', '好', '好的', '可以', '行', '是', '是的', '对', '对的',
+    '没有', '没有了', '没了', '不用', '不用了', '就这些', '就这样', '够了', '确认', '没问题', '就',
+    # 取餐和付款
+    '外送', '外卖', '送餐', '配送', '自取', '到店', '自己取', '堂食', '多少钱', '一共', '总共', '价格', '价钱', '钱',
+    # English
+    'hello', 'hi', 'hey', 'thanks', 'thank you', 'please', 'yes', 'no', 'ok', 'okay', 'sure', 'bye',
+    'i', "i'd", 'we', 'want', 'would like', 'like', 'a', 'an', 'one', 'two', 'three', 'and', 'with', 'of',
+    'pizza', 'pizzas', 'large', 'medium', 'small', 'delivery', 'pickup', 'menu', 'how much', 'that is all',
+)
+
+_BLOCK, _ALLOW = 'block', 'allow'
+
+
+def normalize(text):
+    """规范化文本：Unicode NFKC规范化、转小写、合并连续空白"""
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+def _ignorable(char):
+    """不影响判定的字符：空白、标点、数字"""
+    return char.isspace() or char.isdigit() or unicodedata.category(char).startswith('P')
+
+
+def _is_word_char(char):
+    return char.isascii() and char.isalnum()
+
+
+class Automaton:
+    """
+    多模式字符串匹配自动机（Aho-Corasick）
+
+    构建后扫描一遍文本即可找出所有模式的所有出现位置，耗时与文本长度和匹配数量成正比，
+    与模式数量无关。
+
+    参数:
+        patterns: [(模式, 值), ...]，值在匹配时原样返回
+    """
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for pattern, value in patterns:
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._output[state] += ((len(pattern), value),)
+
+        # 按广度优先计算失败指针，并把失败指针指向状态的输出合并进来
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                self._output[next_state] += self._output[fail]
+
+    def __len__(self):
+        return len(self._goto)
+
+    def finditer(self, text):
+        """
+        查找文本中所有模式的出现位置（包括重叠的匹配）
+
+        产出:
+            (起始位置, 结束位置, 值)，按结束位置排列
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in output[state]:
+                yield index + 1 - length, index + 1, value
+
+
+def _result(categories_hit):
+    """构造与 moderation_create(单个字符串) 相同格式的结果"""
+    single = {
+        'flagged': bool(categories_hit),
+        'categories': {category: category in categories_hit for category in CATEGORIES},
+        'category_scores': {category: 1.0 if category in categories_hit else 0.0 for category in CATEGORIES},
+    }
+    return {
+        'id': None,
+        'model': MODEL,
+        'flagged': single['flagged'],
+        'categories': single['categories'],
+        'category_scores': single['category_scores'],
+        'results': [single],
+    }
+
+
+class PreModerator:
+    """
+    本地预审核器
+
+    参数:
+        blocklist: {类别: 词语列表}，默认为 BLOCKLIST
+        allowlist: 白名单词语，默认为菜单词汇加上 ORDER_VOCABULARY
+        menu: 生成默认白名单使用的菜单，默认为 menu.get_menu()
+    """
+
+    def __init__(self, blocklist=None, allowlist=None, menu=None):
+        if blocklist is None:
+            blocklist = BLOCKLIST
+        if allowlist is None:
+            menu = menu or get_menu()
+            sizes = {size for item in menu.items for size in item.sizes}
+            allowlist = [*menu.names(), *sizes, *ORDER_VOCABULARY]
+        patterns = [(normalize(term), (_BLOCK, category)) for category, terms in blocklist.items() for term in terms]
+        patterns += [(normalize(term), (_ALLOW, None)) for term in allowlist]
+        self._automaton = Automaton(patterns)
+        self._lock = threading.Lock()
+        self.safe = 0
+        self.flagged = 0
+        self.undecided = 0
+
+    def classify(self, text):
+        """
+        本地判定一条文本
+
+        返回:
+            与 moderation_create(text) 格式相同的字典（model 为 'local-pre-moderation'）；
+            无法确定时返回None，需要交给远程审核
+        """
+        text = normalize(text)
+        covered = bytearray(len(text))
+        categories_hit = set()
+        for start, end, (kind, category) in self._automaton.finditer(text):
+            # 英文词语要求完整的单词（“hi”不匹配“this”中的片段）
+            if (_is_word_char(text[start]) and start > 0 and _is_word_char(text[start - 1])) or \
+                    (_is_word_char(text[end - 1]) and end < len(text) and _is_word_char(text[end])):
+                continue
+            if kind == _BLOCK:
+                categories_hit.add(category)
+            else:
+                covered[start:end] = b'\x01' * (end - start)
+
+        if categories_hit:
+            decision = 'flagged'
+            result = _result(categories_hit)
+        elif text and all(covered[i] or _ignorable(char) for i, char in enumerate(text)):
+            decision = 'safe'
+            result = _result(())
+        else:
+            decision = 'undecided'
+            result = None
+        with self._lock:
+            setattr(self, decision, getattr(self, decision) + 1)
+        return result
+
+    def stats(self):
+        """
+        获取统计信息
+
+        返回:
+            dict: {'safe': 判定为安全的次数, 'flagged': 判定为违规的次数,
+                   'undecided': 交给远程审核的次数, 'avoided': 省去的远程调用次数}
+        """
+        with self._lock:
+            return {
+                'safe': self.safe,
+                'flagged': self.flagged,
+                'undecided': self.undecided,
+                'avoided': self.safe + self.flagged,
+            }
+
+
+_default_pre_moderator = None
+_default_pre_moderator_lock = threading.Lock()
+
+
+def get_pre_moderator():
+    """获取进程内共享的预审核器（使用默认词表和菜单），首次调用时创建"""
+    global _default_pre_moderator
+    if _default_pre_moderator is None:
+        with _default_pre_moderator_lock:
+            if _default_pre_moderator is None:
+                _default_pre_moderator = PreModerator()
+    return _default_pre_moderator
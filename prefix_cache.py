@@ -0,0 +1,114 @@
+"""
+提供商提示词前缀缓存（context caching）支持
+DeepSeek、OpenAI 等提供商会缓存请求开头相同的部分（如披萨机器人的菜单系统提示词），
+命中缓存的token计费更低、响应更快，但前提是每次请求的前缀完全一致。
+
+本模块负责：
+- 规范化地序列化请求体，保证相同的开头消息总是得到相同的字节
+- 解析 usage 中的缓存命中/未命中token数量
+- 按提供商汇总命中率
+"""
+import json
+import threading
+
+try:
+    # orjson 的默认输出就是紧凑、不转义中文的UTF-8，与下面标准库的参数等价
+    from orjson import dumps as _orjson_dumps
+except ImportError:
+    _orjson_dumps = None
+
+# 消息字段的固定顺序，其余字段按名称排序排在后面
+_MESSAGE_KEY_ORDER = ('role', 'name', 'content', 'tool_calls', 'tool_call_id')
+
+
+def canonical_message(message):
+    """
+    返回字段顺序固定的消息副本（内容不做任何修改）
+    """
+    ordered = {key: message[key] for key in _MESSAGE_KEY_ORDER if key in message}
+    for key in sorted(message):
+        if key not in ordered:
+            ordered[key] = message[key]
+    return ordered
+
+
+def encode_request_body(data):
+    """
+    把请求体编码为稳定的JSON字节串
+
+    消息字段顺序固定、不转义中文、不含多余空白，相同的消息前缀总是得到相同的字节。
+
+    参数:
+        data: 请求体字典
+
+    返回:
+        bytes: UTF-8编码的JSON
+    """
+    if 'messages' in data:
+        data = dict(data, messages=[canonical_message(m) for m in data['messages']])
+    if _orjson_dumps is not None:
+        return _orjson_dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def parse_cache_usage(usage):
+    """
+    从API返回的 usage 中解析提示词缓存的命中情况
+
+    支持 DeepSeek 的 prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+    以及 OpenAI 的 prompt_tokens_details.cached_tokens。
+
+    返回:
+        (命中的token数量, 未命中的token数量)；usage中没有缓存信息时返回None
+    """
+    if not usage:
+        return None
+    if 'prompt_cache_hit_tokens' in usage:
+        return usage.get('prompt_cache_hit_tokens') or 0, usage.get('prompt_cache_miss_tokens') or 0
+    details = usage.get('prompt_tokens_details') or {}
+    if 'cached_tokens' in details:
+        cached = details.get('cached_tokens') or 0
+        return cached, max((usage.get('prompt_tokens') or 0) - cached, 0)
+    return None
+
+
+class PrefixCacheStats:
+    """
+    按提供商汇总提示词缓存的命中情况
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers = {}
+
+    def record(self, provider, usage):
+        """
+        记录一次请求的 usage（没有缓存信息时忽略）
+        """
+        parsed = parse_cache_usage(usage)
+        if parsed is None:
+            return
+        hit, miss = parsed
+        with self._lock:
+            stats = self._providers.setdefault(provider, {'requests': 0, 'hit_tokens': 0, 'miss_tokens': 0})
+            stats['requests'] += 1
+            stats['hit_tokens'] += hit
+            stats['miss_tokens'] += miss
+
+    def snapshot(self):
+        """
+        返回:
+            dict: {提供商: {'requests': 请求数, 'hit_tokens': 命中token数,
+                           'miss_tokens': 未命中token数, 'hit_rate': 按token计算的命中率}}
+        """
+        with self._lock:
+            result = {}
+            for provider, stats in self._providers.items():
+                total = stats['hit_tokens'] + stats['miss_tokens']
+                result[provider] = dict(stats, hit_rate=stats['hit_tokens'] / total if total else 0.0)
+            return result
+
+    def reset(self):
+        """清空统计"""
+        with self._lock:
+            self._providers.clear()
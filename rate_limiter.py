@@ -0,0 +1,304 @@
+"""
+客户端限流与请求调度
+高峰期每个用户的请求都会立即发出，很容易超过提供商的 RPM（每分钟请求数）/TPM（每分钟token数）
+限额，引发大量429。RateLimiter 在本地按令牌桶算法控制发送速度：
+- 每个提供商 + API密钥一个限流器，同时限制请求数和token数
+- 优先级队列：交互式请求（披萨机器人的对话）排在批量任务（练习脚本等）前面
+- 同步和异步调用共用同一个限流器，异步等待不阻塞事件循环
+- 收到429时暂停该限流器，避免所有排队的请求一起撞上限额
+"""
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from env_loader import getenv
+
+# 请求优先级：数值越小越先发送
+INTERACTIVE = 0
+BATCH = 1
+_PRIORITY_NAMES = {INTERACTIVE: 'interactive', BATCH: 'batch'}
+
+# 当前请求的优先级，默认按批量任务处理；交互式场景（如披萨机器人）需要显式设置
+request_priority = contextvars.ContextVar('request_priority', default=BATCH)
+
+
+@contextmanager
+def priority(level):
+    """
+    在 with 代码块内使用指定的请求优先级
+
+    示例:
+        with priority(INTERACTIVE):
+            reply = get_completion_from_messages(messages)
+    """
+    token = request_priority.set(level)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class _Bucket:
+    """令牌桶：按 limit/60 每秒的速度补充，最多积累 capacity 个"""
+
+    def __init__(self, limit, burst_seconds):
+        self.limit = limit
+        self.rate = limit / 60.0
+        self.capacity = max(limit * burst_seconds / 60.0, 1.0)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """还需要等待多久（秒）才能取出 amount 个令牌"""
+        # 单个请求超过桶容量时，等桶满即可发送，否则永远无法发送
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def drain(self):
+        self.level = 0.0
+
+
+class _Waiter:
+    __slots__ = ('priority', 'tokens', 'wake', 'enqueued_at')
+
+    def __init__(self, priority, tokens, wake):
+        self.priority = priority
+        self.tokens = tokens
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+
+
+class RateLimiter:
+    """
+    同时限制请求数和token数的令牌桶限流器，按优先级排队
+
+    同一优先级内先到先得；只有队首的请求可以取令牌，所以批量任务不会抢在
+    排队中的交互式请求之前发送。
+
+    参数:
+        rpm: 每分钟最多请求数，为None时不限制
+        tpm: 每分钟最多token数，为None时不限制
+        burst_seconds: 空闲后最多允许一次性发送多少秒的额度（令牌桶容量）
+    """
+
+    def __init__(self, rpm=None, tpm=None, burst_seconds=6.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = _Bucket(rpm, burst_seconds) if rpm else None
+        self._tokens = _Bucket(tpm, burst_seconds) if tpm else None
+        self._lock = threading.Lock()
+        self._queue = []  # (优先级, 序号, _Waiter)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+
+        self._acquired = 0
+        self._delayed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._throttled = 0
+
+    def _enqueue(self, waiter):
+        with self._lock:
+            heapq.heappush(self._queue, (waiter.priority, next(self._seq), waiter))
+
+    def _remove(self, waiter):
+        """等待被取消时把请求移出队列，并唤醒新的队首"""
+        with self._lock:
+            was_head = bool(self._queue) and self._queue[0][2] is waiter
+            self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+            heapq.heapify(self._queue)
+            if was_head and self._queue:
+                self._queue[0][2].wake()
+
+    def _poll(self, waiter):
+        """
+        尝试为 waiter 取令牌
+
+        返回:
+            0: 已取得令牌；正数: 队首还需要等待的秒数；None: 不在队首，等待被唤醒
+        """
+        with self._lock:
+            if self._queue[0][2] is not waiter:
+                return None
+            now = time.monotonic()
+            wait = self._paused_until - now
+            for bucket, amount in ((self._requests, 1), (self._tokens, waiter.tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+
+            for bucket, amount in ((self._requests, 1), (self._tokens, waiter.tokens)):
+                if bucket is not None:
+                    bucket.take(amount)
+            heapq.heappop(self._queue)
+            if self._queue:
+                self._queue[0][2].wake()
+
+            waited = now - waiter.enqueued_at
+            self._acquired += 1
+            self._total_wait += waited
+            if waited > 0.001:
+                self._delayed += 1
+            self._max_wait = max(self._max_wait, waited)
+            return 0
+
+    def acquire(self, tokens=0, priority=None):
+        """
+        阻塞直到可以发送一个消耗 tokens 个token的请求
+
+        参数:
+            tokens: 本次请求预计消耗的token数量（提示词 + 回复上限）
+            priority: 请求优先级，为None时使用 request_priority 的当前值
+
+        返回:
+            float: 排队等待的秒数
+        """
+        event = threading.Event()
+        waiter = _Waiter(request_priority.get() if priority is None else priority, tokens, event.set)
+        self._enqueue(waiter)
+        try:
+            while True:
+                event.clear()
+                wait = self._poll(waiter)
+                if wait == 0:
+                    return time.monotonic() - waiter.enqueued_at
+                event.wait(wait)
+        except BaseException:
+            self._remove(waiter)
+            raise
+
+    async def aacquire(self, tokens=0, priority=None):
+        """
+        acquire 的异步版本，等待时不阻塞事件循环；任务被取消时会退出队列
+        """
+        import asyncio  # 只在异步代码中使用，此时已经导入，同步脚本不需要加载
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake():
+            # 唤醒可能来自其他线程（同步调用方）
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass
+
+        waiter = _Waiter(request_priority.get() if priority is None else priority, tokens, wake)
+        self._enqueue(waiter)
+        try:
+            while True:
+                event.clear()
+                wait = self._poll(waiter)
+                if wait == 0:
+                    return time.monotonic() - waiter.enqueued_at
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._remove(waiter)
+            raise
+
+    def pause(self, seconds):
+        """
+        收到429后暂停发送 seconds 秒，并清空令牌桶，恢复后按配额的速度重新开始
+        """
+        with self._lock:
+            self._throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            for bucket in (self._requests, self._tokens):
+                if bucket is not None:
+                    bucket.drain()
+
+    def stats(self):
+        """
+        获取限流统计信息
+
+        返回:
+            dict: {'rpm', 'tpm': 配额, 'queued': {优先级: 排队数量},
+                   'requests': 已发送请求数, 'delayed': 需要排队的请求数,
+                   'avg_wait', 'max_wait': 平均/最长排队秒数, 'throttled': 收到429的次数}
+        """
+        with self._lock:
+            queued = {name: 0 for name in _PRIORITY_NAMES.values()}
+            for level, _, _ in self._queue:
+                name = _PRIORITY_NAMES.get(level, str(level))
+                queued[name] = queued.get(name, 0) + 1
+            return {
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'queued': queued,
+                'requests': self._acquired,
+                'delayed': self._delayed,
+                'avg_wait': self._total_wait / self._acquired if self._acquired else 0.0,
+                'max_wait': self._max_wait,
+                'throttled': self._throttled,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _read_limit(name):
+    value = getenv(name)
+    return int(value) if value else None
+
+
+def get_rate_limiter(provider, api_key):
+    """
+    获取指定提供商和API密钥的限流器（进程内共享）；该提供商未配置限额时返回None
+
+    环境变量配置:
+        {PROVIDER}_RPM: 每分钟最多请求数，例如 OPENAI_RPM=500（默认: 不限制）
+        {PROVIDER}_TPM: 每分钟最多token数，例如 OPENAI_TPM=200000（默认: 不限制）
+        RATE_LIMIT_BURST_SECONDS: 空闲后最多允许一次性发送多少秒的额度（默认: 6）
+    """
+    key = (provider, api_key)
+    if key in _limiters:
+        return _limiters[key]
+    with _limiters_lock:
+        if key not in _limiters:
+            prefix = provider.upper()
+            rpm = _read_limit(f'{prefix}_RPM')
+            tpm = _read_limit(f'{prefix}_TPM')
+            limiter = None
+            if rpm or tpm:
+                limiter = RateLimiter(
+                    rpm=rpm, tpm=tpm,
+                    burst_seconds=float(getenv('RATE_LIMIT_BURST_SECONDS', '6')),
+                )
+            _limiters[key] = limiter
+        return _limiters[key]
+
+
+def get_rate_limit_stats():
+    """
+    获取所有限流器的统计信息
+
+    返回:
+        dict: {提供商: RateLimiter.stats()}，同一提供商有多个API密钥时按密钥末尾4位区分
+    """
+    with _limiters_lock:
+        items = [(key, limiter) for key, limiter in _limiters.items() if limiter is not None]
+    providers = [provider for (provider, _), _ in items]
+    result = {}
+    for (provider, api_key), limiter in items:
+        name = provider
+        if providers.count(provider) > 1:
+            name = f"{provider}:...{(api_key or '')[-4:]}"
+        result[name] = limiter.stats()
+    return result
@@ -0,0 +1,169 @@
+"""
+API调用的容错机制
+- 重试：对临时性错误（网络错误、超时、429、5xx）按带随机抖动的指数退避重试，遵守 Retry-After
+- 熔断：每个提供商一个熔断器，连续失败达到阈值后暂时不再请求该提供商，直接切换到备用提供商
+"""
+import time
+import random
+import threading
+
+from env_loader import getenv
+
+# 可以重试的HTTP状态码
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# 换一个提供商可能成功的HTTP状态码（除可重试的之外，还包括密钥无效/无权限）
+FAILOVER_STATUS = RETRYABLE_STATUS | {401, 403}
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，本次请求未发送"""
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头（秒数或HTTP日期）
+
+    返回:
+        需要等待的秒数；无法解析时返回None
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime  # HTTP日期格式很少见，用到时才导入
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    重试策略：带随机抖动（full jitter）的指数退避
+
+    参数:
+        max_retries: 最多重试次数（不含第一次请求）
+        base_delay: 第一次重试的基础等待时间（秒）
+        max_delay: 单次等待时间上限（秒），Retry-After 也不会超过这个值
+    """
+
+    def __init__(self, max_retries=2, base_delay=0.5, max_delay=8.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """
+        第 attempt 次重试前需要等待的时间（秒），attempt从0开始
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        return min(backoff, self.max_delay)
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    连续失败 failure_threshold 次后打开，recovery_timeout 秒内拒绝所有请求；
+    之后进入半开状态，只放行一个试探请求，成功则关闭，失败则重新打开。
+
+    参数:
+        failure_threshold: 连续失败多少次后打开
+        recovery_timeout: 打开后多久（秒）允许试探请求
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        当前是否允许发送请求
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            # 半开状态只放行一个试探请求
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """
+        请求没有结果就结束了（如被取消）：归还试探名额，不改变状态，下一个请求可以重新试探
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider):
+    """
+    获取指定提供商的熔断器（进程内共享）
+
+    环境变量配置:
+        CIRCUIT_FAILURE_THRESHOLD: 连续失败多少次后熔断（默认: 5）
+        CIRCUIT_RECOVERY_TIMEOUT: 熔断后多久（秒）允许试探请求（默认: 30）
+    """
+    breaker = _breakers.get(provider)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(provider)
+            if breaker is None:
+                breaker = _breakers[provider] = CircuitBreaker(
+                    failure_threshold=int(getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+                    recovery_timeout=float(getenv('CIRCUIT_RECOVERY_TIMEOUT', '30')),
+                )
+    return breaker
+
+
+def get_retry_policy():
+    """
+    根据环境变量创建重试策略
+
+    环境变量配置:
+        API_MAX_RETRIES: 最多重试次数（默认: 2）
+        API_RETRY_BASE_DELAY: 基础等待时间秒数（默认: 0.5）
+        API_RETRY_MAX_DELAY: 单次等待时间上限秒数（默认: 8）
+    """
+    return RetryPolicy(
+        max_retries=int(getenv('API_MAX_RETRIES', '2')),
+        base_delay=float(getenv('API_RETRY_BASE_DELAY', '0.5')),
+        max_delay=float(getenv('API_RETRY_MAX_DELAY', '8')),
+    )
@@ -0,0 +1,397 @@
+"""
+语义回复缓存
+顾客会用很多种说法问同一个问题（“有什么披萨”“你们有哪些披萨”“披萨有哪几种”），
+精确匹配的回复缓存（completion_cache.py）无法命中。语义缓存把最新一条用户消息转换为向量，
+在之前的问题中查找最相似的一条，相似度超过阈值时直接返回之前的回复。
+
+- 只用于无状态的请求：除系统提示词外只有一条用户消息（没有之前的对话）。
+  提供商、模型、回复长度和系统提示词都相同的请求才会互相命中
+- 向量保存在预先分配的 NumPy 矩阵中，查询是一次矩阵乘法加 top-k 选择
+- 条目按TTL过期，数量达到上限时淘汰最久未命中的条目
+- 持久化为目录中的 vectors.npy（向量）和 meta.json（问题、回复等），
+  启动时以内存映射方式打开，不需要把向量全部读入内存
+
+默认使用基于字符n-gram哈希的向量（只依赖NumPy，不需要下载模型）。它只比较字面，不理解语义：
+“有什么披萨”与“你们有哪些披萨”的相似度只有约0.15，而只差一个字的问题相似度可能超过0.9
+（“中号意式辣香肠披萨多少钱”与“大号意式辣香肠披萨多少钱”为0.904）。
+因此相似度达到阈值后还要经过 details_match 检查：两个问题中的数字、尺寸（大/中/小）
+以及提到的菜单项和配料（menu.py）必须完全相同，否则不算命中。
+要命中用词不同的同义问题，需要安装 sentence-transformers 并通过 model（SEMANTIC_CACHE_MODEL）
+指定本地的语义模型（只使用CPU）。
+"""
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import threading
+import unicodedata
+
+import numpy as np
+
+from menu import get_menu
+
+_PUNCTUATION = re.compile(r'[\s\W_]+', re.UNICODE)
+# 不影响问题含义的客套话和语气词，去掉后“你们有什么披萨啊？”与“有什么披萨”完全相同
+_FILLERS = re.compile(r'请问|麻烦|你好|您好|你们|您们|我想问|想问|一下|啊|呀|吗|呢|吧|哦|嘛|呐|哈')
+_NUMBERS = re.compile(r'\d+(?:\.\d+)?|[一两二三四五六七八九十百]+')
+_SIZES = re.compile(r'[大中小]')
+
+
+def normalize_query(text):
+    """规范化问题文本：Unicode NFKC规范化、转小写、去掉标点、空白和语气词"""
+    text = _PUNCTUATION.sub('', unicodedata.normalize('NFKC', text).lower())
+    return _FILLERS.sub('', text) or text
+
+
+def numbers_match(query, cached_query):
+    """
+    默认的命中检查：两个问题中的数字（包括中文数字）必须完全相同
+
+    “两个披萨多少钱”和“三个披萨多少钱”的向量非常接近，但答案不同。
+    """
+    return sorted(_NUMBERS.findall(query)) == sorted(_NUMBERS.findall(cached_query))
+
+
+def _details(query):
+    """问题中决定答案的细节: (数字, 尺寸, 菜单项)"""
+    menu = get_menu()
+    return (
+        sorted(_NUMBERS.findall(query)),
+        sorted(_SIZES.findall(query)),
+        sorted(item.name for _, _, item in menu.scan(query)),
+    )
+
+
+def details_match(query, cached_query):
+    """
+    默认的命中检查：两个问题中的数字、尺寸（大/中/小）和提到的菜单项、配料都必须相同
+
+    “中号意式辣香肠披萨多少钱”和“大号意式辣香肠披萨多少钱”、“芝士披萨多少钱”和
+    “茄子披萨多少钱”的字面非常接近，但答案不同。别名按菜单项比较（“矿泉水”与“瓶装水”相同）。
+    """
+    return _details(query) == _details(cached_query)
+
+
+class HashingEmbedder:
+    """
+    字符n-gram哈希向量：把文本的1-3字符片段哈希到固定维度，带符号累加后归一化
+
+    不需要训练或下载模型，同一文本在不同进程中得到相同的向量。相似度反映的是字面重合程度，
+    不是语义：措辞稍有不同（如多一个“的”）相似度就会低于0.9，用词不同的同义问题接近0。
+
+    参数:
+        dim: 向量维度
+        ngrams: 使用的片段长度
+    """
+
+    def __init__(self, dim=512, ngrams=(1, 2, 3)):
+        self.dim = dim
+        self.ngrams = tuple(ngrams)
+        self.id = f"hashing-{dim}-{''.join(map(str, self.ngrams))}"
+
+    def embed(self, text):
+        text = normalize_query(text)
+        hashes, weights = [], []
+        for n in self.ngrams:
+            for i in range(len(text) - n + 1):
+                hashes.append(zlib.crc32(text[i:i + n].encode('utf-8')))
+                weights.append(float(n))  # 较长的片段更能区分语义
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if hashes:
+            hashes = np.array(hashes, dtype=np.uint32)
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+            vector = np.bincount(hashes % self.dim, weights=signs * np.array(weights),
+                                 minlength=self.dim).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+class SentenceTransformerEmbedder:
+    """
+    使用 sentence-transformers 的本地语义模型（只使用CPU），需要安装 sentence-transformers
+
+    参数:
+        model_name: 模型名称或本地路径，例如 'BAAI/bge-small-zh-v1.5'
+    """
+
+    def __init__(self, model_name):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("使用语义模型需要先安装 sentence-transformers: pip install sentence-transformers") from e
+        self._model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self._model.get_sentence_embedding_dimension()
+        self.id = f"st-{model_name}"
+
+    def embed(self, text):
+        return self._model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+
+def make_embedder(model='hashing'):
+    """根据名称创建向量模型：'hashing'（默认）或 sentence-transformers 的模型名称"""
+    if model in (None, '', 'hashing'):
+        return HashingEmbedder()
+    return SentenceTransformerEmbedder(model)
+
+
+def stateless_query(messages):
+    """
+    判断请求是否无状态，是则返回其中的用户问题，否则返回None
+
+    无状态：只有系统消息和一条文本用户消息（没有之前的对话、工具调用等）。
+    """
+    query = None
+    for message in messages:
+        role = message.get('role')
+        if role == 'system':
+            continue
+        if role != 'user' or query is not None or not isinstance(message.get('content'), str):
+            return None
+        query = message['content']
+    return query if query and query.strip() else None
+
+
+def _namespace(provider, model, max_tokens, messages):
+    system = [m.get('content') for m in messages if m.get('role') == 'system']
+    canonical = json.dumps([provider, model, max_tokens, system], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class _Probe:
+    """一次查询的结果，未命中时用于写入（避免重复计算向量）"""
+
+    __slots__ = ('namespace', 'query', 'vector')
+
+    def __init__(self, namespace, query, vector):
+        self.namespace = namespace
+        self.query = query
+        self.vector = vector
+
+
+class SemanticCache:
+    """
+    语义回复缓存
+
+    参数:
+        embedder: 向量模型，默认为 HashingEmbedder
+        threshold: 余弦相似度阈值，达到才算命中
+        max_size: 最多保存的条目数量，达到后淘汰最久未命中的条目
+        ttl: 条目存活时间（秒），为None时永不过期
+        path: 持久化目录，为None时只保存在内存中
+        top_k: 每次查询检查的最相似条目数量
+        guard: guard(问题, 缓存的问题) -> bool，相似度达到阈值后的额外检查，
+               默认为 details_match（数字、尺寸、菜单项都相同）
+    """
+
+    def __init__(self, embedder=None, threshold=0.9, max_size=2048, ttl=86400, path=None,
+                 top_k=4, guard=details_match):
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.top_k = top_k
+        self.guard = guard
+        self._lock = threading.Lock()
+
+        dim = self.embedder.dim
+        self._vectors = np.zeros((max_size, dim), dtype=np.float32)
+        self._namespace_of = np.full(max_size, -1, dtype=np.int32)
+        self._expires = np.full(max_size, np.inf)
+        self._last_used = np.zeros(max_size)
+        self._entries = []          # 与向量矩阵的行一一对应: {'query', 'content', 'usage'}
+        self._namespaces = {}       # 命名空间哈希 -> 编号
+        self._mapped = False        # 向量矩阵是否仍是只读的内存映射
+        self._dirty = False
+
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evictions = 0
+
+        if path:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, provider, model, messages, max_tokens):
+        """
+        查找语义相似的缓存回复
+
+        返回:
+            (probe, 缓存的值): 请求不是无状态时 probe 为None；未命中时缓存的值为None，
+            命中时为 {'content', 'usage', 'similarity', 'query'}
+        """
+        query = stateless_query(messages)
+        if query is None:
+            with self._lock:
+                self.skipped += 1
+            return None, None
+        probe = _Probe(_namespace(provider, model, max_tokens, messages), query, self.embedder.embed(query))
+        with self._lock:
+            hit = self._search(probe)
+            if hit is None:
+                self.misses += 1
+                return probe, None
+            index, similarity = hit
+            self.hits += 1
+            self._last_used[index] = time.time()
+            entry = self._entries[index]
+            return probe, {'content': entry['content'], 'usage': entry['usage'],
+                           'similarity': similarity, 'query': entry['query']}
+
+    def _search(self, probe):
+        namespace = self._namespaces.get(probe.namespace)
+        count = len(self._entries)
+        if namespace is None or not count:
+            return None
+        scores = self._vectors[:count] @ probe.vector
+        scores[(self._namespace_of[:count] != namespace) | (self._expires[:count] < time.time())] = -1.0
+        k = min(self.top_k, count)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        for index in candidates[np.argsort(-scores[candidates])]:
+            similarity = float(scores[index])
+            if similarity < self.threshold:
+                break
+            if self.guard is None or self.guard(probe.query, self._entries[index]['query']):
+                return int(index), similarity
+        return None
+
+    def store(self, probe, content, usage=None):
+        """把 lookup 未命中的请求得到的回复写入缓存"""
+        if probe is None or not content:
+            return
+        now = time.time()
+        with self._lock:
+            if self._mapped:
+                self._materialize()
+            namespace = self._namespaces.setdefault(probe.namespace, len(self._namespaces))
+            count = len(self._entries)
+            if count < self.max_size:
+                index = count
+                self._entries.append(None)
+            else:
+                # 优先覆盖已过期的条目，其次是最久未命中的条目
+                expired = np.flatnonzero(self._expires[:count] < now)
+                index = int(expired[0]) if len(expired) else int(np.argmin(self._last_used[:count]))
+                self.evictions += 1
+            self._vectors[index] = probe.vector
+            self._namespace_of[index] = namespace
+            self._expires[index] = now + self.ttl if self.ttl is not None else np.inf
+            self._last_used[index] = now
+            self._entries[index] = {'query': probe.query, 'content': content, 'usage': usage}
+            self._dirty = True
+
+    def search(self, text, k=5):
+        """
+        不区分命名空间地查找与 text 最相似的条目，用于调整阈值
+
+        返回:
+            list: [(相似度, 缓存的问题, 缓存的回复), ...]
+        """
+        vector = self.embedder.embed(text)
+        with self._lock:
+            count = len(self._entries)
+            if not count:
+                return []
+            scores = self._vectors[:count] @ vector
+            order = np.argsort(-scores)[:k]
+            return [(float(scores[i]), self._entries[i]['query'], self._entries[i]['content']) for i in order]
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            if self._mapped:
+                self._materialize()
+            self._entries = []
+            self._namespaces = {}
+            self._namespace_of[:] = -1
+            self._dirty = True
+
+    def stats(self):
+        """
+        获取缓存统计信息
+
+        返回:
+            dict: 条目数量、命中/未命中/跳过（非无状态请求）次数、命中率、淘汰次数等
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'skipped': self.skipped,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'threshold': self.threshold,
+                'embedder': self.embedder.id,
+            }
+
+    # ---------- 持久化 ----------
+
+    def _files(self):
+        return os.path.join(self.path, 'vectors.npy'), os.path.join(self.path, 'meta.json')
+
+    def _load(self):
+        vectors_path, meta_path = self._files()
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            vectors = np.load(vectors_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return
+        count = len(meta.get('entries', []))
+        if meta.get('embedder') != self.embedder.id or vectors.shape != (count, self.embedder.dim):
+            return  # 向量模型不同或文件不完整时从空缓存开始
+        count = min(count, self.max_size)
+        # 向量直接使用只读的内存映射，第一次写入时才复制到可写的矩阵中
+        self._vectors = vectors
+        self._mapped = True
+        self._entries = meta['entries'][:count]
+        self._namespaces = {key: index for index, key in enumerate(meta['namespaces'])}
+        self._namespace_of[:count] = meta['namespace_of'][:count]
+        self._expires[:count] = [np.inf if e is None else e for e in meta['expires'][:count]]
+        self._last_used[:count] = meta['last_used'][:count]
+
+    def _materialize(self):
+        vectors = np.zeros((self.max_size, self.embedder.dim), dtype=np.float32)
+        count = len(self._entries)
+        vectors[:count] = self._vectors[:count]
+        self._vectors = vectors
+        self._mapped = False
+
+    def save(self):
+        """写入持久化目录（先写临时文件再替换，写入过程中中断不会损坏已有文件）"""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            count = len(self._entries)
+            vectors = np.ascontiguousarray(self._vectors[:count])
+            meta = {
+                'embedder': self.embedder.id,
+                'namespaces': sorted(self._namespaces, key=self._namespaces.get),
+                'namespace_of': self._namespace_of[:count].tolist(),
+                'expires': [None if np.isinf(e) else e for e in self._expires[:count].tolist()],
+                'last_used': self._last_used[:count].tolist(),
+                'entries': list(self._entries),
+            }
+            self._dirty = False
+        os.makedirs(self.path, exist_ok=True)
+        vectors_path, meta_path = self._files()
+        with open(vectors_path + '.tmp', 'wb') as f:
+            np.save(f, vectors)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(vectors_path + '.tmp', vectors_path)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def close(self):
+        """保存未写入的条目"""
+        self.save()
@@ -0,0 +1,236 @@
+"""
+会话状态存储
+每个浏览器会话的对话历史单独保存，不再放在模块级全局变量中。
+
+会话状态以紧凑的JSON字节串保存（不重复保存系统提示词），后端可替换：
+- MemorySessionBackend：进程内字典，按最近访问时间淘汰，限制总内存
+- SQLiteSessionBackend：SQLite文件，多个服务进程可以共享同一份会话数据
+"""
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from env_loader import getenv
+
+
+def _encode(state):
+    return json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _decode(data):
+    return json.loads(data.decode('utf-8'))
+
+
+class MemorySessionBackend:
+    """
+    进程内的会话存储后端
+
+    参数:
+        max_bytes: 所有会话数据的总大小上限（字节），超出时淘汰最久未访问的会话
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # session_id -> (最后访问时间, 数据)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            self._data[session_id] = (time.time(), entry[1])
+            self._data.move_to_end(session_id)
+            return entry[1]
+
+    def put(self, session_id, data):
+        with self._lock:
+            old = self._data.pop(session_id, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._data[session_id] = (time.time(), data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def delete(self, session_id):
+        with self._lock:
+            old = self._data.pop(session_id, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+
+    def evict_idle(self, idle_timeout):
+        """删除超过 idle_timeout 秒未访问的会话，返回删除的数量"""
+        cutoff = time.time() - idle_timeout
+        evicted = 0
+        with self._lock:
+            # 按访问时间排序，最久未访问的在前面
+            while self._data:
+                session_id, (last_seen, data) = next(iter(self._data.items()))
+                if last_seen >= cutoff:
+                    break
+                del self._data[session_id]
+                self._bytes -= len(data)
+                evicted += 1
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._data), 'bytes': self._bytes}
+
+
+class SQLiteSessionBackend:
+    """
+    基于SQLite文件的会话存储后端，多个服务进程可以共享同一个文件
+
+    参数:
+        db_path: SQLite文件路径
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sessions '
+            '(session_id TEXT PRIMARY KEY, data BLOB NOT NULL, last_seen REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)')
+        self._db.commit()
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE sessions SET last_seen = ? WHERE session_id = ?', (time.time(), session_id)
+            )
+            self._db.commit()
+            return bytes(row[0])
+
+    def put(self, session_id, data):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO sessions (session_id, data, last_seen) VALUES (?, ?, ?)',
+                (session_id, data, time.time()),
+            )
+            self._db.commit()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            self._db.commit()
+
+    def evict_idle(self, idle_timeout):
+        """删除超过 idle_timeout 秒未访问的会话，返回删除的数量"""
+        with self._lock:
+            cursor = self._db.execute(
+                'DELETE FROM sessions WHERE last_seen < ?', (time.time() - idle_timeout,)
+            )
+            self._db.commit()
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            count, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM sessions'
+            ).fetchone()
+            return {'sessions': count, 'bytes': size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SessionStore:
+    """
+    会话状态存储
+
+    会话状态是一个字典，例如 {'messages': [...], 'memo': ..., 'summarized_upto': ...}。
+
+    参数:
+        backend: 存储后端，默认为 MemorySessionBackend
+        idle_timeout: 会话空闲多久（秒）后被删除
+        evict_interval: 两次空闲清理之间的最短间隔（秒）
+    """
+
+    def __init__(self, backend=None, idle_timeout=1800, evict_interval=60):
+        self.backend = backend if backend is not None else MemorySessionBackend()
+        self.idle_timeout = idle_timeout
+        self.evict_interval = evict_interval
+        self._last_evict = time.time()
+
+    def load(self, session_id):
+        """
+        读取会话状态，会话不存在时返回空状态 {'messages': []}
+        """
+        self._maybe_evict()
+        data = self.backend.get(session_id)
+        if data is None:
+            return {'messages': []}
+        return _decode(data)
+
+    def save(self, session_id, state):
+        """保存会话状态"""
+        self.backend.put(session_id, _encode(state))
+        self._maybe_evict()
+
+    def delete(self, session_id):
+        """删除会话"""
+        self.backend.delete(session_id)
+
+    def evict_idle(self):
+        """立即清理空闲会话，返回删除的数量"""
+        self._last_evict = time.time()
+        return self.backend.evict_idle(self.idle_timeout)
+
+    def _maybe_evict(self):
+        if time.time() - self._last_evict >= self.evict_interval:
+            self.evict_idle()
+
+    def stats(self):
+        """
+        获取存储统计信息
+
+        返回:
+            dict: {'sessions': 会话数量, 'bytes': 会话数据总大小}
+        """
+        return self.backend.stats()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    获取进程内共享的会话存储，首次调用时根据环境变量创建
+
+    环境变量配置:
+        SESSION_BACKEND: 'memory'（默认）或 'sqlite'
+        SESSION_DB: SQLite文件路径（默认: sessions.db）
+        SESSION_IDLE_TIMEOUT: 会话空闲超时秒数（默认: 1800）
+        SESSION_MAX_MB: 内存后端的总大小上限（MB，默认: 64）
+    """
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                if getenv('SESSION_BACKEND', 'memory').lower() == 'sqlite':
+                    backend = SQLiteSessionBackend(getenv('SESSION_DB', 'sessions.db'))
+                else:
+                    backend = MemorySessionBackend(
+                        max_bytes=int(float(getenv('SESSION_MAX_MB', '64')) * 1024 * 1024)
+                    )
+                _default_store = SessionStore(
+                    backend, idle_timeout=float(getenv('SESSION_IDLE_TIMEOUT', '1800'))
+                )
+    return _default_store
@@ -0,0 +1,39 @@
+"""测试从仓库根目录导入模块（所有模块都在根目录下）"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """
+    本地模拟服务（mock_server.MockServer）：所有提供商的请求都发往它
+
+    关闭回复缓存、语义缓存、对冲和录制，重试不等待；熔断器和限流器在测试之间互不影响。
+    """
+    import rate_limiter
+    import resilience
+    import tool
+    from mock_server import MockServer
+
+    server = MockServer().start()
+    for config in tool.API_CONFIGS.values():
+        monkeypatch.setenv(config['base_url_env'], server.url)
+        monkeypatch.setenv(config['key'], 'mock')
+    monkeypatch.setenv('API_PROVIDER', 'deepseek')
+    monkeypatch.setenv('API_RETRY_BASE_DELAY', '0')
+    monkeypatch.setenv('API_RETRY_MAX_DELAY', '0')
+    monkeypatch.setattr(resilience, '_breakers', {})
+    monkeypatch.setattr(rate_limiter, '_limiters', {})
+    tool.reload_api_config()
+    tool.disable_completion_cache()
+    tool.disable_semantic_cache()
+    tool.disable_hedging()
+    tool.disable_cassette()
+    yield server
+    tool.close_sessions()
+    tool.reload_api_config()
+    server.stop()
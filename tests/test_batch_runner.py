@@ -0,0 +1,100 @@
+"""批量请求运行器：对话和审核模式、输入格式错误的行、断点续跑"""
+import json
+
+import pytest
+
+import batch_runner
+from tool import CompletionResult
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """用本地函数代替 achat_completion，记录收到的请求"""
+    calls = []
+
+    async def complete(messages, model=None, temperature=0, max_tokens=500):
+        calls.append(messages[-1]['content'])
+        return CompletionResult(f"回复: {messages[-1]['content']}", {'prompt_tokens': 10, 'completion_tokens': 5},
+                                0.01, 'deepseek', 'deepseek-chat')
+
+    async def close():
+        pass
+
+    monkeypatch.setattr(batch_runner, 'achat_completion', complete)
+    monkeypatch.setattr(batch_runner, 'aclose_sessions', close)
+    return calls
+
+
+def _write_lines(path, lines):
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+
+def _read_records(path):
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def _message(item_id, content):
+    return json.dumps({'id': item_id, 'messages': [{'role': 'user', 'content': content}]}, ensure_ascii=False)
+
+
+def test_malformed_line_is_recorded_and_batch_continues(tmp_path, chat):
+    input_path, output_path = tmp_path / 'in.jsonl', tmp_path / 'out.jsonl'
+    _write_lines(input_path, [_message('a', '有什么披萨'), '{"id": "b", "messages": [', _message('c', '营业时间')])
+
+    summary = batch_runner.run_batch(str(input_path), str(output_path), progress_interval=None)
+
+    assert summary['succeeded'] == 2 and summary['failed'] == 1
+    assert sorted(chat) == ['有什么披萨', '营业时间']
+    errors = [record for record in _read_records(output_path) if 'error' in record]
+    assert len(errors) == 1
+    assert errors[0]['id'] == 2 and errors[0]['line'] == 2
+    assert '第2行' in errors[0]['error']
+
+
+def test_resume_skips_succeeded_items(tmp_path, chat):
+    input_path, output_path = tmp_path / 'in.jsonl', tmp_path / 'out.jsonl'
+    _write_lines(input_path, [_message('a', '有什么披萨'), _message('b', '营业时间')])
+    output_path.write_text(json.dumps({'id': 'a', 'content': '...', 'latency': 0.1}) + '\n'
+                           + '{"id": "b", "con', encoding='utf-8')
+
+    summary = batch_runner.run_batch(str(input_path), str(output_path), progress_interval=None)
+
+    assert summary['skipped'] == 1 and summary['succeeded'] == 1
+    assert chat == ['营业时间']
+    assert [record['id'] for record in _read_records(output_path)] == ['a', 'b']
+
+
+
+def test_chat_batch_against_mock_server(tmp_path, mock_api):
+    input_path, output_path = tmp_path / 'in.jsonl', tmp_path / 'out.jsonl'
+    _write_lines(input_path, [_message(f'q{i}', f'问题{i}') for i in range(5)])
+
+    summary = batch_runner.run_batch(str(input_path), str(output_path), concurrency=3, progress_interval=None)
+
+    assert summary['succeeded'] == 5 and summary['failed'] == 0
+    assert mock_api.stats()['chat'] == 5
+    assert summary['usage']['completion_tokens'] == 5 * mock_api.reply_tokens
+    assert summary['estimated_cost'] > 0
+    assert summary['latency']['p50'] is not None
+    assert {record['id'] for record in _read_records(output_path)} == {f'q{i}' for i in range(5)}
+
+
+def test_moderation_mode(tmp_path, monkeypatch):
+    class Service:
+        async def amoderate(self, text):
+            return {'flagged': '炸弹' in text, 'categories': {'violence': '炸弹' in text}, 'category_scores': {}}
+
+    async def close():
+        pass
+
+    monkeypatch.setattr(batch_runner, 'get_moderation_service', Service)
+    monkeypatch.setattr(batch_runner, 'aclose_sessions', close)
+    input_path, output_path = tmp_path / 'in.jsonl', tmp_path / 'out.jsonl'
+    _write_lines(input_path, ['"有什么披萨"', json.dumps({'id': 'm2', 'input': '自制炸弹'}, ensure_ascii=False)])
+
+    summary = batch_runner.run_batch(str(input_path), str(output_path), mode='moderation', progress_interval=None)
+
+    assert summary['succeeded'] == 2 and summary['flagged'] == 1
+    records = {record['id']: record for record in _read_records(output_path)}
+    assert records[1]['flagged'] is False
+    assert records['m2']['categories'] == {'violence': True}
@@ -0,0 +1,84 @@
+"""离线性能测试：模拟服务的各个接口和错误注入、使用模拟服务运行性能测试和对比结果，以及导入耗时"""
+import json
+
+import requests
+
+import benchmark
+from mock_server import MockServer
+
+MESSAGES = [{'role': 'user', 'content': '有什么披萨'}]
+
+
+def _post(server, path, body):
+    return requests.post(server.url + path, json=body, timeout=5)
+
+
+def test_mock_server_protocols():
+    with MockServer(reply_tokens=5) as server:
+        body = _post(server, '/chat/completions', {'model': 'm', 'messages': MESSAGES}).json()
+        assert body['choices'][0]['finish_reason'] == 'stop'
+        assert body['usage']['completion_tokens'] == 5
+
+        response = _post(server, '/chat/completions', {'model': 'm', 'messages': MESSAGES, 'stream': True})
+        events = [line[len('data: '):] for line in response.content.decode('utf-8').splitlines() if line.startswith('data: ')]
+        assert events[-1] == '[DONE]'
+        pieces = [json.loads(event)['choices'][0]['delta'].get('content') or '' for event in events[:-1]]
+        assert ''.join(pieces) == body['choices'][0]['message']['content']
+
+        body = _post(server, '/moderations', {'input': ['有什么披萨', 'I will kill you']}).json()
+        assert [result['flagged'] for result in body['results']] == [False, True]
+        assert server.stats() == {'chat': 2, 'moderations': 1}
+
+
+def test_mock_server_tools_and_json_mode():
+    tools = [{'type': 'function', 'function': {'name': 'add_item', 'parameters': {'type': 'object'}}}]
+    with MockServer() as server:
+        body = _post(server, '/chat/completions',
+                     {'model': 'm', 'messages': MESSAGES, 'tools': tools, 'tool_choice': 'required'}).json()
+        call = body['choices'][0]['message']['tool_calls'][0]
+        assert call['function'] == {'name': 'add_item', 'arguments': '{}'}
+        assert body['choices'][0]['finish_reason'] == 'tool_calls'
+
+        body = _post(server, '/chat/completions',
+                     {'model': 'm', 'messages': MESSAGES, 'response_format': {'type': 'json_object'}}).json()
+        assert 'reply' in json.loads(body['choices'][0]['message']['content'])
+
+
+def test_mock_server_error_injection():
+    with MockServer(error_rate=1.0, error_status=429, retry_after=2) as server:
+        response = _post(server, '/chat/completions', {'model': 'm', 'messages': MESSAGES})
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '2'
+        server.error_rate = 0.0
+        assert _post(server, '/chat/completions', {'model': 'm', 'messages': MESSAGES}).status_code == 200
+        assert server.stats() == {'chat': 2, 'errors': 1}
+
+
+def test_run_benchmarks_against_mock(mock_api):
+    mock_api.reply_tokens = 5
+    # mock=False：使用 mock_api 已经指向的模拟服务
+    report = benchmark.run_benchmarks(scenarios=('single', 'concurrent', 'streaming'), requests=5, sessions=2,
+                                      turns=2, mock=False)
+    results = report['results']
+    assert results['single']['requests'] == 5 and results['single']['errors'] == 0
+    assert results['concurrent']['requests'] == 4
+    assert results['streaming']['ttft']['p50'] is not None
+    assert mock_api.stats()['chat'] == 5 + 4 + 4
+    json.dumps(report)
+
+    text, regressed = benchmark.compare(report, report)
+    assert not regressed and 'single' in text
+
+
+def test_compare_flags_regression():
+    before = {'results': {'single': {'throughput': 100.0, 'latency': {'p50': 0.01, 'p99': 0.02}}}}
+    after = {'results': {'single': {'throughput': 50.0, 'latency': {'p50': 0.01, 'p99': 0.02}}}}
+    text, regressed = benchmark.compare(after, before)
+    assert regressed and '⚠' in text
+
+
+def test_bench_import_measures_each_module():
+    results = benchmark.bench_import(1, modules=('env_loader',))
+    result = results['import.env_loader']
+    assert result['errors'] == 0 and result['requests'] == 1
+    assert result['latency']['p50'] > 0
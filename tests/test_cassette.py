@@ -0,0 +1,119 @@
+"""请求录制与回放：录制后在模拟服务停止的情况下回放（同步、异步、流式），请求键和未录制的请求"""
+import asyncio
+
+import pytest
+
+import tool
+from cassette import Cassette, CassetteMiss, request_key
+
+MESSAGES = [{'role': 'user', 'content': '有什么披萨'}]
+
+
+def _run(coro):
+    async def run():
+        try:
+            return await coro
+        finally:
+            await tool.aclose_sessions()
+    return asyncio.run(run())
+
+
+def _record(path):
+    tool.enable_cassette(path, mode='record')
+    try:
+        reply = tool.chat_completion(MESSAGES)
+        streamed = ''.join(tool.stream_completion_from_messages(MESSAGES))
+        areply = _run(tool.achat_completion(MESSAGES + [{'role': 'user', 'content': '大号的'}]))
+        stats = tool.get_cassette_stats()
+    finally:
+        tool.disable_cassette()
+    assert stats['recorded'] == 3 and stats['interactions'] == 3
+    return reply, streamed, areply
+
+
+def test_replay_without_server(tmp_path, mock_api):
+    path = str(tmp_path / 'calls.sqlite')
+    reply, streamed, areply = _record(path)
+    assert mock_api.stats()['chat'] == 3
+    mock_api.stop()
+    tool.close_sessions()
+
+    tool.enable_cassette(path, mode='replay', latency='none')
+    try:
+        assert tool.chat_completion(MESSAGES).content == reply.content
+        assert ''.join(tool.stream_completion_from_messages(MESSAGES)) == streamed
+        # 同步录制的响应也可以由异步调用回放
+        assert _run(tool.achat_completion(MESSAGES)).content == reply.content
+        assert _run(tool.achat_completion(MESSAGES + [{'role': 'user', 'content': '大号的'}])).content == areply.content
+        stats = tool.get_cassette_stats()
+    finally:
+        tool.disable_cassette()
+    assert stats['replayed'] == 4 and stats['misses'] == 0
+
+
+def test_replay_mode_raises_on_unrecorded_request(tmp_path, mock_api):
+    path = str(tmp_path / 'calls.sqlite')
+    _record(path)
+    tool.enable_cassette(path, mode='replay', latency='none')
+    try:
+        # 未录制的请求不会重试，切换到的提供商同样没有录制
+        with pytest.raises(tool.APIError, match='没有这个请求'):
+            tool.chat_completion([{'role': 'user', 'content': '没有录制过的问题'}])
+        assert tool.get_cassette_stats()['misses'] == 2
+    finally:
+        tool.disable_cassette()
+    assert mock_api.stats()['chat'] == 3
+
+
+def test_auto_mode_records_only_new_requests(tmp_path, mock_api):
+    path = str(tmp_path / 'calls.sqlite')
+    tool.enable_cassette(path, mode='auto')
+    try:
+        first = tool.chat_completion(MESSAGES)
+        second = tool.chat_completion(MESSAGES)
+        stats = tool.get_cassette_stats()
+    finally:
+        tool.disable_cassette()
+    assert first.content == second.content
+    assert stats['recorded'] == 1 and stats['replayed'] == 1
+    assert mock_api.stats()['chat'] == 1
+
+
+def test_original_latency_replays_recorded_timing(tmp_path, mock_api):
+    path = str(tmp_path / 'calls.sqlite')
+    mock_api.latency = 0.2
+    tool.enable_cassette(path, mode='record')
+    try:
+        tool.chat_completion(MESSAGES)
+        timings = tool._get_cassette().timings()
+    finally:
+        tool.disable_cassette()
+    assert timings['deepseek/completion']['ttfb']['p50'] >= 0.2
+
+    tool.enable_cassette(path, mode='replay', latency='original')
+    try:
+        assert tool.chat_completion(MESSAGES).latency >= 0.2
+    finally:
+        tool.disable_cassette()
+    tool.enable_cassette(path, mode='replay', latency='none')
+    try:
+        assert tool.chat_completion(MESSAGES).latency < 0.1
+    finally:
+        tool.disable_cassette()
+
+
+def test_request_key_ignores_server_address():
+    data = {'model': 'deepseek-chat', 'messages': MESSAGES}
+    key = request_key('deepseek', 'https://api.deepseek.com/v1/chat/completions', data)
+    assert key == request_key('deepseek', 'http://127.0.0.1:8800/v1/chat/completions', dict(reversed(data.items())))
+    assert key != request_key('openai', 'https://api.deepseek.com/v1/chat/completions', data)
+    assert key != request_key('deepseek', 'https://api.deepseek.com/v1/moderations', data)
+
+
+def test_cassette_miss_in_replay_mode(tmp_path):
+    cassette = Cassette(str(tmp_path / 'empty.sqlite'), mode='replay')
+    try:
+        with pytest.raises(CassetteMiss):
+            cassette.replay('deepseek', 'http://127.0.0.1:9/v1/chat/completions', {'messages': MESSAGES})
+    finally:
+        cassette.close()
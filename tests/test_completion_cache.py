@@ -0,0 +1,60 @@
+"""回复缓存：LRU/TTL淘汰、SQLite持久化，以及 tool.py 中相同请求不再调用API"""
+import time
+
+import tool
+from completion_cache import CompletionCache, make_cache_key
+
+MESSAGES = [{'role': 'user', 'content': '有什么披萨'}]
+
+
+def test_key_ignores_dict_order_but_not_content():
+    key = make_cache_key('deepseek', 'deepseek-chat', [{'role': 'user', 'content': '你好'}], 0, 500)
+    reordered = make_cache_key('deepseek', 'deepseek-chat', [{'content': '你好', 'role': 'user'}], 0, 500)
+    assert key == reordered
+    assert key != make_cache_key('deepseek', 'deepseek-chat', [{'role': 'user', 'content': '你好'}], 0, 100)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = CompletionCache(max_size=2)
+    cache.set('a', {'content': 'A'})
+    cache.set('b', {'content': 'B'})
+    assert cache.get('a') == {'content': 'A'}
+    cache.set('c', {'content': 'C'})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_expired_entries_miss():
+    cache = CompletionCache(ttl=0.05)
+    cache.set('a', {'content': 'A'})
+    assert cache.get('a') is not None
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_disk_layer_survives_restart(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = CompletionCache(db_path=path)
+    cache.set('a', {'content': 'A', 'usage': {'total_tokens': 3}})
+    cache.close()
+
+    reopened = CompletionCache(db_path=path)
+    assert reopened.get('a') == {'content': 'A', 'usage': {'total_tokens': 3}}
+    assert reopened.stats()['disk_hits'] == 1
+    reopened.close()
+
+
+def test_repeated_request_served_from_cache(mock_api):
+    tool.enable_completion_cache()
+    try:
+        first = tool.get_completion_from_messages(MESSAGES)
+        second = tool.get_completion_from_messages(MESSAGES)
+        assert first == second
+        assert mock_api.stats()['chat'] == 1
+        assert tool.chat_completion(MESSAGES).cached
+        # 默认只缓存 temperature=0 的请求
+        tool.get_completion_from_messages(MESSAGES, temperature=0.7)
+        assert mock_api.stats()['chat'] == 2
+    finally:
+        tool.disable_completion_cache()
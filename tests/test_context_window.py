@@ -0,0 +1,100 @@
+"""上下文窗口：按token预算裁剪、备忘录摘要，以及摘要根据 APIError 判断调用失败"""
+import asyncio
+
+import context_window
+from context_window import ContextWindow
+from tool import APIError, CompletionResult
+
+MESSAGES = [{'role': 'user', 'content': '我要一个大号芝士披萨'}, {'role': 'assistant', 'content': '好的'}]
+
+
+def _reply(content):
+    return CompletionResult(content, None, 0.0, 'deepseek', 'deepseek-chat')
+
+
+def test_summary_returns_none_on_api_error(monkeypatch):
+    def fail(*args, **kwargs):
+        raise APIError('调用deepseek API时发生错误: 503', 'deepseek', 503)
+
+    async def afail(*args, **kwargs):
+        fail()
+
+    monkeypatch.setattr(context_window, 'chat_completion', fail)
+    monkeypatch.setattr(context_window, 'achat_completion', afail)
+    assert context_window.summarize_messages(MESSAGES) is None
+    assert asyncio.run(context_window.asummarize_messages(MESSAGES)) is None
+
+
+def test_summary_keeps_reply_that_mentions_errors(monkeypatch):
+    memo = '错误: 顾客说上次的地址写错了，改为人民路1号 '
+
+    async def reply(*args, **kwargs):
+        return _reply(memo)
+
+    monkeypatch.setattr(context_window, 'chat_completion', lambda *args, **kwargs: _reply(memo))
+    monkeypatch.setattr(context_window, 'achat_completion', reply)
+    assert context_window.summarize_messages(MESSAGES) == memo.strip()
+    assert asyncio.run(context_window.asummarize_messages(MESSAGES)) == memo.strip()
+
+
+def _count(message):
+    """测试用的token计数：每个字符一个token"""
+    return len(message['content'])
+
+
+def _conversation(turns):
+    messages = [{'role': 'system', 'content': '菜单' * 5}]
+    for i in range(turns):
+        messages.append({'role': 'user', 'content': f'问题{i:02d}' + '。' * 5})
+        messages.append({'role': 'assistant', 'content': f'回答{i:02d}' + '。' * 5})
+    return messages
+
+
+def test_short_conversation_sent_unchanged():
+    window = ContextWindow(max_prompt_tokens=1000, token_counter=_count)
+    messages = _conversation(2)
+    assert window.build(messages) == messages
+    assert window.last_report['saved_tokens'] == 0
+
+
+def test_sliding_window_keeps_system_and_recent_messages():
+    window = ContextWindow(max_prompt_tokens=50, token_counter=_count)
+    messages = _conversation(5) + [{'role': 'user', 'content': '最新的问题'}]
+    built = window.build(messages)
+    assert built[0] == messages[0]
+    assert built[-1] == messages[-1]
+    assert built[1]['role'] == 'user'
+    assert sum(_count(m) for m in built) <= 50
+    assert window.last_report['dropped_messages'] > 0
+
+
+def test_dropped_messages_summarized_once():
+    calls = []
+
+    def summarize(messages, previous_memo):
+        calls.append((len(messages), previous_memo))
+        return f'备忘录{len(calls)}'
+
+    window = ContextWindow(max_prompt_tokens=60, summarize=summarize, memo_max_tokens=10, token_counter=_count)
+    messages = _conversation(5)
+    built = window.build(messages + [{'role': 'user', 'content': '新问题'}])
+    assert built[1] == {'role': 'system', 'content': '之前对话的备忘录：备忘录1'}
+    assert len(calls) == 1
+
+    # 再加一轮：只摘要新移出窗口的消息，并带上之前的备忘录
+    messages += [{'role': 'user', 'content': '新问题'}, {'role': 'assistant', 'content': '新回答' + '。' * 8}]
+    window.build(messages + [{'role': 'user', 'content': '又一个问题'}])
+    assert len(calls) == 2 and calls[1][1] == '备忘录1'
+    assert window.export_state()['memo'] == '备忘录2'
+
+
+def test_restored_state_skips_summarized_messages():
+    window = ContextWindow(max_prompt_tokens=60, summarize=lambda messages, memo: '备忘录', memo_max_tokens=10,
+                           token_counter=_count)
+    messages = _conversation(5) + [{'role': 'user', 'content': '新问题'}]
+    window.build(messages)
+
+    restored = ContextWindow(max_prompt_tokens=60, summarize=lambda messages, memo: None, memo_max_tokens=10,
+                             token_counter=_count)
+    restored.restore_state(window.export_state())
+    assert restored.build(messages) == window.build(messages)
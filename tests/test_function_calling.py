@@ -0,0 +1,118 @@
+"""工具调用：工具定义、执行工具调用、调用循环（使用本地模拟服务）和JSON模式"""
+import asyncio
+
+import pytest
+
+import tool
+from function_calling import Toolbox, ajson_completion, arun_tools, force_tool, function_tool, json_completion, run_tools
+from tool import APIError, ToolCall
+
+MESSAGES = [{'role': 'user', 'content': '有什么披萨'}]
+
+
+def _call(name, arguments='{}'):
+    return ToolCall.from_response({'id': 'call_1', 'type': 'function',
+                                   'function': {'name': name, 'arguments': arguments}})
+
+
+def _toolbox(calls):
+    toolbox = Toolbox()
+
+    @toolbox.tool('列出菜单')
+    def list_menu(**arguments):
+        calls.append(arguments)
+        return {'pizzas': ['芝士披萨']}
+
+    return toolbox
+
+
+def test_definitions():
+    assert function_tool('list_menu', '列出菜单') == {
+        'type': 'function',
+        'function': {'name': 'list_menu', 'description': '列出菜单', 'parameters': {'type': 'object', 'properties': {}}},
+    }
+    assert force_tool('list_menu') == {'type': 'function', 'function': {'name': 'list_menu'}}
+    toolbox = _toolbox([])
+    assert 'list_menu' in toolbox and 'other' not in toolbox
+    assert [definition['function']['name'] for definition in toolbox.definitions] == ['list_menu']
+
+
+def test_dispatch_results_and_errors():
+    toolbox = Toolbox()
+    toolbox.register('price', '查询价格', handler=lambda item: {'item': item, 'price': '10.95'})
+    toolbox.register('broken', '出错', handler=lambda: 1 / 0)
+
+    message = toolbox.dispatch(_call('price', '{"item": "芝士披萨"}'))
+    assert message == {'role': 'tool', 'tool_call_id': 'call_1', 'content': '{"item": "芝士披萨", "price": "10.95"}'}
+    assert '未知的工具' in toolbox.dispatch(_call('missing'))['content']
+    assert '不是合法的JSON' in toolbox.dispatch(_call('price', '{item'))['content']
+    assert 'ZeroDivisionError' in toolbox.dispatch(_call('broken'))['content']
+
+
+def test_async_handler_requires_arun_tools():
+    toolbox = Toolbox()
+
+    @toolbox.tool('异步工具')
+    async def slow():
+        return 'ok'
+
+    with pytest.raises(TypeError):
+        toolbox.dispatch(_call('slow'))
+    assert asyncio.run(toolbox.adispatch(_call('slow')))['content'] == 'ok'
+
+
+def test_run_tools_loop(mock_api):
+    calls = []
+    result, messages = run_tools(MESSAGES, _toolbox(calls), tool_choice='required')
+
+    # 第一轮模型调用工具，第二轮（tool_choice 为 auto）给出最终回复
+    assert calls == [{}]
+    assert [message['role'] for message in messages] == ['user', 'assistant', 'tool']
+    assert messages[1]['tool_calls'][0]['function']['name'] == 'list_menu'
+    assert result.tool_calls == [] and result.content
+    assert mock_api.stats()['chat'] == 2
+
+
+def test_arun_tools_with_forced_tool(mock_api):
+    calls = []
+
+    async def run():
+        try:
+            return await arun_tools(MESSAGES, _toolbox(calls), tool_choice=force_tool('list_menu'))
+        finally:
+            await tool.aclose_sessions()
+
+    result, messages = asyncio.run(run())
+    assert calls == [{}]
+    assert messages[-1]['content'] == '{"pizzas": ["芝士披萨"]}'
+    assert result.finish_reason == 'stop'
+
+
+def test_max_rounds_returns_pending_tool_calls(mock_api):
+    calls = []
+    result, messages = run_tools(MESSAGES, _toolbox(calls), tool_choice='required', max_rounds=1)
+    assert result.finish_reason == 'tool_calls'
+    assert result.tool_calls[0].name == 'list_menu'
+    # 工具已经执行，结果在消息列表中，调用方可以继续对话
+    assert calls == [{}]
+    assert [message['role'] for message in messages] == ['user', 'assistant', 'tool']
+    assert mock_api.stats()['chat'] == 1
+
+
+def test_json_completion(mock_api):
+    assert 'reply' in json_completion(MESSAGES)
+
+    async def run():
+        try:
+            return await ajson_completion(MESSAGES)
+        finally:
+            await tool.aclose_sessions()
+
+    assert 'reply' in asyncio.run(run())
+
+
+def test_json_completion_rejects_plain_text(monkeypatch):
+    reply = tool.CompletionResult('不是JSON', None, 0.0, 'deepseek', 'deepseek-chat')
+    monkeypatch.setattr('function_calling.chat_completion', lambda *args, **kwargs: reply)
+    with pytest.raises(APIError):
+        json_completion(MESSAGES)
@@ -0,0 +1,153 @@
+"""对冲请求：等待时间、预算，对冲在慢请求上触发、在正常请求上不触发，以及 chat_completion 切换到更快的提供商"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import tool
+from hedging import HedgePolicy
+from mock_server import MockServer
+
+CONFIG = SimpleNamespace(provider='deepseek', url='http://127.0.0.1:9/chat/completions', headers={})
+DATA = {'model': 'deepseek-chat', 'messages': [{'role': 'user', 'content': '有什么披萨'}]}
+
+
+class _Response:
+    def __init__(self, provider):
+        self.provider = provider
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def latency(monkeypatch):
+    """按提供商设置 _send_request / _asend_request 的耗时（整次请求，包括读取响应体）"""
+    seconds = {'deepseek': 0.01, 'openai': 0.01}
+    calls = []
+
+    def send(provider, url, headers, data, stream=False, failover=True):
+        calls.append(provider)
+        time.sleep(seconds[provider])
+        return _Response(provider), provider
+
+    async def asend(provider, url, headers, data, stream=False, failover=True):
+        calls.append(provider)
+        await asyncio.sleep(seconds[provider])
+        return _Response(provider), provider
+
+    monkeypatch.setattr(tool, '_send_request', send)
+    monkeypatch.setattr(tool, '_asend_request', asend)
+    monkeypatch.setattr(tool, '_hedge_target', lambda config: ('openai', 'http://127.0.0.1:9/chat/completions', {},
+                                                                'gpt-4o-mini'))
+    return SimpleNamespace(seconds=seconds, calls=calls)
+
+
+def test_delay_uses_percentile_after_min_samples():
+    policy = HedgePolicy(percentile=50, min_samples=4, initial_delay=2.0, min_delay=0.05)
+    for seconds in (0.1, 0.2, 0.3):
+        policy.observe('deepseek', 'completion', seconds)
+    assert policy.delay('deepseek', 'completion') == 2.0
+    policy.observe('deepseek', 'completion', 0.4)
+    assert policy.delay('deepseek', 'completion') == 0.2
+    assert policy.delay('deepseek', 'stream') == 2.0
+
+
+def test_delay_has_lower_bound():
+    policy = HedgePolicy(min_samples=1, min_delay=0.05)
+    policy.observe('deepseek', 'completion', 0.001)
+    assert policy.delay('deepseek', 'completion') == 0.05
+
+
+def test_budget_limits_hedges():
+    policy = HedgePolicy(budget=0.5, burst=1)
+    assert policy.try_hedge()
+    assert not policy.try_hedge()
+    policy.record_request()
+    assert not policy.try_hedge()
+    policy.record_request()
+    assert policy.try_hedge()
+    assert policy.stats()['budget_exhausted'] == 2
+
+
+def test_sync_hedge_fires_when_primary_is_slow(latency):
+    latency.seconds['deepseek'] = 0.5
+    policy = HedgePolicy(initial_delay=0.05)
+    started = time.perf_counter()
+    response, provider = tool._send_hedged(policy, CONFIG, DATA)
+    assert provider == 'openai'
+    assert time.perf_counter() - started < 0.4
+    assert latency.calls == ['deepseek', 'openai']
+    assert policy.stats()['hedged'] == 1 and policy.stats()['wins'] == 1
+
+
+def test_sync_hedge_not_fired_when_primary_is_fast(latency):
+    policy = HedgePolicy(initial_delay=0.5)
+    response, provider = tool._send_hedged(policy, CONFIG, DATA)
+    assert provider == 'deepseek'
+    assert latency.calls == ['deepseek']
+    assert policy.stats()['hedged'] == 0
+
+
+def test_delay_learned_from_whole_request(latency):
+    """非流式请求的耗时包括读取完整的响应体，回复较长的请求不会都被对冲"""
+    latency.seconds['deepseek'] = 0.15
+    policy = HedgePolicy(min_samples=3, initial_delay=1.0)
+    for _ in range(3):
+        tool._send_hedged(policy, CONFIG, DATA)
+    assert 0.15 <= policy.delay('deepseek', 'completion') < 1.0
+
+    latency.seconds['deepseek'] = 0.1
+    response, provider = tool._send_hedged(policy, CONFIG, DATA)
+    assert provider == 'deepseek'
+    assert 'openai' not in latency.calls
+    assert policy.stats()['hedged'] == 0
+
+
+def test_async_hedge_fires_and_cancels_primary(latency):
+    latency.seconds['deepseek'] = 0.5
+    policy = HedgePolicy(initial_delay=0.05)
+    started = time.perf_counter()
+    response, provider = asyncio.run(tool._asend_hedged(policy, CONFIG, DATA))
+    assert provider == 'openai'
+    assert time.perf_counter() - started < 0.4
+    assert policy.stats()['wins'] == 1
+    # 被取消的首选请求不记录样本，等待时间只来自完成的请求
+    assert 'deepseek/completion' not in policy.stats()['delays']
+
+
+def test_async_hedge_not_fired_when_primary_is_fast(latency):
+    policy = HedgePolicy(initial_delay=0.5)
+    response, provider = asyncio.run(tool._asend_hedged(policy, CONFIG, DATA))
+    assert provider == 'deepseek'
+    assert latency.calls == ['deepseek']
+    assert policy.stats()['hedged'] == 0
+
+
+@pytest.fixture
+def slow_deepseek(mock_api, monkeypatch):
+    """deepseek 使用一个很慢的模拟服务，openai 仍然使用 mock_api"""
+    server = MockServer(latency=1.0).start()
+    monkeypatch.setenv('DEEPSEEK_BASE_URL', server.url)
+    tool.reload_api_config()
+    yield server
+    tool.close_sessions()
+    server.stop()
+
+
+def test_chat_completion_hedged_to_other_provider(slow_deepseek, mock_api):
+    tool.enable_hedging(initial_delay=0.05)
+    try:
+        started = time.perf_counter()
+        result = tool.chat_completion([{'role': 'user', 'content': '有什么披萨'}])
+        elapsed = time.perf_counter() - started
+        stats = tool.get_hedging_stats()
+    finally:
+        tool.disable_hedging()
+    assert (result.provider, result.model) == ('openai', tool.API_CONFIGS['openai']['default_model'])
+    assert elapsed < 0.8
+    assert stats['requests'] == 1 and stats['hedged'] == 1 and stats['wins'] == 1
+    assert mock_api.stats()['chat'] == 1
+    assert tool.get_hedging_stats() is None
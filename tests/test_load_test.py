@@ -0,0 +1,37 @@
+"""负载测试：虚拟顾客完成整个下单对话，以及饱和点的判断"""
+import asyncio
+
+import load_test
+import tool
+
+
+def test_stage_runs_scripted_customers(mock_api):
+    mock_api.reply_tokens = 5
+
+    async def run():
+        try:
+            return await load_test.run_stage(3, think_time=(0.0, 0.0), ramp_up=0.0, seed=1)
+        finally:
+            await tool.aclose_sessions()
+
+    result = asyncio.run(run())
+    assert result['customers'] == 3
+    assert result['errors'] == 0
+    assert result['turns'] >= 3 * 6
+    for phase in load_test.PHASES:
+        assert result['latency'][phase]['p50'] > 0
+    assert result['memory_per_session']['store_bytes'] >= 0
+    assert mock_api.stats()['chat'] >= result['turns']
+
+
+def _stage(p95, errors=0, turns=100):
+    return {'latency': {'first_token': {'p95': p95} if p95 is not None else {}}, 'errors': errors, 'turns': turns}
+
+
+def test_saturation_reasons():
+    baseline = _stage(0.1)
+    assert load_test._saturated(_stage(0.15), baseline, slo=2.0, max_degradation=2.0) is None
+    assert 'SLO' in load_test._saturated(_stage(2.5), baseline, slo=2.0, max_degradation=2.0)
+    assert '倍' in load_test._saturated(_stage(0.3), baseline, slo=2.0, max_degradation=2.0)
+    assert '错误率' in load_test._saturated(_stage(0.1, errors=10), baseline, slo=2.0, max_degradation=2.0)
+    assert load_test._saturated(_stage(None), baseline, slo=2.0, max_degradation=2.0) == '没有成功的对话'
@@ -0,0 +1,71 @@
+"""订单引擎：真实点餐说法的识别结果"""
+from decimal import Decimal
+
+import pytest
+
+from menu import OrderState
+
+
+def _lines(order):
+    return [(line['item'], line['size'], line['quantity'], line['toppings']) for line in order.to_dict()['lines']]
+
+
+# (顾客依次发送的消息, 期望的订单行 [(名称, 尺寸, 数量, 配料)])
+CASES = [
+    (['两个大的意式辣香肠披萨'], [('意式辣香肠披萨', '大', 2, [])]),
+    (['十二个小号芝士披萨'], [('芝士披萨', '小', 12, [])]),
+    (['要二十五个中号茄子披萨'], [('茄子披萨', '中', 25, [])]),
+    (['3个大号的芝士披萨'], [('芝士披萨', '大', 3, [])]),
+    (['十个小号雪碧'], [('雪碧', '小', 10, [])]),
+    (['大号芝士'], [('芝士披萨', '大', 1, [])]),
+    (['一个大号芝士披萨，加芝士'], [('芝士披萨', '大', 1, ['奶酪'])]),
+    (['我要一个中号茄子披萨，加蘑菇和香肠'], [('茄子披萨', '中', 1, ['蘑菇', '香肠'])]),
+    (['两个小号茄子披萨', '一个加辣椒，一个加加拿大熏肉'],
+     [('茄子披萨', '小', 1, ['辣椒']), ('茄子披萨', '小', 1, ['加拿大熏肉'])]),
+    (['一个芝士披萨', '大的'], [('芝士披萨', '大', 1, [])]),
+    (['一个芝士披萨和一瓶矿泉水', '不要矿泉水了'], [('芝士披萨', None, 1, [])]),
+    (['能来一杯大杯可乐吗？'], [('可乐', '大', 1, [])]),
+    # 紧跟“披萨”的配料名称是披萨的简称
+    (['一个小号香肠披萨'], [('意式辣香肠披萨', '小', 1, [])]),
+    (['一个大号意式辣香肠披萨，加香肠', '我不要香肠披萨了'], []),
+    (['一个芝士披萨和一个香肠披萨', '不要香肠披萨了'], [('芝士披萨', None, 1, [])]),
+    (['一个大号芝士披萨，加香肠', '不要香肠了'], [('芝士披萨', '大', 1, [])]),
+    # 询问不修改订单
+    (['芝士披萨多少钱？'], []),
+    (['有可乐吗？'], []),
+    (['有加拿大熏肉吗'], []),
+    (['你们的意式辣香肠披萨好吃吗'], []),
+    (['一个大号芝士披萨', '薯条多少钱？'], [('芝士披萨', '大', 1, [])]),
+    (['我要一个小号芝士披萨，沙拉多少钱？'], [('芝士披萨', '小', 1, [])]),
+    # 地址中的字不会被当作菜单项
+    (['一个大号芝士披萨', '外送，送到水库路3号'], [('芝士披萨', '大', 1, [])]),
+]
+
+
+@pytest.mark.parametrize('messages, expected', CASES, ids=[' / '.join(case[0]) for case in CASES])
+def test_apply(messages, expected):
+    order = OrderState()
+    for message in messages:
+        order.apply(message)
+    assert _lines(order) == expected
+
+
+@pytest.mark.parametrize('messages, fulfillment, address', [
+    (['一个大号芝士披萨', '外送，送到水库路3号'], 'delivery', '水库路3号'),
+    (['一个大号芝士披萨', '外送', '建设路12号'], 'delivery', '建设路12号'),
+    (['一个大号芝士披萨，自取'], 'pickup', None),
+    (['一个大号芝士披萨', '可以外送吗？'], None, None),
+])
+def test_fulfillment(messages, fulfillment, address):
+    order = OrderState()
+    for message in messages:
+        order.apply(message)
+    assert (order.fulfillment, order.address) == (fulfillment, address)
+
+
+def test_total():
+    order = OrderState()
+    order.apply('两个小号茄子披萨')
+    order.apply('一个加辣椒，一个加加拿大熏肉')
+    order.apply('再来一杯中杯可乐')
+    assert order.total() == Decimal('20.00')
@@ -0,0 +1,101 @@
+"""指标：样本分位数、直方图、Prometheus导出、/metrics 插件，以及API调用记录的指标和追踪span"""
+import asyncio
+from contextlib import contextmanager
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.web import Application
+
+import tool
+from metrics import MetricsRegistry, REGISTRY, add_trace_hook, percentile, remove_trace_hook
+
+
+def test_percentile_nearest_rank():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert percentile(values, 50) == 5
+    assert percentile(values, 95) == 10
+    assert percentile(values, 0) == 1
+    assert percentile([], 50) is None
+
+
+def test_histogram_counts_and_render():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('demo_seconds', '测试', ('phase',))
+    for seconds in (0.1, 0.2, 0.3):
+        histogram.observe(seconds, 'total')
+    text = registry.render()
+    assert 'demo_seconds_count{phase="total"} 3' in text
+    assert '# TYPE demo_seconds histogram' in text
+
+
+def test_metrics_plugin_serves_registry():
+    from metrics_plugin import ROUTES
+
+    REGISTRY.counter('plugin_test_total', '测试').inc()
+
+    async def fetch():
+        app = Application(ROUTES)
+        server = app.listen(0, address='127.0.0.1')
+        port = next(iter(server._sockets.values())).getsockname()[1]
+        try:
+            return await AsyncHTTPClient().fetch(f'http://127.0.0.1:{port}/metrics')
+        finally:
+            server.stop()
+
+    response = asyncio.run(fetch())
+    assert response.code == 200
+    assert 'plugin_test_total' in response.body.decode('utf-8')
+
+
+def _count(histogram, *labels):
+    return histogram.collect().get(labels, {}).get('count', 0)
+
+
+def test_chat_call_records_phases_and_tokens(mock_api):
+    totals = _count(tool._REQUEST_SECONDS, 'deepseek', 'completion', 'total')
+    ttfbs = _count(tool._REQUEST_SECONDS, 'deepseek', 'completion', 'ttfb')
+    decodes = _count(tool._REQUEST_SECONDS, 'deepseek', 'completion', 'decode')
+    ok = tool._REQUESTS.value('deepseek', 'completion', 'ok')
+    tokens = tool._TOKENS.value('deepseek', 'deepseek-chat', 'completion')
+
+    tool.chat_completion([{'role': 'user', 'content': '有什么披萨'}])
+
+    assert _count(tool._REQUEST_SECONDS, 'deepseek', 'completion', 'total') == totals + 1
+    assert _count(tool._REQUEST_SECONDS, 'deepseek', 'completion', 'ttfb') == ttfbs + 1
+    assert _count(tool._REQUEST_SECONDS, 'deepseek', 'completion', 'decode') == decodes + 1
+    assert tool._REQUESTS.value('deepseek', 'completion', 'ok') == ok + 1
+    assert tool._TOKENS.value('deepseek', 'deepseek-chat', 'completion') == tokens + mock_api.reply_tokens
+
+
+def test_failed_call_counted_by_outcome(mock_api):
+    mock_api.error_rate = 1.0
+    mock_api.error_status = 400
+    errors = tool._REQUESTS.value('deepseek', 'completion', 'http_400')
+    failures = tool._FAILURES.value('deepseek', 'completion')
+    try:
+        tool.chat_completion([{'role': 'user', 'content': '有什么披萨'}])
+    except tool.APIError:
+        pass
+    assert tool._REQUESTS.value('deepseek', 'completion', 'http_400') == errors + 1
+    assert tool._FAILURES.value('deepseek', 'completion') == failures + 1
+
+
+def test_trace_hooks_wrap_requests(mock_api):
+    spans = []
+
+    @contextmanager
+    def hook(name, attributes):
+        spans.append(('start', name, attributes))
+        yield
+        spans.append(('end', name))
+
+    add_trace_hook(hook)
+    try:
+        tool.chat_completion([{'role': 'user', 'content': '有什么披萨'}])
+    finally:
+        remove_trace_hook(hook)
+    assert spans == [('start', 'llm.request', {'provider': 'deepseek', 'operation': 'completion'}),
+                     ('end', 'llm.request')]
+
+    # 移除钩子后不再记录
+    tool.chat_completion([{'role': 'user', 'content': '有什么披萨'}])
+    assert len(spans) == 2
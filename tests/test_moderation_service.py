@@ -0,0 +1,78 @@
+"""审核服务：请求合并、缓存，以及调用方取消时不影响其他调用方"""
+import time
+import asyncio
+import threading
+
+from moderation_service import ModerationService
+
+
+def _slow_backend(delay, calls):
+    def moderate_batch(texts, model=None):
+        calls.append(len(texts))
+        time.sleep(delay)
+        return {'id': 'm', 'model': model, 'results': [{'flagged': False} for _ in texts]}
+    return moderate_batch
+
+
+def test_batches_overlap():
+    calls = []
+    service = ModerationService(batch_window=0.01, moderate_batch=_slow_backend(0.3, calls))
+    latencies = []
+    lock = threading.Lock()
+
+    def request(index):
+        started = time.perf_counter()
+        result = service.moderate(f'消息 {index}')
+        with lock:
+            latencies.append(time.perf_counter() - started)
+        assert result['flagged'] is False
+
+    threads = []
+    for index in range(6):
+        thread = threading.Thread(target=request, args=(index,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    service.close()
+
+    # 每条请求只等待自己这一批：约 窗口 + 一次往返，而不是再多等上一批的往返
+    assert len(calls) == 6
+    assert max(latencies) < 0.45
+
+
+def test_cached_and_coalesced():
+    calls = []
+    service = ModerationService(batch_window=0.05, moderate_batch=_slow_backend(0.01, calls))
+    first, second = service.submit('你好 世界'), service.submit('你好  世界')
+    assert first is not second
+    assert second.result()['flagged'] is False
+    assert first.result()['flagged'] is False
+    assert service.moderate('你好 世界')['flagged'] is False
+    service.close()
+    assert calls == [1]
+    assert service.stats()['cache_hits'] == 1
+
+
+def test_cancelled_caller_does_not_affect_others():
+    calls = []
+    service = ModerationService(batch_window=0.05, moderate_batch=_slow_backend(0.1, calls))
+
+    async def run():
+        # 三个会话提交相同的文本（合并为一次调用），另一个会话的文本进入同一批
+        tasks = [asyncio.ensure_future(service.amoderate('有人在吗')) for _ in range(3)]
+        other = asyncio.ensure_future(service.amoderate('今天营业吗'))
+        await asyncio.sleep(0.01)
+        tasks[0].cancel()   # 第一个会话关闭
+        results = await asyncio.wait_for(asyncio.gather(*tasks[1:], other), timeout=2)
+        assert tasks[0].cancelled()
+        return results
+
+    results = asyncio.run(run())
+    assert [result['flagged'] for result in results] == [False, False, False]
+    assert calls == [2]
+    # 取消之后，同一文本的新请求直接命中缓存
+    assert service.moderate('有人在吗')['flagged'] is False
+    assert service.stats()['cache_hits'] == 1
+    service.close()
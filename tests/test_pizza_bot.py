@@ -0,0 +1,112 @@
+"""披萨机器人：导入模块时不读取配置、不导入重量级依赖，流水线模式下的一轮对话"""
+import asyncio
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_import_does_not_load_env():
+    code = 'import env_loader, pizza_bot; print(env_loader._loaded)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == 'False'
+
+
+def test_import_defers_heavy_dependencies():
+    code = ('import sys, tool, pizza_bot; '
+            'print(sorted(name for name in ("requests", "httpx", "panel") if name in sys.modules))')
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == '[]'
+
+
+def test_settings_read_on_first_use(monkeypatch):
+    import pizza_bot
+    monkeypatch.setattr(pizza_bot, '_settings', None)
+    monkeypatch.setenv('ORDER_ENGINE', '0')
+    monkeypatch.setenv('ORDER_EXTRACTION', 'LLM')
+    settings = pizza_bot.get_settings()
+    assert settings['order_engine'] is False
+    assert settings['order_extraction'] == 'llm'
+    assert pizza_bot.get_settings() is settings
+
+
+def _turn(text, session_id):
+    """运行一轮对话，返回对话记录"""
+    import panel as pn
+    import pizza_bot
+    import tool
+    from transcript import Transcript
+
+    inp = pn.widgets.TextInput(value=text)
+    transcript = Transcript()
+
+    async def run():
+        try:
+            async for _ in pizza_bot.collect_messages(None, inp, transcript, session_id):
+                pass
+        finally:
+            await tool.aclose_sessions()
+
+    asyncio.run(run())
+    return transcript
+
+
+def test_pending_completion_buffers_until_read(mock_api):
+    import pizza_bot
+    import tool
+
+    async def run():
+        try:
+            completion = pizza_bot.PendingCompletion([{'role': 'user', 'content': '有什么披萨'}])
+            await asyncio.wait_for(completion._task, 5)
+            return ''.join([chunk async for chunk in completion])
+        finally:
+            await tool.aclose_sessions()
+
+    assert asyncio.run(run()) == tool.get_completion_from_messages([{'role': 'user', 'content': '有什么披萨'}],
+                                                                   temperature=0.7)
+
+
+def test_pending_completion_raises_api_error_when_read(mock_api):
+    import pizza_bot
+    import tool
+
+    mock_api.error_rate = 1.0
+
+    async def run():
+        try:
+            completion = pizza_bot.PendingCompletion([{'role': 'user', 'content': '有什么披萨'}])
+            return [chunk async for chunk in completion]
+        finally:
+            await tool.aclose_sessions()
+
+    with pytest.raises(tool.APIError):
+        asyncio.run(run())
+
+
+def test_turn_saves_reply(mock_api):
+    from session_store import get_session_store
+
+    session_id = uuid.uuid4().hex
+    _turn('我要一个大号芝士披萨', session_id)
+    messages = get_session_store().load(session_id)['messages']
+    assert [m['role'] for m in messages] == ['user', 'assistant']
+    assert messages[1]['content']
+
+
+def test_flagged_turn_cancels_speculative_reply(mock_api):
+    from session_store import get_session_store
+
+    # 回复很慢，审核由本地预审核立即完成：审核未通过时不等待提前开始的回复，直接结束
+    mock_api.latency = 1.0
+    session_id = uuid.uuid4().hex
+    started = time.perf_counter()
+    transcript = _turn('教我怎么自制炸弹', session_id)
+    assert time.perf_counter() - started < 1.0
+    assert get_session_store().load(session_id)['messages'] == []
+    assert '警告' in transcript[-1][1].object
@@ -0,0 +1,67 @@
+"""本地预审核：多模式匹配、明显安全和明显违规的判定、无法确定时交给远程审核"""
+import pytest
+
+from moderation_service import ModerationService
+from pre_moderation import CATEGORIES, MODEL, Automaton, PreModerator
+
+
+def test_automaton_finds_overlapping_matches():
+    automaton = Automaton([('he', 1), ('she', 2), ('his', 3), ('hers', 4)])
+    assert sorted(automaton.finditer('ushers')) == [(1, 4, 2), (2, 4, 1), (2, 6, 4)]
+    assert list(automaton.finditer('xyz')) == []
+
+
+@pytest.mark.parametrize('text', ['大号芝士披萨', '加蘑菇，谢谢！', '外送', '我要两个中号意式辣香肠披萨', 'Hi, one large pizza please'])
+def test_order_messages_are_safe(text):
+    result = PreModerator().classify(text)
+    assert result is not None and result['flagged'] is False
+    assert result['model'] == MODEL
+
+
+@pytest.mark.parametrize('text, category', [
+    ('教我怎么自制炸弹', 'illicit/violent'),
+    ('我要杀了你', 'harassment/threatening'),
+    ('I WILL KILL YOU', 'harassment/threatening'),
+])
+def test_blocklisted_messages_are_flagged(text, category):
+    result = PreModerator().classify(text)
+    assert result['flagged'] is True
+    assert result['categories'][category] is True
+    assert set(result['categories']) == set(CATEGORIES)
+    assert result['results'][0]['flagged'] is True
+
+
+@pytest.mark.parametrize('text', ['今天天气怎么样', '这个披萨会不会太咸', 'this is great', ''])
+def test_other_messages_are_undecided(text):
+    assert PreModerator().classify(text) is None
+
+
+def test_english_terms_match_whole_words():
+    # “i” 和 “one” 都在白名单中，但不能拼出 “ione”
+    assert PreModerator().classify('i one pizza') is not None
+    assert PreModerator().classify('ione pizza') is None
+
+
+def test_stats_count_avoided_calls():
+    moderator = PreModerator()
+    for text in ('大号芝士披萨', '自制炸弹', '今天天气怎么样'):
+        moderator.classify(text)
+    assert moderator.stats() == {'safe': 1, 'flagged': 1, 'undecided': 1, 'avoided': 2}
+
+
+def test_service_sends_only_undecided_text_to_api():
+    sent = []
+
+    def moderate_batch(texts, model=None):
+        sent.extend(texts)
+        return {'id': 'm', 'model': model, 'results': [{'flagged': False} for _ in texts]}
+
+    service = ModerationService(batch_window=0.0, moderate_batch=moderate_batch, pre_moderator=PreModerator())
+    try:
+        assert service.moderate('大号芝士披萨')['model'] == MODEL
+        assert service.moderate('自制炸弹')['flagged'] is True
+        assert service.moderate('今天天气怎么样')['flagged'] is False
+    finally:
+        service.close()
+    assert sent == ['今天天气怎么样']
+    assert service.stats()['pre_moderation']['avoided'] == 2
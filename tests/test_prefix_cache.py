@@ -0,0 +1,39 @@
+"""提示词前缀缓存：稳定的请求体字节、usage解析和命中率统计"""
+import tool
+from prefix_cache import PrefixCacheStats, encode_request_body, parse_cache_usage
+
+SYSTEM = {'role': 'system', 'content': '你是订餐机器人。菜单包括：芝士披萨 10.95'}
+
+
+def test_same_prefix_gives_same_bytes():
+    first = encode_request_body({'model': 'deepseek-chat', 'messages': [SYSTEM, {'role': 'user', 'content': '你好'}]})
+    reordered = {'content': SYSTEM['content'], 'role': 'system'}
+    second = encode_request_body({'model': 'deepseek-chat',
+                                  'messages': [reordered, {'content': '有什么披萨', 'role': 'user'}]})
+    prefix = encode_request_body({'model': 'deepseek-chat', 'messages': [SYSTEM]})[:-2]
+    assert first.startswith(prefix) and second.startswith(prefix)
+    assert '芝士披萨'.encode('utf-8') in first  # 中文不转义
+    assert b': ' not in first                   # 没有多余空白
+
+
+def test_parse_cache_usage():
+    assert parse_cache_usage({'prompt_cache_hit_tokens': 80, 'prompt_cache_miss_tokens': 20}) == (80, 20)
+    assert parse_cache_usage({'prompt_tokens': 100, 'prompt_tokens_details': {'cached_tokens': 64}}) == (64, 36)
+    assert parse_cache_usage({'prompt_tokens': 100}) is None
+    assert parse_cache_usage(None) is None
+
+
+def test_stats_hit_rate():
+    stats = PrefixCacheStats()
+    stats.record('deepseek', {'prompt_cache_hit_tokens': 0, 'prompt_cache_miss_tokens': 100})
+    stats.record('deepseek', {'prompt_cache_hit_tokens': 100, 'prompt_cache_miss_tokens': 0})
+    stats.record('deepseek', {'prompt_tokens': 5})
+    assert stats.snapshot() == {'deepseek': {'requests': 2, 'hit_tokens': 100, 'miss_tokens': 100, 'hit_rate': 0.5}}
+
+
+def test_tool_records_cache_hits(mock_api):
+    tool._prefix_cache_stats.reset()
+    tool.get_completion_from_messages([SYSTEM, {'role': 'user', 'content': '有什么披萨'}])
+    stats = tool.get_prefix_cache_stats()['deepseek']
+    assert stats['requests'] == 1
+    assert stats['hit_tokens'] > 0
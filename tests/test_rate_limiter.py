@@ -0,0 +1,85 @@
+"""客户端限流：令牌桶速率、优先级排队、429暂停和取消等待"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import tool
+from rate_limiter import BATCH, INTERACTIVE, RateLimiter
+
+
+def _drained(**kwargs):
+    """桶容量为1个请求、每0.1秒补充一个的限流器，并且已经用掉了第一个令牌"""
+    limiter = RateLimiter(rpm=600, burst_seconds=0.1, **kwargs)
+    limiter.acquire()
+    return limiter
+
+
+def test_requests_spaced_by_rate():
+    limiter = _drained()
+    started = time.monotonic()
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - started >= 0.18
+    assert limiter.stats()['requests'] == 3
+    assert limiter.stats()['delayed'] == 2
+
+
+def test_interactive_requests_go_first():
+    limiter = _drained()
+    order = []
+
+    def request(level, name):
+        limiter.acquire(priority=level)
+        order.append(name)
+
+    batch = threading.Thread(target=request, args=(BATCH, 'batch'))
+    batch.start()
+    time.sleep(0.02)
+    assert limiter.stats()['queued'] == {'interactive': 0, 'batch': 1}
+    interactive = threading.Thread(target=request, args=(INTERACTIVE, 'interactive'))
+    interactive.start()
+    batch.join()
+    interactive.join()
+    assert order == ['interactive', 'batch']
+
+
+def test_pause_delays_next_request():
+    limiter = RateLimiter(rpm=6000)
+    limiter.pause(0.2)
+    assert limiter.acquire() >= 0.19
+    assert limiter.stats()['throttled'] == 1
+
+
+def test_oversized_token_request_waits_for_full_bucket():
+    limiter = RateLimiter(tpm=600, burst_seconds=0.1)
+    assert limiter.acquire(tokens=10_000) < 0.01
+    assert limiter.acquire(tokens=10_000) >= 0.09
+
+
+def test_cancelled_async_wait_leaves_queue():
+    limiter = _drained()
+
+    async def run():
+        task = asyncio.ensure_future(limiter.aacquire())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert limiter.stats()['queued'] == {'interactive': 0, 'batch': 0}
+
+
+def test_429_pauses_provider_limiter(mock_api, monkeypatch):
+    monkeypatch.setenv('DEEPSEEK_RPM', '6000')
+    monkeypatch.setenv('API_FAILOVER', '0')
+    mock_api.error_rate = 1.0
+    mock_api.error_status = 429
+    with pytest.raises(tool.APIError) as error:
+        tool.chat_completion([{'role': 'user', 'content': '有什么披萨'}])
+    assert error.value.status_code == 429
+    stats = tool.get_rate_limit_stats()['deepseek']
+    assert stats['rpm'] == 6000
+    assert stats['throttled'] == 3
@@ -0,0 +1,148 @@
+"""重试、提供商切换和熔断器（包括半开状态的试探请求被取消后，熔断器仍然可以恢复）"""
+import asyncio
+
+import pytest
+
+import tool
+from mock_server import MockServer
+from resilience import CircuitBreaker, get_circuit_breaker, parse_retry_after
+
+MESSAGES = [{'role': 'user', 'content': '有什么披萨'}]
+
+
+class _FlakyServer(MockServer):
+    """前 failures 个请求返回错误，之后正常响应"""
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    def _pick_error(self):
+        with self._lock:
+            if self.failures:
+                self.failures -= 1
+                return self.error_status
+        return None
+
+
+@pytest.fixture
+def deepseek(mock_api, monkeypatch):
+    """单独为 deepseek 启动一个模拟服务（openai 仍然使用 mock_api），返回启动函数"""
+    servers = []
+
+    def start(failures, **kwargs):
+        server = _FlakyServer(failures, **kwargs).start()
+        servers.append(server)
+        monkeypatch.setenv('DEEPSEEK_BASE_URL', server.url)
+        tool.reload_api_config()
+        return server
+
+    yield start
+    tool.close_sessions()
+    for server in servers:
+        server.stop()
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('2') == 2.0
+    assert parse_retry_after('-1') == 0.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert parse_retry_after('soon') is None
+
+
+def test_transient_errors_retried(deepseek, mock_api):
+    server = deepseek(failures=2)
+    result = tool.chat_completion(MESSAGES)
+    assert result.provider == 'deepseek'
+    assert server.stats() == {'chat': 3, 'errors': 2}
+    assert mock_api.stats() == {}
+
+
+def test_fails_over_after_retries(deepseek, mock_api):
+    server = deepseek(failures=100)
+    result = tool.chat_completion(MESSAGES)
+    assert result.provider == 'openai'
+    assert result.model == tool.API_CONFIGS['openai']['default_model']
+    assert server.stats()['chat'] == 3
+    assert mock_api.stats()['chat'] == 1
+
+
+def test_client_errors_not_retried(deepseek, mock_api):
+    server = deepseek(failures=100, error_status=400)
+    with pytest.raises(tool.APIError) as error:
+        tool.chat_completion(MESSAGES)
+    assert error.value.status_code == 400
+    assert server.stats()['chat'] == 1
+    assert mock_api.stats() == {}
+
+
+def test_breaker_opens_and_skips_provider(deepseek, mock_api, monkeypatch):
+    monkeypatch.setenv('CIRCUIT_FAILURE_THRESHOLD', '2')
+    monkeypatch.setenv('API_MAX_RETRIES', '0')
+    server = deepseek(failures=100)
+    for _ in range(2):
+        assert tool.chat_completion(MESSAGES).provider == 'openai'
+    assert get_circuit_breaker('deepseek').state == CircuitBreaker.OPEN
+    assert tool.chat_completion(MESSAGES).provider == 'openai'
+    assert server.stats()['chat'] == 2
+
+
+def _half_open(provider):
+    """让指定提供商的熔断器进入“打开且已到恢复时间”的状态，下一个请求就是试探请求"""
+    breaker = get_circuit_breaker(provider)
+    breaker.recovery_timeout = 0.0
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+
+def test_release_probe_allows_next_probe():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release_probe()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+def test_cancelled_async_probe_releases_breaker(monkeypatch):
+    breaker = _half_open('probe-async')
+    started = asyncio.Event()
+
+    async def hang(*args, **kwargs):
+        started.set()
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(tool, '_arequest_with_retry', hang)
+
+    async def run():
+        task = asyncio.ensure_future(
+            tool._asend_request('probe-async', 'http://127.0.0.1:9/chat/completions', {}, {'messages': []},
+                                failover=False)
+        )
+        await started.wait()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker._probe_in_flight
+    assert breaker.allow()
+
+
+def test_interrupted_sync_probe_releases_breaker(monkeypatch):
+    breaker = _half_open('probe-sync')
+
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(tool, '_request_with_retry', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        tool._send_request('probe-sync', 'http://127.0.0.1:9/chat/completions', {}, {'messages': []},
+                           failover=False)
+    assert not breaker._probe_in_flight
+    assert breaker.allow()
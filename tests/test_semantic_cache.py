@@ -0,0 +1,101 @@
+"""语义回复缓存：字面相近但答案不同的问题不能互相命中、持久化、淘汰，以及在 chat_completion 中命中"""
+import pytest
+
+import tool
+from semantic_cache import SemanticCache, HashingEmbedder, details_match, normalize_query
+
+SYSTEM = {'role': 'system', 'content': '你是披萨店的订餐机器人。'}
+
+
+def _messages(question):
+    return [SYSTEM, {'role': 'user', 'content': question}]
+
+
+def _ask(cache, question):
+    return cache.lookup('deepseek', 'deepseek-chat', _messages(question), 500)
+
+
+def _cache_with(question, answer):
+    cache = SemanticCache(HashingEmbedder(), threshold=0.9)
+    probe, cached = _ask(cache, question)
+    assert cached is None
+    cache.store(probe, answer)
+    return cache
+
+
+@pytest.mark.parametrize('cached_question, question', [
+    ('中号意式辣香肠披萨多少钱', '大号意式辣香肠披萨多少钱'),
+    ('小号芝士披萨多少钱', '中号芝士披萨多少钱'),
+    ('芝士披萨多少钱', '茄子披萨多少钱'),
+    ('大杯可乐多少钱', '大杯雪碧多少钱'),
+    ('两个芝士披萨多少钱', '三个芝士披萨多少钱'),
+    ('加蘑菇多少钱', '加香肠多少钱'),
+])
+def test_near_miss_questions_do_not_hit(cached_question, question):
+    cache = _cache_with(cached_question, '10.00')
+    assert _ask(cache, question)[1] is None
+
+
+@pytest.mark.parametrize('cached_question, question', [
+    ('有什么披萨', '你们有什么披萨啊？'),
+    ('大号意式辣香肠披萨多少钱', '请问大号意式辣香肠披萨多少钱呢'),
+    ('一瓶矿泉水多少钱', '一瓶 矿泉水 多少钱？'),
+])
+def test_normalized_questions_hit(cached_question, question):
+    cache = _cache_with(cached_question, '回复')
+    probe, cached = _ask(cache, question)
+    assert cached is not None and cached['content'] == '回复'
+
+
+def test_details_match_uses_menu_items():
+    assert details_match(normalize_query('矿泉水多少钱'), normalize_query('瓶装水多少钱'))
+    assert not details_match(normalize_query('大号薯条'), normalize_query('小号薯条'))
+
+
+def test_follow_up_turns_are_not_cached():
+    cache = SemanticCache(HashingEmbedder())
+    messages = _messages('有什么披萨') + [{'role': 'assistant', 'content': '有三种'}, {'role': 'user', 'content': '大号的'}]
+    assert cache.lookup('deepseek', 'deepseek-chat', messages, 500) == (None, None)
+    assert cache.stats()['skipped'] == 1
+
+
+def test_persisted_cache_reloads_memory_mapped(tmp_path):
+    cache = SemanticCache(HashingEmbedder(), path=str(tmp_path))
+    probe, _ = _ask(cache, '有什么披萨')
+    cache.store(probe, '芝士披萨、意式辣香肠披萨')
+    cache.close()
+
+    reloaded = SemanticCache(HashingEmbedder(), path=str(tmp_path))
+    assert len(reloaded) == 1 and reloaded._mapped
+    assert _ask(reloaded, '你们有什么披萨')[1]['content'] == '芝士披萨、意式辣香肠披萨'
+    # 第一次写入时才复制内存映射的向量
+    probe, _ = _ask(reloaded, '有什么饮料')
+    reloaded.store(probe, '可乐、雪碧')
+    assert not reloaded._mapped and len(reloaded) == 2
+
+
+def test_full_cache_evicts_least_recently_used():
+    cache = SemanticCache(HashingEmbedder(), max_size=2)
+    for question in ('有什么披萨', '有什么饮料'):
+        probe, _ = _ask(cache, question)
+        cache.store(probe, question)
+    _ask(cache, '有什么披萨')
+    probe, _ = _ask(cache, '有什么配料')
+    cache.store(probe, '有什么配料')
+    assert cache.stats()['evictions'] == 1
+    assert _ask(cache, '有什么披萨')[1] is not None
+    assert _ask(cache, '有什么饮料')[1] is None
+
+
+def test_chat_completion_served_from_semantic_cache(mock_api):
+    tool.enable_semantic_cache()
+    try:
+        first = tool.chat_completion(_messages('有什么披萨'))
+        second = tool.chat_completion(_messages('你们有什么披萨？'))
+        stats = tool.get_semantic_cache_stats()
+    finally:
+        tool.disable_semantic_cache()
+    assert not first.cached and second.cached
+    assert second.content == first.content
+    assert mock_api.stats()['chat'] == 1
+    assert stats['hits'] == 1 and stats['entries'] == 1
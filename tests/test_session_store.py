@@ -0,0 +1,55 @@
+"""会话存储：会话互相隔离、内存上限淘汰、空闲清理和SQLite共享"""
+import time
+
+import pytest
+
+from session_store import MemorySessionBackend, SQLiteSessionBackend, SessionStore
+
+STATE = {'messages': [{'role': 'user', 'content': '我要一个大号芝士披萨'}], 'memo': None}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        backend = MemorySessionBackend()
+    else:
+        backend = SQLiteSessionBackend(str(tmp_path / 'sessions.db'))
+    yield SessionStore(backend, idle_timeout=0.05, evict_interval=3600)
+    if request.param == 'sqlite':
+        backend.close()
+
+
+def test_sessions_are_isolated(store):
+    assert store.load('a') == {'messages': []}
+    store.save('a', STATE)
+    assert store.load('a') == STATE
+    assert store.load('b') == {'messages': []}
+    store.delete('a')
+    assert store.load('a') == {'messages': []}
+
+
+def test_idle_sessions_evicted(store):
+    store.save('old', STATE)
+    time.sleep(0.06)
+    store.save('new', STATE)
+    assert store.evict_idle() == 1
+    assert store.load('old') == {'messages': []}
+    assert store.load('new') == STATE
+
+
+def test_memory_backend_respects_max_bytes():
+    store = SessionStore(MemorySessionBackend(max_bytes=200))
+    for session_id in ('a', 'b', 'c'):
+        store.save(session_id, STATE)
+    assert store.stats()['bytes'] <= 200
+    assert store.load('a') == {'messages': []}
+    assert store.load('c') == STATE
+
+
+def test_sqlite_shared_between_stores(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    first, second = SQLiteSessionBackend(path), SQLiteSessionBackend(path)
+    SessionStore(first).save('a', STATE)
+    assert SessionStore(second).load('a') == STATE
+    first.close()
+    second.close()
@@ -0,0 +1,39 @@
+"""token计数与费用估算，以及 MAX_PROMPT_TOKENS 在发送前拒绝过长的提示词"""
+import pytest
+
+import tool
+from token_counter import (
+    TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, count_message_tokens, count_messages_tokens, estimate_cost,
+    estimate_request, estimate_tokens,
+)
+
+
+def test_estimate_uses_provider_ratios():
+    assert estimate_tokens('披萨' * 10) == 12          # DeepSeek: 中文约0.6个token/字
+    assert estimate_tokens('a' * 10) == 3               # DeepSeek: 英文约0.3个token/字符
+    assert estimate_tokens('披萨' * 10, 'gpt-4o') == 20  # OpenAI: 中文约1个token/字
+    assert estimate_tokens('a' * 10, 'gpt-4o') == 3     # OpenAI: 英文约4个字符/token
+
+
+def test_message_overhead():
+    message = {'role': 'user', 'content': '有什么披萨'}
+    assert count_message_tokens(message) == estimate_tokens('有什么披萨') + TOKENS_PER_MESSAGE
+    assert count_messages_tokens([message, message]) == 2 * count_message_tokens(message) + TOKENS_PER_REPLY
+    assert count_message_tokens({'role': 'assistant', 'content': None}) == TOKENS_PER_MESSAGE
+
+
+def test_cost_estimates():
+    assert estimate_cost('deepseek-chat', 1_000_000, 1_000_000) == pytest.approx(0.27 + 1.10)
+    assert estimate_cost('unknown-model', 100) is None
+    estimate = estimate_request([{'role': 'user', 'content': '有什么披萨'}], 'deepseek-chat', max_tokens=1000)
+    assert estimate['max_completion_tokens'] == 1000
+    assert estimate['estimated_cost'] == pytest.approx(estimate_cost('deepseek-chat', estimate['prompt_tokens'], 1000))
+
+
+def test_prompt_over_limit_rejected_before_sending(mock_api, monkeypatch):
+    monkeypatch.setenv('MAX_PROMPT_TOKENS', '10')
+    reply = tool.get_completion_from_messages([{'role': 'user', 'content': '披萨' * 50}])
+    assert 'MAX_PROMPT_TOKENS=10' in reply
+    assert mock_api.stats().get('chat', 0) == 0
+    with pytest.raises(tool.APIError):
+        tool.chat_completion([{'role': 'user', 'content': '披萨' * 50}])
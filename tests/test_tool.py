@@ -0,0 +1,134 @@
+"""tool.py：缓存的提供商配置、统一的请求核心、连接复用、流式和异步接口（使用本地模拟服务），以及调用失败时的返回格式"""
+import asyncio
+import time
+
+import pytest
+
+import tool
+
+MESSAGES = [{'role': 'user', 'content': '有什么披萨'}]
+
+
+def _run(coro):
+    """在新的事件循环中运行，结束时关闭该事件循环的异步客户端"""
+    async def run():
+        try:
+            return await coro
+        finally:
+            await tool.aclose_sessions()
+    return asyncio.run(run())
+
+
+def _connections(provider):
+    """新建连接的次数（llm_connect_seconds 的样本数）"""
+    return tool._CONNECT_SECONDS.collect().get((provider,), {}).get('count', 0)
+
+
+def test_token_count_error_keeps_tuple(monkeypatch, capsys):
+    def fail(*args, **kwargs):
+        raise tool.APIError('错误: 请在.env文件中设置 DEEPSEEK_API_KEY', 'deepseek')
+
+    monkeypatch.setattr(tool, '_complete', fail)
+    response, token_dict = tool.get_completion_and_token_count([{'role': 'user', 'content': '你好'}])
+    assert 'DEEPSEEK_API_KEY' in response
+    assert token_dict == {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    assert capsys.readouterr().out == ''
+
+
+def test_calls_share_one_keep_alive_connection(mock_api):
+    before = _connections('deepseek')
+    first = tool.get_completion_from_messages(MESSAGES)
+    second = tool.get_completion('营业时间是几点')
+    assert first and second
+    assert mock_api.stats()['chat'] == 2
+    assert _connections('deepseek') - before == 1
+    assert tool.get_session('deepseek') is tool.get_session('deepseek')
+
+
+def test_closed_sessions_are_recreated(mock_api):
+    session = tool.get_session('deepseek')
+    tool.close_sessions()
+    assert tool.get_session('deepseek') is not session
+    assert tool.get_completion_from_messages(MESSAGES)
+
+
+def test_stream_yields_reply_in_pieces(mock_api):
+    mock_api.reply_tokens = 5
+    chunks = list(tool.stream_completion_from_messages(MESSAGES))
+    assert len(chunks) == 5
+    assert ''.join(chunks) == tool.get_completion_from_messages(MESSAGES)
+
+
+def test_stream_raises_api_error_instead_of_yielding_it(mock_api):
+    mock_api.error_rate = 1.0
+    with pytest.raises(tool.APIError) as error:
+        list(tool.stream_completion_from_messages(MESSAGES))
+    assert error.value.status_code == 503
+
+
+def test_async_matches_sync(mock_api):
+    expected = tool.chat_completion(MESSAGES)
+    result = _run(tool.achat_completion(MESSAGES))
+    assert result.content == expected.content
+    assert result.usage == expected.usage
+    assert _run(tool.aget_completion_from_messages(MESSAGES)) == expected.content
+
+
+def test_async_calls_run_concurrently(mock_api):
+    mock_api.latency = 0.2
+
+    async def many():
+        return await asyncio.gather(*(tool.achat_completion(MESSAGES) for _ in range(10)))
+
+    started = time.perf_counter()
+    results = _run(many())
+    assert len(results) == 10
+    assert time.perf_counter() - started < 1.0
+
+
+def test_async_stream_and_error_text(mock_api):
+    async def stream():
+        return [chunk async for chunk in tool.astream_completion_from_messages(MESSAGES)]
+
+    assert ''.join(_run(stream())) == tool.get_completion_from_messages(MESSAGES)
+    mock_api.error_rate = 1.0
+    assert '503' in _run(tool.aget_completion_from_messages(MESSAGES))
+
+
+def test_provider_config_cached_until_reload(mock_api, monkeypatch):
+    config = tool.get_api_config()
+    assert tool.get_api_config() is config
+    assert config.url == mock_api.url.rstrip('/') + '/chat/completions'
+    api_key, api_url, default_model, provider = config
+    assert (api_key, provider) == ('mock', 'deepseek')
+
+    # 运行中修改环境变量不影响已缓存的配置，reload_api_config 之后才生效
+    monkeypatch.setenv('API_PROVIDER', 'openai')
+    assert tool.get_api_config().provider == 'deepseek'
+    tool.reload_api_config()
+    assert tool.get_api_config().provider == 'openai'
+
+
+def test_entry_points_share_one_core(mock_api):
+    result = tool.chat_completion(MESSAGES)
+    assert isinstance(result, tool.CompletionResult)
+    assert (result.provider, result.model, result.finish_reason) == ('deepseek', 'deepseek-chat', 'stop')
+    assert result.latency > 0 and not result.cached
+    assert result.assistant_message() == {'role': 'assistant', 'content': result.content}
+    assert set(result.as_dict()) == set(tool.CompletionResult.__slots__)
+
+    assert tool.get_completion_from_messages(MESSAGES) == result.content
+    content, tokens = tool.get_completion_and_token_count(MESSAGES)
+    assert content == result.content
+    assert tokens == result.token_counts()
+    assert tokens['completion_tokens'] == mock_api.reply_tokens
+    assert mock_api.stats()['chat'] == 3
+
+
+def test_missing_api_key_raises(mock_api, monkeypatch):
+    monkeypatch.setenv('DEEPSEEK_API_KEY', '')
+    tool.reload_api_config()
+    with pytest.raises(tool.APIError) as error:
+        tool.chat_completion(MESSAGES)
+    assert 'DEEPSEEK_API_KEY' in str(error.value)
+    assert mock_api.stats().get('chat', 0) == 0
@@ -0,0 +1,46 @@
+"""对话记录组件：追加消息、超过上限后移除最早的消息、替换最后一条和清空"""
+import panel as pn
+
+from transcript import Transcript
+
+
+def _row(text):
+    return pn.Row('用户:', pn.pane.Markdown(text))
+
+
+def test_append_keeps_existing_rows():
+    transcript = Transcript(max_messages=10)
+    view = transcript.view
+    first = _row('你好')
+    transcript.append(first)
+    transcript.append(_row('一个芝士披萨'), _row('好的'))
+    assert transcript.view is view
+    assert len(transcript) == 3
+    assert transcript[0] is first
+    assert transcript.hidden == 0 and not transcript._notice.visible
+
+
+def test_oldest_rows_hidden_after_limit():
+    transcript = Transcript(max_messages=4)
+    rows = [_row(str(i)) for i in range(6)]
+    for i in range(0, 6, 2):
+        transcript.append(rows[i], rows[i + 1])
+    assert len(transcript) == 4
+    assert list(transcript[:]) == rows[2:]
+    assert transcript.hidden == 2
+    assert transcript._notice.visible and '2' in transcript._notice.object
+    # 提示始终在最前面
+    assert transcript.view.objects[0] is transcript._notice
+
+
+def test_replace_last_and_clear():
+    transcript = Transcript(max_messages=4)
+    transcript.append(_row('问题'), _row('回复中'))
+    error = _row('抱歉，出错了')
+    transcript.replace_last(error)
+    assert transcript[-1] is error and len(transcript) == 2
+
+    transcript.append(*(_row(str(i)) for i in range(4)))
+    transcript.clear()
+    assert len(transcript) == 0
+    assert transcript.hidden == 0 and not transcript._notice.visible
@@ -0,0 +1,140 @@
+"""
+本地token计数与请求费用估算
+在发送请求之前估算提示词的token数量和费用，可以提前拒绝或裁剪过长的提示词，
+不必等API返回 usage 才知道用了多少token。
+
+分词方式:
+- OpenAI模型：安装了 tiktoken 时使用对应的编码精确计数
+- DeepSeek模型：安装了 tokenizers 并通过 DEEPSEEK_TOKENIZER 指定 tokenizer.json 时精确计数
+- 其他情况：按官方给出的字符/token经验比例估算
+"""
+import math
+from functools import lru_cache
+
+from env_loader import getenv
+
+# 每条消息除内容外的固定开销（角色、分隔符等），以及回复开头的固定开销
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# 各模型每百万token的价格（美元）：(输入, 输出)，请按提供商的最新价格调整
+MODEL_PRICES = {
+    'deepseek-chat': (0.27, 1.10),
+    'deepseek-reasoner': (0.55, 2.19),
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+}
+
+
+def _is_cjk(ch):
+    return '一' <= ch <= '鿿' or '　' <= ch <= '〿' or '＀' <= ch <= '￯'
+
+
+def estimate_tokens(text, model=None):
+    """
+    不依赖分词器，按经验比例估算token数量
+
+    DeepSeek：1个中文字符约0.6个token，1个英文字符约0.3个token；
+    OpenAI：1个中文字符约1个token，英文约4个字符1个token。
+    """
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    other = len(text) - cjk
+    if model and model.startswith('gpt'):
+        return math.ceil(cjk + other / 4)
+    return math.ceil(cjk * 0.6 + other * 0.3)
+
+
+@lru_cache(maxsize=None)
+def _get_encoder(model):
+    """
+    获取模型对应的分词器（结果会被缓存，每个模型只加载一次）
+
+    返回:
+        encode(text) -> token列表 的函数；没有可用的分词器时返回None
+    """
+    if model and model.startswith('deepseek'):
+        path = getenv('DEEPSEEK_TOKENIZER')
+        if not path:
+            return None
+        try:
+            from tokenizers import Tokenizer
+        except ImportError:
+            return None
+        tokenizer = Tokenizer.from_file(path)
+        return lambda text: tokenizer.encode(text, add_special_tokens=False).ids
+
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    return encoding.encode
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text, model=None):
+    """
+    计算一段文本的token数量（相同文本的结果会被缓存）
+
+    参数:
+        text: 文本内容
+        model: 模型名称，决定使用哪种分词方式；为None时按DeepSeek的比例估算
+
+    返回:
+        int: token数量
+    """
+    encode = _get_encoder(model) if model else None
+    if encode is None:
+        return estimate_tokens(text, model)
+    return len(encode(text))
+
+
+def count_message_tokens(message, model=None):
+    """
+    计算单条消息的token数量（内容 + 固定开销）
+    """
+    return count_tokens(message.get('content') or '', model) + TOKENS_PER_MESSAGE
+
+
+def count_messages_tokens(messages, model=None):
+    """
+    计算整个消息列表作为提示词时的token数量
+    """
+    return sum(count_message_tokens(m, model) for m in messages) + TOKENS_PER_REPLY
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens=0):
+    """
+    估算请求费用（美元）；模型不在价格表中时返回None
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+
+
+def estimate_request(messages, model, max_tokens=500):
+    """
+    发送请求前的预估：提示词token数量和最高费用
+
+    参数:
+        messages: 消息列表
+        model: 模型名称
+        max_tokens: 回复的最大token数量
+
+    返回:
+        dict: {'model': 模型名称, 'prompt_tokens': 提示词token数量,
+               'max_completion_tokens': 回复的最大token数量,
+               'estimated_cost': 按回复用满max_tokens计算的最高费用（美元），未知价格时为None}
+    """
+    prompt_tokens = count_messages_tokens(messages, model)
+    return {
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'max_completion_tokens': max_tokens,
+        'estimated_cost': estimate_cost(model, prompt_tokens, max_tokens or 0),
+    }
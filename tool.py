@@ -1,42 +1,1253 @@
-import os
-import requests
-from dotenv import load_dotenv, find_dotenv
+import sys
+import json
+import time
+import atexit
+import threading
+import weakref
+import contextvars
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+# requests、httpx 和 asyncio 在第一次发送同步/异步请求时才导入，.env 在第一次读取配置时才加载
+# （env_loader.py），只导入本模块不会产生这些开销
+try:
+    # 安装了 orjson 时用它解析响应，比标准库 json 快数倍
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+from completion_cache import CompletionCache, make_cache_key
+from token_counter import estimate_request, count_messages_tokens
+from prefix_cache import PrefixCacheStats, encode_request_body, parse_cache_usage
+from resilience import (
+    RETRYABLE_STATUS, FAILOVER_STATUS, CircuitOpenError,
+    get_circuit_breaker, get_retry_policy, parse_retry_after,
+)
+from rate_limiter import get_rate_limiter, get_rate_limit_stats
+from metrics import REGISTRY, span
+from env_loader import getenv
+
+# ========== 指标 ==========
+# 各阶段耗时: ttfb（发送请求到收到响应头，每次尝试记录一次）、decode（解析响应体）、
+# first_token（流式请求收到第一段内容）、total（一次调用的总耗时，包括排队、重试和切换提供商）
+_REQUEST_SECONDS = REGISTRY.histogram(
+    'llm_request_seconds', 'API调用各阶段的耗时（秒）', ('provider', 'operation', 'phase')
+)
+_CONNECT_SECONDS = REGISTRY.histogram(
+    'llm_connect_seconds', '新建连接（DNS解析、TCP连接和TLS握手）的耗时（秒）', ('provider',)
+)
+_REQUESTS = REGISTRY.counter(
+    'llm_requests_total', '发送的API请求次数（每次重试单独计数），按结果分类', ('provider', 'operation', 'outcome')
+)
+_FAILURES = REGISTRY.counter(
+    'llm_call_failures_total', '重试和切换提供商后仍然失败的调用次数', ('provider', 'operation')
+)
+_TOKENS = REGISTRY.counter(
+    'llm_tokens_total', 'API返回的token用量', ('provider', 'model', 'type')
+)
+# 对冲请求（按首选的提供商）: fired（发送了对冲请求）、won（对冲请求先返回）、
+# lost（原请求先返回）、budget_exhausted（超过等待时间但预算不足，没有对冲）
+_HEDGES = REGISTRY.counter(
+    'llm_hedges_total', '对冲请求的次数，按结果分类', ('provider', 'outcome')
+)
+
+
+def get_metrics():
+    """
+    获取进程内汇总的指标：各阶段耗时分布、连接耗时、请求结果、token用量
+    
+    返回:
+        dict: {指标名称: {标签: 计数 或 {'count', 'sum', 'mean', 'p50', 'p95', 'p99'}}}，
+              Prometheus 文本格式请使用 metrics.render_prometheus()
+    """
+    return REGISTRY.snapshot()
+
+
+def _timed_pool_classes(provider):
+    """返回新建连接时记录耗时的 urllib3 连接池类"""
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def timed(pool_cls):
+        class TimedConnection(pool_cls.ConnectionCls):
+            def connect(self):
+                started = time.perf_counter()
+                super().connect()
+                _CONNECT_SECONDS.observe(time.perf_counter() - started, provider)
+
+        return type(f'Timed{pool_cls.__name__}', (pool_cls,), {'ConnectionCls': TimedConnection})
+
+    return {'http': timed(HTTPConnectionPool), 'https': timed(HTTPSConnectionPool)}
+
+
+_timed_adapter_class = None
+
+
+def _timed_adapter(provider, **kwargs):
+    """创建记录新建连接耗时的 HTTPAdapter（类在第一次创建会话时定义，此时才导入 requests）"""
+    global _timed_adapter_class
+    if _timed_adapter_class is None:
+        from requests.adapters import HTTPAdapter
+
+        class TimedAdapter(HTTPAdapter):
+            def __init__(self, provider, **kwargs):
+                self._provider = provider
+                super().__init__(**kwargs)
+
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = _timed_pool_classes(self._provider)
+
+        _timed_adapter_class = TimedAdapter
+    return _timed_adapter_class(provider, **kwargs)
+
+
+# 每个API提供商共享一个HTTP会话（连接池 + keep-alive），避免每次调用都重新建立TCP+TLS连接
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_http_settings():
+    """
+    从环境变量获取HTTP连接池与超时配置
+
+    返回:
+        dict: {'pool_size': 每个提供商的连接池大小,
+               'connect_timeout': 建立连接超时（秒）,
+               'read_timeout': 读取响应超时（秒）,
+               'async_pool_size': 异步客户端的最大连接数}
+
+    环境变量配置:
+        HTTP_POOL_SIZE: 连接池大小（默认: 10）
+        HTTP_CONNECT_TIMEOUT: 连接超时秒数（默认: 5）
+        HTTP_READ_TIMEOUT: 读取超时秒数（默认: 60）
+        HTTP_ASYNC_POOL_SIZE: 异步客户端每个提供商的最大连接数（默认: 100）
+    """
+    return {
+        'pool_size': int(getenv('HTTP_POOL_SIZE', '10')),
+        'connect_timeout': float(getenv('HTTP_CONNECT_TIMEOUT', '5')),
+        'read_timeout': float(getenv('HTTP_READ_TIMEOUT', '60')),
+        'async_pool_size': int(getenv('HTTP_ASYNC_POOL_SIZE', '100')),
+    }
+
+
+def get_session(provider):
+    """
+    获取指定提供商共享的HTTP会话，首次调用时创建
+
+    同一提供商的所有请求复用同一个连接池，连接保持keep-alive，
+    因此pizza_bot的多轮对话可以复用已经建立好的连接。
+
+    参数:
+        provider: API提供商名称，如 'deepseek' 或 'openai'
+
+    返回:
+        requests.Session对象
+    """
+    session = _sessions.get(provider)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if session is None:
+            import requests
+            settings = get_http_settings()
+            adapter = _timed_adapter(
+                provider,
+                pool_connections=1,  # 每个提供商只访问一个主机
+                pool_maxsize=settings['pool_size'],
+                pool_block=False,
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[provider] = session
+    return session
+
+
+def close_sessions():
+    """
+    关闭所有提供商的HTTP会话，释放连接池中的连接
+
+    进程退出时会自动调用，也可以在服务关闭时手动调用。
+    关闭后再次调用API会自动重新创建会话。
+    """
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+atexit.register(close_sessions)
+
+
+def _post(provider, url, headers, data, stream=False):
+    """
+    通过提供商共享的连接池发送POST请求（带连接/读取超时）
+
+    参数:
+        provider: API提供商名称，用于选择连接池
+        url: 请求地址
+        headers: 请求头
+        data: 请求体（按固定格式编码为JSON，保证相同的消息前缀总是得到相同的字节，
+              便于提供商的提示词前缀缓存命中）
+        stream: 是否以流式方式读取响应
+
+    返回:
+        requests.Response对象
+    """
+    cassette = _get_cassette()
+    if cassette is not None:
+        if cassette.mode != 'record':
+            response = cassette.replay(provider, url, data)
+            if response is not None:
+                return response
+        # 录制时要求服务端不压缩，保存的响应体同步和异步调用都可以回放
+        headers = dict(headers, **{'Accept-Encoding': 'identity'})
+    settings = get_http_settings()
+    timeout = (settings['connect_timeout'], settings['read_timeout'])
+    started = time.perf_counter()
+    response = get_session(provider).post(
+        url, data=encode_request_body(data), headers=headers, timeout=timeout, stream=stream
+    )
+    if cassette is not None:
+        response = cassette.record(provider, url, data, response, started)
+    return response
+
+# ========== 请求录制与回放（可选） ==========
+_cassette = None
+_cassette_configured = False
+
+
+def enable_cassette(path, mode='replay', latency='original'):
+    """
+    启用请求录制与回放：在发送HTTP请求的最底层录制API的响应，或者用录制的响应代替网络请求
+    
+    参数:
+        path: 录制文件（SQLite）路径
+        mode: 'record'（发送请求并录制）、'replay'（只回放，没有录制的请求会失败）、
+              'auto'（有录制时回放，否则发送请求并录制）
+        latency: 回放时的延迟，'original'（与录制时相同）或 'none'（立即返回）
+    
+    返回:
+        cassette.Cassette对象
+    
+    环境变量配置（无需修改代码即可启用）:
+        CASSETTE_PATH: 录制文件路径，设置后启用
+        CASSETTE_MODE: record / replay / auto（默认: replay）
+        CASSETTE_LATENCY: original / none（默认: original）
+    """
+    global _cassette, _cassette_configured
+    from cassette import Cassette
+    _cassette = Cassette(path, mode=mode, latency=latency)
+    _cassette_configured = True
+    return _cassette
+
+
+def disable_cassette():
+    """
+    关闭请求录制与回放，之后的请求照常发送
+    """
+    global _cassette, _cassette_configured
+    if _cassette is not None:
+        _cassette.close()
+    _cassette = None
+    _cassette_configured = True
+
+
+def get_cassette_stats():
+    """
+    获取请求录制与回放的统计
+    
+    返回:
+        dict: 模式、录制文件中的响应数量、本次录制/回放/未找到录制的次数（见 Cassette.stats()）；未启用时返回None
+    """
+    cassette = _get_cassette()
+    return cassette.stats() if cassette is not None else None
+
+
+def _get_cassette():
+    """返回当前的录制文件，首次调用时根据环境变量决定是否启用"""
+    global _cassette, _cassette_configured
+    if not _cassette_configured:
+        from cassette import cassette_from_env
+        _cassette = cassette_from_env()
+        _cassette_configured = True
+    return _cassette
+
+
+# ========== 回复缓存（可选） ==========
+_completion_cache = None
+_cache_deterministic_only = True
+_cache_configured = False
+
+
+def enable_completion_cache(max_size=1024, ttl=3600, db_path=None, deterministic_only=True):
+    """
+    启用AI回复缓存，相同的请求直接返回之前的回复
+    
+    参数:
+        max_size: 内存中最多缓存的回复数量（LRU淘汰）
+        ttl: 缓存存活时间（秒），为None时永不过期
+        db_path: SQLite文件路径，设置后缓存会持久化到磁盘
+        deterministic_only: 是否只缓存 temperature=0 的请求（默认True）
+    
+    返回:
+        CompletionCache对象
+    
+    环境变量配置（无需修改代码即可启用）:
+        COMPLETION_CACHE: 设为1时启用缓存
+        COMPLETION_CACHE_SIZE: 内存层大小（默认: 1024）
+        COMPLETION_CACHE_TTL: 存活时间秒数（默认: 3600）
+        COMPLETION_CACHE_DB: SQLite文件路径（默认不持久化）
+    """
+    global _completion_cache, _cache_deterministic_only, _cache_configured
+    disable_completion_cache()
+    _completion_cache = CompletionCache(max_size=max_size, ttl=ttl, db_path=db_path)
+    _cache_deterministic_only = deterministic_only
+    _cache_configured = True
+    return _completion_cache
+
+
+def disable_completion_cache():
+    """
+    关闭AI回复缓存
+    """
+    global _completion_cache, _cache_configured
+    if _completion_cache is not None:
+        _completion_cache.close()
+    _completion_cache = None
+    _cache_configured = True
+
+
+def get_completion_cache_stats():
+    """
+    获取回复缓存的命中统计
+    
+    返回:
+        dict: 命中/未命中次数等统计信息；缓存未启用时返回None
+    """
+    cache = _get_completion_cache()
+    return cache.stats() if cache is not None else None
+
+
+def _get_completion_cache():
+    """返回当前的回复缓存，首次调用时根据环境变量决定是否启用"""
+    if not _cache_configured:
+        if getenv('COMPLETION_CACHE', '').strip() in ('1', 'true', 'yes'):
+            enable_completion_cache(
+                max_size=int(getenv('COMPLETION_CACHE_SIZE', '1024')),
+                ttl=float(getenv('COMPLETION_CACHE_TTL', '3600')),
+                db_path=getenv('COMPLETION_CACHE_DB') or None,
+            )
+        else:
+            disable_completion_cache()
+    return _completion_cache
+
+
+# ========== 语义回复缓存（可选） ==========
+_semantic_cache = None
+_semantic_cache_configured = False
+
+
+def enable_semantic_cache(threshold=0.9, max_size=2048, ttl=86400, path=None, model='hashing'):
+    """
+    启用语义回复缓存：无状态的请求（只有系统提示词和一条用户消息）中，
+    与之前的问题足够相似时直接返回之前的回复，位于精确匹配的回复缓存之后
+    
+    参数:
+        threshold: 余弦相似度阈值（0-1），越高越严格
+        max_size: 最多保存的条目数量
+        ttl: 条目存活时间（秒），为None时永不过期
+        path: 持久化目录，设置后启动时加载（内存映射）、退出时保存
+        model: 向量模型，'hashing'（默认，只依赖NumPy，只比较字面）
+               或 sentence-transformers 的模型名称（能命中用词不同的同义问题）
+    
+    返回:
+        semantic_cache.SemanticCache对象
+    
+    环境变量配置（无需修改代码即可启用）:
+        SEMANTIC_CACHE: 设为1时启用
+        SEMANTIC_CACHE_THRESHOLD: 相似度阈值（默认: 0.9）
+        SEMANTIC_CACHE_SIZE: 最多条目数量（默认: 2048）
+        SEMANTIC_CACHE_TTL: 存活时间秒数（默认: 86400）
+        SEMANTIC_CACHE_PATH: 持久化目录（默认不持久化）
+        SEMANTIC_CACHE_MODEL: 向量模型（默认: hashing）
+    """
+    global _semantic_cache, _semantic_cache_configured
+    from semantic_cache import SemanticCache, make_embedder
+    disable_semantic_cache()
+    _semantic_cache = SemanticCache(make_embedder(model), threshold=threshold, max_size=max_size, ttl=ttl, path=path)
+    _semantic_cache_configured = True
+    if path:
+        atexit.register(_semantic_cache.close)
+    return _semantic_cache
+
+
+def disable_semantic_cache():
+    """
+    关闭语义回复缓存（设置了持久化目录时先保存）
+    """
+    global _semantic_cache, _semantic_cache_configured
+    if _semantic_cache is not None:
+        _semantic_cache.close()
+    _semantic_cache = None
+    _semantic_cache_configured = True
+
+
+def get_semantic_cache_stats():
+    """
+    获取语义回复缓存的统计信息
+    
+    返回:
+        dict: 条目数量、命中率等，详见 SemanticCache.stats()；未启用时返回None
+    """
+    cache = _get_semantic_cache()
+    return cache.stats() if cache is not None else None
+
+
+def _get_semantic_cache():
+    """返回当前的语义回复缓存，首次调用时根据环境变量决定是否启用"""
+    if not _semantic_cache_configured:
+        if getenv('SEMANTIC_CACHE', '').strip() in ('1', 'true', 'yes'):
+            ttl = getenv('SEMANTIC_CACHE_TTL', '86400')
+            enable_semantic_cache(
+                threshold=float(getenv('SEMANTIC_CACHE_THRESHOLD', '0.9')),
+                max_size=int(getenv('SEMANTIC_CACHE_SIZE', '2048')),
+                ttl=float(ttl) if ttl else None,
+                path=getenv('SEMANTIC_CACHE_PATH') or None,
+                model=getenv('SEMANTIC_CACHE_MODEL', 'hashing'),
+            )
+        else:
+            disable_semantic_cache()
+    return _semantic_cache
+
+
+def _cache_lookup(provider, model, messages, temperature, max_tokens):
+    """
+    依次查询精确匹配的回复缓存和语义回复缓存
+    
+    返回:
+        (缓存键, 缓存的值)；两种缓存都不使用时缓存键为None，未命中时缓存的值为None
+    """
+    key = None
+    cache = _get_completion_cache()
+    if cache is not None and not (_cache_deterministic_only and temperature != 0):
+        key = make_cache_key(provider, model, messages, temperature, max_tokens)
+        cached = cache.get(key)
+        if cached is not None:
+            return (key, None), cached
+    semantic = _get_semantic_cache()
+    if semantic is None:
+        return ((key, None) if key is not None else None), None
+    probe, cached = semantic.lookup(provider, model, messages, max_tokens)
+    if key is None and probe is None:
+        return None, None
+    return (key, probe), cached
+
+
+def _cache_store(key, content, usage=None):
+    """把成功的回复写入缓存（key为None表示本次请求不使用缓存）"""
+    if key is None:
+        return
+    exact_key, probe = key
+    cache = _completion_cache
+    if exact_key is not None and cache is not None:
+        cache.set(exact_key, {'content': content, 'usage': usage})
+    semantic = _semantic_cache
+    if probe is not None and semantic is not None:
+        semantic.store(probe, content, usage)
+
+
+# 各API提供商的配置
+# base_url 可以通过 base_url_env 指定的环境变量覆盖，例如指向本地的 mock_server.py 或代理
+API_CONFIGS = {
+    'deepseek': {
+        'key': 'DEEPSEEK_API_KEY',
+        'base_url_env': 'DEEPSEEK_BASE_URL',
+        'base_url': 'https://api.deepseek.com/v1',
+        'default_model': 'deepseek-chat'
+    },
+    'openai': {
+        'key': 'OPENAI_API_KEY',
+        'base_url_env': 'OPENAI_BASE_URL',
+        'base_url': 'https://api.openai.com/v1',
+        'default_model': 'gpt-3.5-turbo'
+    }
+}
+
+
+class ProviderConfig:
+    """
+    一个提供商解析后的配置（API密钥、地址、默认模型和预先构造的请求头）
+    
+    首次使用时从环境变量读取，之后直接复用，不必每次请求都重新读取环境变量、构造请求头。
+    为了兼容旧代码，可以像元组一样解包: api_key, api_url, default_model, provider = config
+    
+    属性:
+        base_url: API根地址，如 https://api.deepseek.com/v1
+        url: 对话接口地址（base_url + /chat/completions）
+    """
+    
+    __slots__ = ('provider', 'api_key', 'base_url', 'url', 'default_model', 'headers')
+    
+    def __init__(self, provider, api_key, base_url, default_model):
+        self.provider = provider
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.url = f"{self.base_url}/chat/completions"
+        self.default_model = default_model
+        # 所有请求共用同一个请求头字典，调用方不能修改它
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+    
+    def __iter__(self):
+        return iter((self.api_key, self.url, self.default_model, self.provider))
+
+
+_provider_configs = {}
+_default_provider = None
+
+
+def get_provider_config(provider):
+    """
+    获取指定提供商的API配置（首次调用时从环境变量读取，之后使用缓存）
+    
+    返回:
+        ProviderConfig: 可以解包为 (api_key, api_url, default_model, provider)
+    
+    环境变量配置:
+        DEEPSEEK_BASE_URL / OPENAI_BASE_URL: 覆盖API根地址（默认为官方地址），
+                                             例如 http://127.0.0.1:8800/v1 指向本地模拟服务
+    """
+    config = _provider_configs.get(provider)
+    if config is None:
+        settings = API_CONFIGS[provider]
+        config = _provider_configs[provider] = ProviderConfig(
+            provider,
+            getenv(settings['key']),
+            getenv(settings['base_url_env']) or settings['base_url'],
+            settings['default_model'],
+        )
+    return config
 
-# 读取环境变量
-_ = load_dotenv(find_dotenv())
 
 def get_api_config():
     """
-    从环境变量获取API配置，支持灵活切换不同的API服务
+    获取当前使用的API配置，支持通过环境变量灵活切换不同的API服务
+    
+    环境变量只在第一次调用时读取；运行中修改了 API_PROVIDER 或API密钥后，
+    需要调用 reload_api_config() 才会生效。
+    
+    返回:
+        ProviderConfig: 可以解包为 (api_key, api_url, default_model, provider)
+    """
+    global _default_provider
+    if _default_provider is None:
+        # 获取API提供商（默认为deepseek）
+        provider = getenv('API_PROVIDER', 'deepseek').lower()
+        # 如果提供商不在配置中，使用deepseek作为默认
+        _default_provider = provider if provider in API_CONFIGS else 'deepseek'
+    return get_provider_config(_default_provider)
+
+
+def reload_api_config():
+    """
+    清除缓存的API配置，下次请求时重新从环境变量读取
+    """
+    global _default_provider
+    _provider_configs.clear()
+    _default_provider = None
+
+
+# ========== 重试、熔断与提供商切换 ==========
+class APIError(Exception):
+    """
+    API调用失败（已经过重试和提供商切换）
+    
+    属性:
+        provider: 最初请求的提供商
+        status_code: 最后一次失败的HTTP状态码（网络错误等情况下为None）
+    """
+
+    def __init__(self, message, provider=None, status_code=None):
+        super().__init__(message)
+        self.provider = provider
+        self.status_code = status_code
+
+
+def _http_error_types():
+    """
+    返回 (HTTP状态码错误类型, 网络错误类型)
+
+    只包括已经导入的库：requests / httpx 还没有导入时，不可能是它们抛出的异常。
+    """
+    status_errors, transport_errors = (), ()
+    requests = sys.modules.get('requests')
+    if requests is not None:
+        status_errors += (requests.exceptions.HTTPError,)
+        transport_errors += (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        )
+    httpx = sys.modules.get('httpx')
+    if httpx is not None:
+        status_errors += (httpx.HTTPStatusError,)
+        transport_errors += (httpx.TransportError,)
+    return status_errors, transport_errors
+
+
+def _error_status(error):
+    """返回异常对应的HTTP状态码，不是HTTP错误时返回None"""
+    response = getattr(error, 'response', None)
+    if isinstance(error, _http_error_types()[0]) and response is not None:
+        return response.status_code
+    return None
+
+
+def _is_retryable(error):
+    """是否为可以重试的临时性错误（网络错误、超时、429、5xx）"""
+    status = _error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(error, _http_error_types()[1])
+
+
+def _retry_after(error):
+    """从错误响应中读取 Retry-After（秒）"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    return parse_retry_after(response.headers.get('Retry-After'))
+
+
+def _failover_chain(provider, api_url, headers, failover=True):
+    """
+    按顺序返回本次请求可以尝试的提供商: [(提供商, 地址, 请求头, 替换的模型)]
+    
+    第一个是原本要请求的提供商；启用切换（API_FAILOVER，默认开启）时，
+    后面是其他配置了API密钥的提供商，使用它们各自的默认模型。
+    """
+    chain = [(provider, api_url, headers, None)]
+    if failover and getenv('API_FAILOVER', '1') != '0':
+        for other in API_CONFIGS:
+            if other == provider:
+                continue
+            config = get_provider_config(other)
+            if config.api_key:
+                chain.append((other, config.url, config.headers, config.default_model))
+    return chain
+
+
+def _give_up(provider, errors):
+    """所有提供商都失败后，构造最终抛出的APIError"""
+    status_code = next((_error_status(e) for _, e in reversed(errors) if _error_status(e)), None)
+    if len(errors) == 1:
+        message = str(errors[0][1])
+    else:
+        message = '; '.join(f"{name}: {error}" for name, error in errors)
+    return APIError(message, provider=provider, status_code=status_code)
+
+
+def _rate_limit_for(provider, headers, data):
+    """
+    返回 (限流器, 本次请求预计消耗的token数量)
+    
+    只对对话请求限流（审核接口的额度与对话接口分开计算）；
+    该提供商没有配置 RPM/TPM 限额时限流器为None。
+    """
+    if 'messages' not in data:
+        return None, 0
+    api_key = headers.get('Authorization', '').removeprefix('Bearer ')
+    limiter = get_rate_limiter(provider, api_key)
+    if limiter is None or not limiter.tpm:
+        return limiter, 0
+    # 提供商按 提示词 + max_tokens 预先占用TPM额度
+    tokens = count_messages_tokens(data['messages'], data.get('model')) + (data.get('max_tokens') or 0)
+    return limiter, tokens
+
+
+def _operation(data, stream):
+    """指标中使用的调用类型: completion、stream 或 moderation"""
+    if 'messages' not in data:
+        return 'moderation'
+    return 'stream' if stream else 'completion'
+
+
+def _outcome(error):
+    """指标中使用的失败原因，如 http_429、ReadTimeout"""
+    status = _error_status(error)
+    return f'http_{status}' if status is not None else type(error).__name__
+
+
+def _backoff(limiter, error, policy, attempt):
+    """
+    计算重试前需要等待的秒数；收到429时暂停整个限流器，让排队的其他请求一起等待，
+    此时重试会在限流器中排队，不需要再单独等待
+    """
+    delay = policy.delay(attempt, _retry_after(error))
+    if limiter is not None and _error_status(error) == 429:
+        limiter.pause(delay)
+        return 0
+    return delay
+
+
+def _request_with_retry(provider, url, headers, data, stream=False):
+    """
+    发送请求，遇到临时性错误时按指数退避重试（遵守 Retry-After）
+    
+    配置了限额（{PROVIDER}_RPM / {PROVIDER}_TPM）时，每次发送前先在限流器中按优先级排队。
+    
+    返回:
+        状态码正常的 requests.Response对象；重试用尽后抛出最后一次的异常
+    """
+    policy = get_retry_policy()
+    limiter, tokens = _rate_limit_for(provider, headers, data)
+    operation = _operation(data, stream)
+    for attempt in range(policy.max_retries + 1):
+        if limiter is not None:
+            limiter.acquire(tokens)
+        started = time.perf_counter()
+        try:
+            # 总是先只读取响应头，以便单独记录首字节时间
+            response = _post(provider, url, headers, data, stream=True)
+            try:
+                _REQUEST_SECONDS.observe(time.perf_counter() - started, provider, operation, 'ttfb')
+                response.raise_for_status()
+                if not stream:
+                    response.content  # 读取完整的响应体，连接随即归还连接池
+            except Exception:
+                response.close()
+                raise
+            _REQUESTS.inc(provider, operation, 'ok')
+            return response
+        except Exception as e:
+            _REQUESTS.inc(provider, operation, _outcome(e))
+            delay = _backoff(limiter, e, policy, attempt)
+            if attempt == policy.max_retries or not _is_retryable(e):
+                raise
+            time.sleep(delay)
+
+
+def _send_request(provider, api_url, headers, data, stream=False, failover=True):
+    """
+    所有API调用共用的发送入口：重试 + 熔断 + 提供商切换
+    
+    参数:
+        provider: 首选的API提供商
+        api_url: 首选提供商的请求地址
+        headers: 请求头
+        data: 请求体
+        stream: 是否以流式方式读取响应
+        failover: 首选提供商失败时是否切换到其他提供商
+    
+    返回:
+        (requests.Response对象, 实际使用的提供商)
+    
+    异常:
+        APIError: 所有可用的提供商都失败
+    """
+    errors = []
+    operation = _operation(data, stream)
+    for name, url, request_headers, model in _failover_chain(provider, api_url, headers, failover):
+        breaker = get_circuit_breaker(name)
+        if not breaker.allow():
+            _REQUESTS.inc(name, operation, 'circuit_open')
+            errors.append((name, CircuitOpenError(f"{name} API暂时不可用（熔断中）")))
+            continue
+        
+        payload = data if model is None else dict(data, model=model)
+        try:
+            with span('llm.request', provider=name, operation=operation):
+                response = _request_with_retry(name, url, request_headers, payload, stream=stream)
+        except Exception as e:
+            if _is_retryable(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            errors.append((name, e))
+            status = _error_status(e)
+            if status is not None and status not in FAILOVER_STATUS:
+                # 请求本身有问题（如参数错误），换提供商也无济于事
+                break
+            continue
+        except BaseException:
+            # 请求被中断（如 KeyboardInterrupt）时没有结果，归还半开状态的试探名额，否则熔断器永远无法恢复
+            breaker.release_probe()
+            raise
+        
+        breaker.record_success()
+        return response, name
+    
+    _FAILURES.inc(provider, operation)
+    raise _give_up(provider, errors)
+
+
+# ========== 对冲请求（可选） ==========
+_hedge_policy = None
+_hedge_configured = False
+
+
+def enable_hedging(percentile=95, budget=0.05, initial_delay=2.0, min_delay=0.05, window=256):
+    """
+    启用对冲请求：对话请求在等待时间内还没有收到响应时，向另一个配置了API密钥的提供商
+    发送一份相同的请求（使用该提供商的默认模型），使用先返回的结果并取消另一个
+    
+    参数:
+        percentile: 等待时间取该提供商最近请求耗时的哪个分位数
+        budget: 对冲请求占请求总数的最大比例
+        initial_delay: 样本不足时的等待时间（秒）
+        min_delay: 等待时间的下限（秒）
+        window: 每个提供商保留的最近样本数量
+    
+    返回:
+        hedging.HedgePolicy对象
+    
+    环境变量配置（无需修改代码即可启用）:
+        HEDGE_REQUESTS: 设为1时启用
+        HEDGE_PERCENTILE: 等待时间的分位数（默认: 95）
+        HEDGE_BUDGET: 对冲请求的最大比例（默认: 0.05）
+        HEDGE_INITIAL_DELAY: 样本不足时的等待秒数（默认: 2）
+        HEDGE_MIN_DELAY: 等待时间的下限秒数（默认: 0.05）
+    """
+    global _hedge_policy, _hedge_configured
+    from hedging import HedgePolicy
+    _hedge_policy = HedgePolicy(percentile=percentile, window=window, initial_delay=initial_delay,
+                                min_delay=min_delay, budget=budget)
+    _hedge_configured = True
+    return _hedge_policy
+
+
+def disable_hedging():
+    """
+    关闭对冲请求
+    """
+    global _hedge_policy, _hedge_configured
+    _hedge_policy = None
+    _hedge_configured = True
+
+
+def get_hedging_stats():
+    """
+    获取对冲请求的统计
+    
+    返回:
+        dict: 对冲次数、对冲请求先返回的次数、当前等待时间等（见 HedgePolicy.stats()）；未启用时返回None
+    """
+    policy = _get_hedge_policy()
+    return policy.stats() if policy is not None else None
+
+
+def _get_hedge_policy():
+    """返回当前的对冲策略，首次调用时根据环境变量决定是否启用"""
+    if not _hedge_configured:
+        if getenv('HEDGE_REQUESTS', '').strip() in ('1', 'true', 'yes'):
+            enable_hedging(
+                percentile=float(getenv('HEDGE_PERCENTILE', '95')),
+                budget=float(getenv('HEDGE_BUDGET', '0.05')),
+                initial_delay=float(getenv('HEDGE_INITIAL_DELAY', '2')),
+                min_delay=float(getenv('HEDGE_MIN_DELAY', '0.05')),
+            )
+        else:
+            disable_hedging()
+    return _hedge_policy
+
+
+def _hedge_target(config):
+    """对冲请求发往的提供商: (提供商, 地址, 请求头, 模型)；没有其他可用的提供商时返回None"""
+    for name, url, headers, model in _failover_chain(config.provider, config.url, config.headers)[1:]:
+        # 只查看熔断器状态，不占用半开状态的试探名额
+        breaker = get_circuit_breaker(name)
+        if breaker.state == breaker.CLOSED:
+            return name, url, headers, model
+    return None
+
+
+def _timed_send(policy, operation, provider, *args, **kwargs):
+    """
+    调用 _send_request，成功时把耗时记录为对冲等待时间的样本
+
+    样本与对冲时等待的是同一段时间：非流式请求包括读取完整的响应体，流式请求到收到响应头为止。
+    """
+    started = time.perf_counter()
+    result = _send_request(provider, *args, **kwargs)
+    policy.observe(provider, operation, time.perf_counter() - started)
+    return result
+
+
+async def _atimed_send(policy, operation, provider, *args, **kwargs):
+    """_timed_send 的异步版本；被取消的请求不记录样本"""
+    started = time.perf_counter()
+    result = await _asend_request(provider, *args, **kwargs)
+    policy.observe(provider, operation, time.perf_counter() - started)
+    return result
+
+
+def _run_in_thread(func, *args, **kwargs):
+    """在新线程中运行函数（复制当前的上下文变量，如请求优先级），返回 concurrent.futures.Future"""
+    future = Future()
+    context = contextvars.copy_context()
+    
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = context.run(func, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+    
+    threading.Thread(target=run, name='llm-hedge', daemon=True).start()
+    return future
+
+
+def _close_when_done(future):
+    """丢弃较慢的请求：同步请求无法中途中断，返回后立即关闭响应，把连接归还连接池"""
+    def close(done):
+        if done.exception() is None:
+            done.result()[0].close()
+    future.add_done_callback(close)
+
+
+def _send_hedged(policy, config, data, stream=False):
+    """
+    带对冲的 _send_request：首选提供商超过等待时间还没有响应时，向另一个提供商发送相同的请求
+    
+    返回:
+        (requests.Response对象, 实际使用的提供商)
+    """
+    target = _hedge_target(config)
+    if target is None:
+        return _send_request(config.provider, config.url, config.headers, data, stream=stream)
+    policy.record_request()
+    operation = _operation(data, stream)
+    primary = _run_in_thread(_timed_send, policy, operation, config.provider, config.url, config.headers, data,
+                             stream=stream)
+    if wait([primary], timeout=policy.delay(config.provider, operation)).done:
+        return primary.result()
+    if not policy.try_hedge():
+        _HEDGES.inc(config.provider, 'budget_exhausted')
+        return primary.result()
+    
+    _HEDGES.inc(config.provider, 'fired')
+    name, url, headers, model = target
+    hedge = _run_in_thread(_timed_send, policy, operation, name, url, headers, dict(data, model=model),
+                           stream=stream, failover=False)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in (primary, hedge) if future in done and future.exception() is None), None)
+        if winner is not None:
+            _close_when_done(hedge if winner is primary else primary)
+            policy.record_result(winner is hedge)
+            _HEDGES.inc(config.provider, 'won' if winner is hedge else 'lost')
+            return winner.result()
+    # 两个请求都失败：抛出首选提供商的错误（包含切换提供商的过程）
+    return primary.result()
+
+
+# ========== 提示词前缀缓存统计 ==========
+_prefix_cache_stats = PrefixCacheStats()
+
+
+def _record_usage(provider, model, usage):
+    """记录API返回的token用量：前缀缓存命中情况和各类token数量"""
+    if not usage:
+        return
+    _prefix_cache_stats.record(provider, usage)
+    for key, kind in (('prompt_tokens', 'prompt'), ('completion_tokens', 'completion')):
+        if usage.get(key):
+            _TOKENS.inc(provider, model, kind, amount=usage[key])
+    cache = parse_cache_usage(usage)
+    if cache is not None and cache[0]:
+        _TOKENS.inc(provider, model, 'cached_prompt', amount=cache[0])
+
+
+def get_prefix_cache_stats():
+    """
+    获取各提供商提示词前缀缓存（context caching）的命中情况
+    
+    根据API返回的 usage 统计（DeepSeek: prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+    OpenAI: prompt_tokens_details.cached_tokens），可以用来确认菜单系统提示词是否命中缓存。
     
     返回:
-        tuple: (api_key, api_url, default_model)
+        dict: {提供商: {'requests', 'hit_tokens', 'miss_tokens', 'hit_rate'}}
+    """
+    return _prefix_cache_stats.snapshot()
+
+
+def estimate_prompt(messages, model=None, max_tokens=500):
     """
-    # 获取API提供商（默认为deepseek）
-    provider = os.getenv('API_PROVIDER', 'deepseek').lower()
+    发送请求前在本地估算提示词的token数量和最高费用（不访问网络）
     
-    # 根据提供商返回不同的配置
-    configs = {
-        'deepseek': {
-            'key': 'DEEPSEEK_API_KEY',
-            'url': 'https://api.deepseek.com/v1/chat/completions',
-            'default_model': 'deepseek-chat'
-        },
-        'openai': {
-            'key': 'OPENAI_API_KEY',
-            'url': 'https://api.openai.com/v1/chat/completions',
-            'default_model': 'gpt-3.5-turbo'
-        }
+    参数:
+        messages: 消息列表
+        model: 使用的模型，如果为None则使用当前提供商的默认模型
+        max_tokens: 回复的最大token数量
+    
+    返回:
+        dict: {'model', 'prompt_tokens', 'max_completion_tokens', 'estimated_cost'}，
+              详见 token_counter.estimate_request
+    """
+    if model is None:
+        model = get_api_config().default_model
+    return estimate_request(messages, model, max_tokens)
+
+
+def _check_prompt_size(messages, model):
+    """
+    请求前检查提示词是否超过 MAX_PROMPT_TOKENS（未设置时不检查）
+    
+    返回:
+        超过限制时返回错误信息，否则返回None
+    """
+    limit = getenv('MAX_PROMPT_TOKENS')
+    if not limit:
+        return None
+    prompt_tokens = estimate_request(messages, model, 0)['prompt_tokens']
+    if prompt_tokens > int(limit):
+        return f"错误: 提示词约{prompt_tokens}个token，超过了 MAX_PROMPT_TOKENS={limit} 的限制，请缩短对话后重试"
+    return None
+
+
+class ToolCall:
+    """
+    模型请求调用的一个工具（函数）
+    
+    属性:
+        id: 调用ID，返回工具结果时作为 tool_call_id
+        name: 工具名称
+        arguments: 解析后的参数（dict）；模型生成的参数不是合法JSON时为None
+        raw_arguments: 模型生成的原始参数字符串
+    """
+    
+    __slots__ = ('id', 'name', 'arguments', 'raw_arguments')
+    
+    def __init__(self, id, name, arguments, raw_arguments):
+        self.id = id
+        self.name = name
+        self.arguments = arguments
+        self.raw_arguments = raw_arguments
+    
+    @classmethod
+    def from_response(cls, data):
+        """从响应中的 tool_calls 元素解析"""
+        function = data.get('function') or {}
+        raw = function.get('arguments') or '{}'
+        try:
+            arguments = _loads(raw) if isinstance(raw, (str, bytes)) else raw
+        except ValueError:
+            arguments = None
+        if not isinstance(arguments, dict):
+            arguments = None
+        return cls(data.get('id'), function.get('name'), arguments, raw if isinstance(raw, str) else json.dumps(raw))
+    
+    def as_dict(self):
+        """转换为请求中 assistant 消息的 tool_calls 元素格式"""
+        return {'id': self.id, 'type': 'function', 'function': {'name': self.name, 'arguments': self.raw_arguments}}
+    
+    def __repr__(self):
+        return f"ToolCall(id={self.id!r}, name={self.name!r}, arguments={self.arguments!r})"
+
+
+class CompletionResult:
+    """
+    一次对话请求的结果
+    
+    属性:
+        content: 回复内容（只调用工具时为空字符串）
+        usage: API返回的token使用情况（dict），响应中没有时为None
+        latency: 从发送请求到解析完响应的耗时（秒），缓存命中时为0
+        provider: 实际使用的提供商（切换提供商后与首选的不同）
+        model: 实际使用的模型
+        cached: 是否来自回复缓存
+        tool_calls: 模型请求调用的工具（ToolCall列表），没有时为空列表
+        finish_reason: 结束原因，如 'stop'、'length'、'tool_calls'
+    """
+    
+    __slots__ = ('content', 'usage', 'latency', 'provider', 'model', 'cached', 'tool_calls', 'finish_reason')
+    
+    def __init__(self, content, usage, latency, provider, model, cached=False, tool_calls=None, finish_reason=None):
+        self.content = content
+        self.usage = usage
+        self.latency = latency
+        self.provider = provider
+        self.model = model
+        self.cached = cached
+        self.tool_calls = tool_calls or []
+        self.finish_reason = finish_reason
+    
+    def assistant_message(self):
+        """
+        本次回复对应的 assistant 消息，可以直接追加到对话历史中（包括 tool_calls）
+        """
+        message = {'role': 'assistant', 'content': self.content}
+        if self.tool_calls:
+            message['tool_calls'] = [call.as_dict() for call in self.tool_calls]
+        return message
+    
+    def token_counts(self):
+        """
+        返回:
+            dict: {'prompt_tokens', 'completion_tokens', 'total_tokens'}，usage中没有的项为0
+        """
+        usage = self.usage or {}
+        return {key: usage.get(key, 0) for key in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+    
+    def as_dict(self):
+        """转换为字典，便于序列化为JSON"""
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result['tool_calls'] = [call.as_dict() for call in self.tool_calls]
+        return result
+    
+    def __repr__(self):
+        return (f"CompletionResult(provider={self.provider!r}, model={self.model!r}, "
+                f"cached={self.cached}, latency={self.latency:.3f}, content={self.content[:30]!r})")
+
+
+def _prepare_chat(messages, model, temperature, max_tokens, stream=False, options=None):
+    """
+    构造对话请求，未配置API密钥或提示词过长时抛出APIError
+    
+    参数:
+        options: 其他请求字段（如 tools、tool_choice、response_format），值为None的字段不发送
+    
+    返回:
+        (ProviderConfig, 请求体)
+    """
+    config = get_api_config()
+    
+    if not config.api_key:
+        key_name = API_CONFIGS[config.provider]['key']
+        raise APIError(f"错误: 请在.env文件中设置 {key_name} 或设置 API_PROVIDER={config.provider}", config.provider)
+    
+    # 如果没有指定模型，使用默认模型
+    if model is None:
+        model = config.default_model
+    
+    data = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,  # 控制模型输出的随机程度
     }
+    if max_tokens is not None:
+        data["max_tokens"] = max_tokens
+    if stream:
+        data["stream"] = True
+        data["stream_options"] = {"include_usage": True}  # 最后一个数据块返回usage
+    for name, value in (options or {}).items():
+        if value is not None:
+            data[name] = value
+    
+    # 发送前检查提示词长度，过长时不发起请求
+    size_error = _check_prompt_size(messages, model)
+    if size_error:
+        raise APIError(size_error, config.provider)
+    return config, data
+
+
+def _send_chat(config, data, stream=False):
+    """
+    发送对话请求（重试 + 熔断 + 提供商切换）
+    
+    返回:
+        (requests.Response对象, 实际使用的提供商, 实际使用的模型)
+    
+    异常:
+        APIError: 错误信息已包含提供商说明，可以直接显示给用户
+    """
+    try:
+        policy = _get_hedge_policy()
+        if policy is None:
+            response, provider = _send_request(config.provider, config.url, config.headers, data, stream=stream)
+        else:
+            response, provider = _send_hedged(policy, config, data, stream=stream)
+    except APIError as e:
+        raise APIError(f"调用{config.provider} API时发生错误: {str(e)}", config.provider, e.status_code) from e
+    return response, provider, _model_used(config, provider, data)
+
+
+def _model_used(config, provider, data):
+    # 切换提供商时使用的是该提供商的默认模型
+    return data["model"] if provider == config.provider else get_provider_config(provider).default_model
+
+
+def _parse_completion(provider, model, body, started):
+    """
+    解析对话接口的响应体（只解码一次），并记录前缀缓存命中情况
+    
+    返回:
+        CompletionResult
+    """
+    decode_started = time.perf_counter()
+    try:
+        result = _loads(body)
+        choice = result['choices'][0]
+        message = choice['message']
+        # 只调用工具时 content 为null
+        content = message.get('content') or ''
+        tool_calls = [ToolCall.from_response(call) for call in message.get('tool_calls') or ()]
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        raise APIError(f"调用{provider} API时发生错误: 无法解析的响应 {str(e)}", provider) from e
+    finished = time.perf_counter()
+    _REQUEST_SECONDS.observe(finished - decode_started, provider, 'completion', 'decode')
+    _REQUEST_SECONDS.observe(finished - started, provider, 'completion', 'total')
+    usage = result.get('usage')
+    _record_usage(provider, model, usage)
+    return CompletionResult(content, usage, finished - started, provider, model,
+                            tool_calls=tool_calls, finish_reason=choice.get('finish_reason'))
+
+
+def _has_options(options):
+    return bool(options) and any(value is not None for value in options.values())
+
+
+def _complete(messages, model, temperature, max_tokens, need_usage=False, options=None):
+    """
+    所有非流式对话请求共用的核心：构造请求、查缓存、发送、解析、写缓存
+    
+    参数:
+        need_usage: 为True时忽略没有记录token使用情况的缓存
+        options: 其他请求字段（tools、tool_choice、response_format）；使用这些字段的请求不使用回复缓存
+    """
+    config, data = _prepare_chat(messages, model, temperature, max_tokens, options=options)
+    model = data["model"]
+    
+    # 相同的请求直接返回缓存的回复（缓存只保存文本回复，不保存工具调用）
+    cache_key, cached = (None, None) if _has_options(options) else \
+        _cache_lookup(config.provider, model, messages, temperature, max_tokens)
+    if cached is not None and (cached.get('usage') or not need_usage):
+        return CompletionResult(cached['content'], cached.get('usage'), 0.0, config.provider, model, cached=True)
+    
+    started = time.perf_counter()
+    # 临时性错误自动重试，首选提供商不可用时切换到其他提供商
+    response, provider, model = _send_chat(config, data)
+    result = _parse_completion(provider, model, response.content, started)
+    _cache_store(cache_key, result.content, result.usage)
+    return result
+
+
+def chat_completion(messages, model=None, temperature=0, max_tokens=500,
+                    tools=None, tool_choice=None, response_format=None):
+    """
+    获取AI回复以及token使用情况、耗时等信息，失败时抛出异常（适合批量任务等需要区分成功与失败的场景）
     
-    # 如果提供商不在配置中，使用deepseek作为默认
-    if provider not in configs:
-        provider = 'deepseek'
+    参数与 get_completion_from_messages 相同；max_tokens为None时不限制回复长度。另外支持:
+        tools: 工具（函数）定义列表，格式见 function_calling.function_tool
+        tool_choice: 'auto'、'none'、'required' 或 {"type": "function", "function": {"name": ...}}（强制调用指定工具）
+        response_format: 例如 {"type": "json_object"}（JSON模式，提示词中需要要求模型输出JSON）
     
-    config = configs[provider]
-    api_key = os.getenv(config['key'])
+    返回:
+        CompletionResult: 包含 content、usage、latency、provider、model、cached、tool_calls、finish_reason
     
-    return api_key, config['url'], config['default_model'], provider
+    异常:
+        APIError: 未配置API密钥、提示词过长，或请求在重试和切换提供商后仍然失败
+    """
+    options = {'tools': tools, 'tool_choice': tool_choice, 'response_format': response_format}
+    return _complete(messages, model, temperature, max_tokens, options=options)
+
 
 def get_completion(prompt, model=None, temperature=0.7):
     """
@@ -48,46 +1259,16 @@ def get_completion(prompt, model=None, temperature=0.7):
         temperature: 温度参数，控制输出的随机性，范围0-1，默认为0.7
     
     返回:
-        AI模型的回复内容
+        AI模型的回复内容；调用失败时返回错误信息
     
     环境变量配置:
         API_PROVIDER: 选择API提供商，可选 'deepseek' 或 'openai'（默认: deepseek）
         DEEPSEEK_API_KEY: DeepSeek API密钥
         OPENAI_API_KEY: OpenAI API密钥
     """
-    # 获取API配置
-    api_key, api_url, default_model, provider = get_api_config()
-    
-    if not api_key:
-        configs = {
-            'deepseek': {'key': 'DEEPSEEK_API_KEY'},
-            'openai': {'key': 'OPENAI_API_KEY'}
-        }
-        key_name = configs.get(provider, configs['deepseek'])['key']
-        return f"错误: 请在.env文件中设置 {key_name} 或设置 API_PROVIDER={provider}"
-    
-    # 如果没有指定模型，使用默认模型
-    if model is None:
-        model = default_model
-    
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    data = {
-        "model": model,
-        "messages": [
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": temperature
-    }
-    
-    try:
-        response = requests.post(api_url, json=data, headers=headers)
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
-    except Exception as e:
-        return f"调用{provider} API时发生错误: {str(e)}"
+    return get_completion_from_messages(
+        [{"role": "user", "content": prompt}], model=model, temperature=temperature, max_tokens=None
+    )
 
 
 def get_completion_from_messages(messages, model=None, temperature=0, max_tokens = 500):
@@ -99,43 +1280,92 @@ def get_completion_from_messages(messages, model=None, temperature=0, max_tokens
                   role可以是: "system", "user", "assistant"
         model: 使用的模型，如果为None则使用默认模型
         temperature: 温度参数，控制模型输出的随机程度，范围0-1，默认为0
+        max_tokens: 回复的最大token数量，为None时不限制
     
     返回:
-        AI模型的回复内容
+        AI模型的回复内容；调用失败时返回错误信息（需要区分成功与失败时请使用 chat_completion）
     
     环境变量配置:
         API_PROVIDER: 选择API提供商，可选 'deepseek' 或 'openai'（默认: deepseek）
         DEEPSEEK_API_KEY: DeepSeek API密钥
         OPENAI_API_KEY: OpenAI API密钥
     """
-    # 获取API配置
-    api_key, api_url, default_model, provider = get_api_config()
+    try:
+        return _complete(messages, model, temperature, max_tokens).content
+    except APIError as e:
+        return str(e)
+
+
+def _iter_sse_events(response):
+    """
+    增量解析SSE（Server-Sent Events）响应，逐个产出 data 字段解码后的JSON对象
+
+    按网络到达的数据块逐行解析，不会缓冲整个响应体；遇到 [DONE] 时结束。
+    """
+    for line in response.iter_lines(chunk_size=None):
+        if not line or not line.startswith(b'data:'):
+            continue
+        payload = line[5:].strip()
+        if payload == b'[DONE]':
+            break
+        yield _loads(payload)
+
+
+def stream_completion_from_messages(messages, model=None, temperature=0, max_tokens=500):
+    """
+    以流式方式从消息列表获取AI回复，逐段产出生成的文本（stream: true）
+
+    参数与 get_completion_from_messages 相同。
     
-    if not api_key:
-        return f"错误: 请在.env文件中设置相应的API密钥，或设置 API_PROVIDER={provider}"
+    返回:
+        生成器，每次产出一段新生成的回复文本；把所有片段拼接起来就是完整回复
     
-    # 如果没有指定模型，使用默认模型
-    if model is None:
-        model = default_model
+    异常:
+        APIError: 未配置API密钥、提示词过长，或请求在重试和切换提供商后仍然失败。
+                  与 get_completion_from_messages 不同，错误不会作为回复文本产出，
+                  调用方可以把错误与正常回复区分开显示
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    data = {
-        "model": model,
-        "messages": messages,  # 直接使用传入的messages列表
-        "temperature": temperature,  # 控制模型输出的随机程度
-        "max_tokens": max_tokens,
-    }
+    示例:
+        for chunk in stream_completion_from_messages(messages):
+            print(chunk, end='', flush=True)
+    """
+    config, data = _prepare_chat(messages, model, temperature, max_tokens, stream=True)
     
-    try:
-        response = requests.post(api_url, json=data, headers=headers)
-        response.raise_for_status()
-        # print(str(response.json()['choices'][0]['message']))  # 可选：打印完整响应
-        return response.json()['choices'][0]['message']['content']
-    except Exception as e:
-        return f"调用{provider} API时发生错误: {str(e)}"
+    # 缓存命中时一次性产出完整回复
+    cache_key, cached = _cache_lookup(config.provider, data["model"], messages, temperature, max_tokens)
+    if cached is not None:
+        yield cached['content']
+        return
+    
+    # 开始接收回复之前的错误会自动重试或切换提供商
+    started = time.perf_counter()
+    response, provider, model = _send_chat(config, data, stream=True)
+    
+    # 连接在生成器结束（或被提前关闭）时归还连接池
+    chunks = []
+    usage = None
+    with response:
+        try:
+            for event in _iter_sse_events(response):
+                if event.get('usage'):
+                    usage = event['usage']
+                    _record_usage(provider, model, usage)
+                choices = event.get('choices') or []
+                if not choices:
+                    continue
+                chunk = choices[0].get('delta', {}).get('content')
+                if chunk:
+                    if not chunks:
+                        _REQUEST_SECONDS.observe(time.perf_counter() - started, provider, 'stream', 'first_token')
+                    chunks.append(chunk)
+                    yield chunk
+        except Exception as e:
+            # 已经产出部分内容，无法再重试
+            raise APIError(f"调用{provider} API时发生错误: {str(e)}", provider) from e
+    
+    _REQUEST_SECONDS.observe(time.perf_counter() - started, provider, 'stream', 'total')
+    # 只缓存完整接收的回复
+    _cache_store(cache_key, ''.join(chunks), usage)
 
 def get_completion_and_token_count(messages, 
                                    model=None, 
@@ -153,42 +1383,14 @@ def get_completion_and_token_count(messages,
     返回:
     content: 生成的回复内容。
     token_dict: 包含'prompt_tokens'、'completion_tokens'和'total_tokens'的字典，分别表示提示的 token 数量、生成的回复的 token 数量和总的 token 数量。
+    调用失败时 content 为错误信息（与 get_completion_from_messages 相同），token_dict 中的各项均为0。
     """
-    api_key, api_url, default_model, provider = get_api_config()
-    
-    if not api_key:
-        return f"错误: 请在.env文件中设置相应的API密钥，或设置 API_PROVIDER={provider}"
-    
-    if model is None:
-        model = default_model
-    
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    data = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-    }
-    
     try:
-        response = requests.post(api_url, json=data, headers=headers)
-        response.raise_for_status()
-        # return response.json()['choices'][0]['message']['content']
-    except Exception as e:
-        print(f"调用{provider} API时发生错误: {str(e)}")
-
-    content = response.json()['choices'][0]['message']['content']
-    
-    token_dict = {
-        'prompt_tokens':response.json()['usage']['prompt_tokens'],
-        'completion_tokens':response.json()['usage']['completion_tokens'],
-        'total_tokens':response.json()['usage']['total_tokens'],
-    }
-
-    return content, token_dict
+        # 缓存命中时也需要token使用情况，没有记录usage的缓存不算命中
+        result = _complete(messages, model, temperature, max_tokens, need_usage=True)
+    except APIError as e:
+        return str(e), {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    return result.content, result.token_counts()
 
 def moderation_create(input_text, model="omni-moderation-latest"):
     """
@@ -240,21 +1442,18 @@ def moderation_create(input_text, model="omni-moderation-latest"):
         OPENAI_API_KEY: OpenAI API密钥（用于审核功能）
     """
     # 获取OpenAI API密钥
-    openai_api_key = os.getenv('OPENAI_API_KEY')
+    config = get_provider_config('openai')
     
-    if not openai_api_key:
+    if not config.api_key:
         return {
             'error': '错误: 请在.env文件中设置 OPENAI_API_KEY 以使用审核功能',
             'flagged': True  # 如果无法审核，默认标记为需要审核
         }
     
-    # OpenAI Moderation API端点
-    moderation_url = 'https://api.openai.com/v1/moderations'
+    # OpenAI Moderation API端点（可以通过 OPENAI_BASE_URL 覆盖根地址）
+    moderation_url = f"{config.base_url}/moderations"
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai_api_key}"
-    }
+    headers = config.headers
     
     # 确保input是列表格式
     if isinstance(input_text, str):
@@ -268,44 +1467,447 @@ def moderation_create(input_text, model="omni-moderation-latest"):
     }
     
     try:
-        response = requests.post(moderation_url, json=data, headers=headers)
-        response.raise_for_status()
-        result = response.json()
-        
-        # 如果输入是单个字符串，返回单个结果；如果是列表，返回所有结果
-        if isinstance(input_text, str) and len(result.get('results', [])) > 0:
-            # 返回格式化的单个结果
-            single_result = result['results'][0]
-            return {
-                'id': result.get('id'),
-                'model': result.get('model'),
-                'flagged': single_result.get('flagged', False),
-                'categories': single_result.get('categories', {}),
-                'category_scores': single_result.get('category_scores', {}),
-                'results': result.get('results', [])
-            }
-        else:
-            # 返回完整结果
-            return result
+        # 临时性错误（包括429）自动重试；审核只有OpenAI提供，不切换提供商
+        started = time.perf_counter()
+        response, _ = _send_request('openai', moderation_url, headers, data, failover=False)
+        return _format_moderation_result(input_text, _decode_moderation(response.content, started))
             
-    except requests.exceptions.HTTPError as e:
+    except APIError as e:
         # HTTP错误（如401未授权、403禁止等）
-        error_msg = str(e)
-        if e.response.status_code == 401:
-            error_msg = "OpenAI API密钥无效或未授权。请检查您的 OPENAI_API_KEY 是否正确。"
-        elif e.response.status_code == 403:
-            error_msg = "OpenAI API访问被禁止。请检查您的API密钥权限。"
-        elif e.response.status_code == 429:
-            error_msg = "OpenAI API请求频率过高，请稍后再试。"
-        
+        return _moderation_error(_moderation_error_message(e.status_code, str(e)))
+    except Exception as e:
+        return _moderation_error(str(e))
+
+
+def _decode_moderation(body, started):
+    """解析审核接口的响应体，并记录解析耗时和总耗时"""
+    decode_started = time.perf_counter()
+    result = _loads(body)
+    finished = time.perf_counter()
+    _REQUEST_SECONDS.observe(finished - decode_started, 'openai', 'moderation', 'decode')
+    _REQUEST_SECONDS.observe(finished - started, 'openai', 'moderation', 'total')
+    return result
+
+
+def _format_moderation_result(input_text, result):
+    """
+    整理Moderation API的返回结果
+    
+    如果输入是单个字符串，返回单个结果；如果是列表，返回所有结果
+    """
+    if isinstance(input_text, str) and len(result.get('results', [])) > 0:
+        # 返回格式化的单个结果
+        single_result = result['results'][0]
         return {
-            'error': f'调用OpenAI Moderation API时发生错误: {error_msg}',
-            'flagged': False,  # API调用失败时，不标记为不当内容，避免误判
-            'api_error': True  # 标记这是API错误，不是内容问题
+            'id': result.get('id'),
+            'model': result.get('model'),
+            'flagged': single_result.get('flagged', False),
+            'categories': single_result.get('categories', {}),
+            'category_scores': single_result.get('category_scores', {}),
+            'results': result.get('results', [])
         }
+    else:
+        # 返回完整结果
+        return result
+
+
+def _moderation_error_message(status_code, default):
+    """把常见的HTTP状态码转换为可读的错误说明"""
+    if status_code == 401:
+        return "OpenAI API密钥无效或未授权。请检查您的 OPENAI_API_KEY 是否正确。"
+    elif status_code == 403:
+        return "OpenAI API访问被禁止。请检查您的API密钥权限。"
+    elif status_code == 429:
+        return "OpenAI API请求频率过高，请稍后再试。"
+    return default
+
+
+def _moderation_error(error_msg):
+    """构造审核API调用失败时的返回结果"""
+    return {
+        'error': f'调用OpenAI Moderation API时发生错误: {error_msg}',
+        'flagged': False,  # API调用失败时，不标记为不当内容，避免误判
+        'api_error': True  # 标记这是API错误，不是内容问题
+    }
+
+
+# ========== 异步API（asyncio） ==========
+# 异步版本供 panel serve 等高并发场景使用：等待LLM回复时不会占用工作线程。
+# httpx.AsyncClient 绑定在创建它的事件循环上，所以按 (事件循环, 提供商) 缓存。
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _http2_available():
+    """是否安装了h2，安装后异步客户端会与支持HTTP/2的提供商协商HTTP/2"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_async_client(provider):
+    """
+    获取当前事件循环中指定提供商共享的异步HTTP客户端，首次调用时创建
+    
+    同一事件循环内的所有异步请求复用同一个连接池；安装h2时启用HTTP/2，
+    多个并发请求可以复用同一条连接。
+    
+    参数:
+        provider: API提供商名称，如 'deepseek' 或 'openai'
+    
+    返回:
+        httpx.AsyncClient对象
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(provider)
+    if client is None or client.is_closed:
+        import httpx
+        settings = get_http_settings()
+        client = httpx.AsyncClient(
+            http2=_http2_available(),
+            limits=httpx.Limits(
+                max_connections=settings['async_pool_size'],
+                max_keepalive_connections=settings['async_pool_size'],
+            ),
+            timeout=httpx.Timeout(settings['read_timeout'], connect=settings['connect_timeout']),
+        )
+        clients[provider] = client
+    return client
+
+
+async def aclose_sessions():
+    """
+    关闭当前事件循环中所有的异步HTTP客户端（服务关闭时调用）
+    """
+    import asyncio
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
+
+
+async def _apost(provider, url, headers, data, stream=False):
+    """
+    _post 的异步版本，通过共享的异步连接池发送POST请求
+    
+    stream为True时响应体不会被读取，调用方读取完后需要调用 response.aclose()
+    """
+    cassette = _get_cassette()
+    if cassette is not None:
+        if cassette.mode != 'record':
+            response = await cassette.areplay(provider, url, data)
+            if response is not None:
+                return response
+        headers = dict(headers, **{'Accept-Encoding': 'identity'})
+    client = get_async_client(provider)
+    connect = {}
+    
+    async def trace(event, info):
+        # 只有新建连接时才会收到 connection.* 事件
+        if event == 'connection.connect_tcp.started':
+            connect['started'] = time.perf_counter()
+        elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            connect['finished'] = time.perf_counter()
+    
+    request = client.build_request(
+        'POST', url, content=encode_request_body(data), headers=headers, extensions={'trace': trace}
+    )
+    started = time.perf_counter()
+    try:
+        response = await client.send(request, stream=stream)
+    finally:
+        if 'finished' in connect:
+            _CONNECT_SECONDS.observe(connect['finished'] - connect['started'], provider)
+    if cassette is not None:
+        response = cassette.arecord(provider, url, data, response, started)
+    return response
+
+
+async def _arequest_with_retry(provider, url, headers, data, stream=False):
+    """_request_with_retry 的异步版本，排队和等待重试时都不阻塞事件循环"""
+    import asyncio
+    policy = get_retry_policy()
+    limiter, tokens = _rate_limit_for(provider, headers, data)
+    operation = _operation(data, stream)
+    for attempt in range(policy.max_retries + 1):
+        if limiter is not None:
+            await limiter.aacquire(tokens)
+        started = time.perf_counter()
+        try:
+            # 总是先只读取响应头，以便单独记录首字节时间
+            response = await _apost(provider, url, headers, data, stream=True)
+            try:
+                _REQUEST_SECONDS.observe(time.perf_counter() - started, provider, operation, 'ttfb')
+                response.raise_for_status()
+                if not stream:
+                    await response.aread()
+            except BaseException:
+                await response.aclose()
+                raise
+            _REQUESTS.inc(provider, operation, 'ok')
+            return response
+        except Exception as e:
+            _REQUESTS.inc(provider, operation, _outcome(e))
+            delay = _backoff(limiter, e, policy, attempt)
+            if attempt == policy.max_retries or not _is_retryable(e):
+                raise
+            await asyncio.sleep(delay)
+
+
+async def _asend_request(provider, api_url, headers, data, stream=False, failover=True):
+    """
+    _send_request 的异步版本：重试 + 熔断 + 提供商切换（与同步版本共用熔断器）
+    
+    返回:
+        (httpx.Response对象, 实际使用的提供商)
+    """
+    errors = []
+    operation = _operation(data, stream)
+    for name, url, request_headers, model in _failover_chain(provider, api_url, headers, failover):
+        breaker = get_circuit_breaker(name)
+        if not breaker.allow():
+            _REQUESTS.inc(name, operation, 'circuit_open')
+            errors.append((name, CircuitOpenError(f"{name} API暂时不可用（熔断中）")))
+            continue
+        
+        payload = data if model is None else dict(data, model=model)
+        try:
+            with span('llm.request', provider=name, operation=operation):
+                response = await _arequest_with_retry(name, url, request_headers, payload, stream=stream)
+        except Exception as e:
+            if _is_retryable(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            errors.append((name, e))
+            status = _error_status(e)
+            if status is not None and status not in FAILOVER_STATUS:
+                break
+            continue
+        except BaseException:
+            # 请求被取消（如对冲请求中较慢的一个、会话结束）时没有结果，归还半开状态的试探名额，
+            # 否则熔断器永远无法恢复
+            breaker.release_probe()
+            raise
+        
+        breaker.record_success()
+        return response, name
+    
+    _FAILURES.inc(provider, operation)
+    raise _give_up(provider, errors)
+
+
+def _discard_task(task):
+    """丢弃较慢的请求：还在进行时取消（中断连接），已经返回的响应立即关闭"""
+    import asyncio
+    
+    def close(done):
+        if not done.cancelled() and done.exception() is None:
+            asyncio.ensure_future(done.result()[0].aclose())
+    task.add_done_callback(close)
+    task.cancel()
+
+
+async def _asend_hedged(policy, config, data, stream=False):
+    """_send_hedged 的异步版本，较慢的请求会被取消（中断连接）"""
+    import asyncio
+    target = _hedge_target(config)
+    if target is None:
+        return await _asend_request(config.provider, config.url, config.headers, data, stream=stream)
+    policy.record_request()
+    operation = _operation(data, stream)
+    primary = asyncio.ensure_future(
+        _atimed_send(policy, operation, config.provider, config.url, config.headers, data, stream=stream)
+    )
+    tasks = [primary]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=policy.delay(config.provider, operation))
+        if not done:
+            if not policy.try_hedge():
+                _HEDGES.inc(config.provider, 'budget_exhausted')
+            else:
+                _HEDGES.inc(config.provider, 'fired')
+                name, url, headers, model = target
+                hedge = asyncio.ensure_future(
+                    _atimed_send(policy, operation, name, url, headers, dict(data, model=model), stream=stream,
+                                 failover=False)
+                )
+                tasks.append(hedge)
+                pending = set(tasks)
+                while pending and winner is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    winner = next((task for task in tasks if task in done and task.exception() is None), None)
+                if winner is not None:
+                    policy.record_result(winner is hedge)
+                    _HEDGES.inc(config.provider, 'won' if winner is hedge else 'lost')
+                    return winner.result()
+        # 没有对冲，或两个请求都失败：返回首选提供商的结果（或抛出其错误，包含切换提供商的过程）
+        winner = primary
+        return await primary
+    finally:
+        # 返回结果、抛出异常或调用方被取消时，取消（或关闭）其余的请求
+        for task in tasks:
+            if task is not winner:
+                _discard_task(task)
+
+
+async def aget_completion(prompt, model=None, temperature=0.7):
+    """
+    get_completion 的异步版本
+    
+    参数和返回值与 get_completion 相同。任务被取消（例如用户离开会话）时，
+    会抛出 asyncio.CancelledError 并中断正在进行的请求。
+    """
+    return await aget_completion_from_messages(
+        [{"role": "user", "content": prompt}], model=model, temperature=temperature, max_tokens=None
+    )
+
+
+async def _asend_chat(config, data, stream=False):
+    """_send_chat 的异步版本，返回 (httpx.Response对象, 实际使用的提供商, 实际使用的模型)"""
+    try:
+        policy = _get_hedge_policy()
+        if policy is None:
+            response, provider = await _asend_request(config.provider, config.url, config.headers, data, stream=stream)
+        else:
+            response, provider = await _asend_hedged(policy, config, data, stream=stream)
+    except APIError as e:
+        raise APIError(f"调用{config.provider} API时发生错误: {str(e)}", config.provider, e.status_code) from e
+    return response, provider, _model_used(config, provider, data)
+
+
+async def _acomplete(messages, model, temperature, max_tokens, need_usage=False, options=None):
+    """_complete 的异步版本"""
+    config, data = _prepare_chat(messages, model, temperature, max_tokens, options=options)
+    model = data["model"]
+    
+    # 相同的请求直接返回缓存的回复（缓存只保存文本回复，不保存工具调用）
+    cache_key, cached = (None, None) if _has_options(options) else \
+        _cache_lookup(config.provider, model, messages, temperature, max_tokens)
+    if cached is not None and (cached.get('usage') or not need_usage):
+        return CompletionResult(cached['content'], cached.get('usage'), 0.0, config.provider, model, cached=True)
+    
+    started = time.perf_counter()
+    # 临时性错误自动重试，首选提供商不可用时切换到其他提供商
+    response, provider, model = await _asend_chat(config, data)
+    result = _parse_completion(provider, model, response.content, started)
+    _cache_store(cache_key, result.content, result.usage)
+    return result
+
+
+async def aget_completion_from_messages(messages, model=None, temperature=0, max_tokens=500):
+    """
+    get_completion_from_messages 的异步版本
+    
+    参数和返回值与 get_completion_from_messages 相同；max_tokens为None时不限制回复长度。
+    任务被取消时会抛出 asyncio.CancelledError 并中断正在进行的请求。
+    """
+    try:
+        return (await _acomplete(messages, model, temperature, max_tokens)).content
+    except APIError as e:
+        return str(e)
+
+
+async def achat_completion(messages, model=None, temperature=0, max_tokens=500,
+                           tools=None, tool_choice=None, response_format=None):
+    """
+    chat_completion 的异步版本
+    
+    参数、返回值和异常与 chat_completion 相同。
+    """
+    options = {'tools': tools, 'tool_choice': tool_choice, 'response_format': response_format}
+    return await _acomplete(messages, model, temperature, max_tokens, options=options)
+
+
+async def astream_completion_from_messages(messages, model=None, temperature=0, max_tokens=500):
+    """
+    stream_completion_from_messages 的异步版本
+    
+    返回:
+        异步生成器，逐段产出回复文本
+    
+    异常:
+        APIError: 与 stream_completion_from_messages 相同
+    
+    示例:
+        async for chunk in astream_completion_from_messages(messages):
+            print(chunk, end='', flush=True)
+    """
+    config, data = _prepare_chat(messages, model, temperature, max_tokens, stream=True)
+    
+    # 缓存命中时一次性产出完整回复
+    cache_key, cached = _cache_lookup(config.provider, data["model"], messages, temperature, max_tokens)
+    if cached is not None:
+        yield cached['content']
+        return
+    
+    # 开始接收回复之前的错误会自动重试或切换提供商
+    started = time.perf_counter()
+    response, provider, model = await _asend_chat(config, data, stream=True)
+    
+    chunks = []
+    usage = None
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue
+            payload = line[5:].strip()
+            if payload == '[DONE]':
+                break
+            event = _loads(payload)
+            if event.get('usage'):
+                usage = event['usage']
+                _record_usage(provider, model, usage)
+            choices = event.get('choices') or []
+            if not choices:
+                continue
+            chunk = choices[0].get('delta', {}).get('content')
+            if chunk:
+                if not chunks:
+                    _REQUEST_SECONDS.observe(time.perf_counter() - started, provider, 'stream', 'first_token')
+                chunks.append(chunk)
+                yield chunk
     except Exception as e:
+        # 已经产出部分内容，无法再重试
+        raise APIError(f"调用{provider} API时发生错误: {str(e)}", provider) from e
+    finally:
+        await response.aclose()
+    
+    _REQUEST_SECONDS.observe(time.perf_counter() - started, provider, 'stream', 'total')
+    # 只缓存完整接收的回复
+    _cache_store(cache_key, ''.join(chunks), usage)
+
+
+async def amoderation_create(input_text, model="omni-moderation-latest"):
+    """
+    moderation_create 的异步版本
+    
+    参数和返回值与 moderation_create 相同。
+    """
+    config = get_provider_config('openai')
+    
+    if not config.api_key:
         return {
-            'error': f'调用OpenAI Moderation API时发生错误: {str(e)}',
-            'flagged': False,  # API调用失败时，不标记为不当内容，避免误判
-            'api_error': True  # 标记这是API错误，不是内容问题
+            'error': '错误: 请在.env文件中设置 OPENAI_API_KEY 以使用审核功能',
+            'flagged': True  # 如果无法审核，默认标记为需要审核
         }
+    
+    moderation_url = f"{config.base_url}/moderations"
+    
+    headers = config.headers
+    data = {
+        "input": [input_text] if isinstance(input_text, str) else input_text,
+        "model": model
+    }
+    
+    try:
+        started = time.perf_counter()
+        response, _ = await _asend_request('openai', moderation_url, headers, data, failover=False)
+        return _format_moderation_result(input_text, _decode_moderation(response.content, started))
+    except APIError as e:
+        return _moderation_error(_moderation_error_message(e.status_code, str(e)))
+    except Exception as e:
+        return _moderation_error(str(e))
@@ -0,0 +1,84 @@
+"""
+对话记录显示组件
+每轮对话只把新增的消息发送到浏览器，而不是重新构造并发送整个对话记录：
+- 对话记录是一个固定的 Feed 布局，新消息直接追加，已显示的消息不会重新渲染
+- Feed 只在浏览器中渲染可见区域附近的消息（load_buffer），滚动时再加载，较早的消息不占用DOM
+- 每个会话最多保留 max_messages 条消息组件，超出的最早的消息从服务端移除，
+  顶部显示一条提示（对话历史仍完整保存在会话存储中，只是不再显示）
+
+这样每轮对话更新界面的开销与对话长度无关。
+
+示例:
+    transcript = Transcript()
+    reply_pane = pn.pane.Markdown('')
+    transcript.append(pn.Row('用户:', pn.pane.Markdown('你好')), pn.Row('助手:', reply_pane))
+    reply_pane.object = '你好！'   # 只更新这一个组件
+"""
+
+import panel as pn
+
+from env_loader import getenv
+
+# 每个会话最多保留的消息组件数量（TRANSCRIPT_MAX_MESSAGES）
+TRANSCRIPT_MAX_MESSAGES = int(getenv('TRANSCRIPT_MAX_MESSAGES', '200'))
+# 浏览器中可见区域两侧渲染的消息数量（TRANSCRIPT_LOAD_BUFFER）
+TRANSCRIPT_LOAD_BUFFER = int(getenv('TRANSCRIPT_LOAD_BUFFER', '20'))
+
+
+class Transcript:
+    """
+    一个会话的对话记录
+
+    参数:
+        max_messages: 最多保留的消息数量（每条消息一个组件，通常是 pn.Row）
+        load_buffer: 浏览器中可见区域两侧渲染的消息数量
+        **params: 传给 pn.layout.Feed 的其他参数（如 height、width）
+
+    属性:
+        view: 放入页面的 Panel 布局，在会话中保持不变
+        hidden: 已经从显示中移除的消息数量
+    """
+
+    def __init__(self, max_messages=None, load_buffer=None, **params):
+        self.max_messages = max(max_messages or TRANSCRIPT_MAX_MESSAGES, 1)
+        self.hidden = 0
+        self._notice = pn.pane.Markdown('', visible=False, styles={'color': '#999', 'text-align': 'center'})
+        params.setdefault('height', 400)
+        params.setdefault('auto_scroll_limit', 400)
+        self.view = pn.layout.Feed(
+            self._notice,
+            load_buffer=load_buffer or TRANSCRIPT_LOAD_BUFFER,
+            view_latest=True,
+            **params
+        )
+
+    def __len__(self):
+        return len(self.view) - 1
+
+    def __getitem__(self, index):
+        return self.view.objects[1:][index]
+
+    def append(self, *rows):
+        """
+        追加一条或多条消息（一次界面更新）
+
+        超过 max_messages 时同时移除最早的消息，被移除的组件及其浏览器端模型随之释放。
+        """
+        overflow = len(self) + len(rows) - self.max_messages
+        if overflow <= 0:
+            self.view.extend(rows)
+            return
+        self.hidden += overflow
+        self._notice.object = f"更早的 {self.hidden} 条消息已不再显示"
+        self._notice.visible = True
+        self.view.objects = [self._notice] + (self.view.objects[1:] + list(rows))[overflow:]
+
+    def replace_last(self, row):
+        """替换最后一条消息（如把回复框换成错误提示）"""
+        self.view[-1] = row
+
+    def clear(self):
+        """清空显示的对话记录"""
+        self.hidden = 0
+        self._notice.visible = False
+        self.view.objects = [self._notice]